@@ -0,0 +1,152 @@
+from PyQt5.QtCore import QAbstractListModel, QModelIndex, QPoint, QRect, QSize, Qt
+from PyQt5.QtGui import QBrush, QColor, QFontMetrics, QPainter
+from PyQt5.QtWidgets import QStyledItemDelegate
+
+# Роли данных модели истории
+DIRECTION_ROLE = Qt.UserRole
+CURSOR_ROLE = Qt.UserRole + 1
+
+# Оформление сообщений: фон входящих и исходящих, цвет текста.
+# Объекты общие для всех строк, а не создаются для каждого сообщения
+IN_BRUSH = QBrush(QColor(255, 213, 213))
+OUT_BRUSH = QBrush(QColor(204, 255, 204))
+TEXT_COLOR = QColor(27, 31, 37)
+# Отступы внутри сообщения и между сообщениями, радиус углов, доля ширины списка под сообщение
+PADDING = 6
+MARGIN = 3
+RADIUS = 6
+BUBBLE_WIDTH = 0.75
+
+
+class HistoryModel(QAbstractListModel):
+    """
+    The model of the messages of the current chat.
+    Keeps only the loaded part of the history as tuples (direction, text, (date, id)),
+    the text is formatted once when the message is added. New messages are appended
+    and older pages are inserted at the top without rebuilding the model.
+    """
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.rows = []
+
+    @staticmethod
+    def make_row(item):
+        """Makes the row of the model from the history tuple (contact, direction, message, date, id)."""
+
+        contact, direction, message, date, message_id = item
+        date_text = date.replace(microsecond=0)
+        if direction == 'in':
+            text = f'{contact}:\n{message}\n{date_text}'
+        else:
+            text = f'{message}\n{date_text}'
+        return direction, text, (date, message_id)
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.rows)
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid():
+            return None
+        direction, text, cursor = self.rows[index.row()]
+        if role == Qt.DisplayRole:
+            return text
+        if role == DIRECTION_ROLE:
+            return direction
+        if role == CURSOR_ROLE:
+            return cursor
+        if role == Qt.TextAlignmentRole:
+            return Qt.AlignLeft if direction == 'in' else Qt.AlignRight
+        return None
+
+    def set_messages(self, messages):
+        """Replaces the contents of the model with the list of history tuples."""
+
+        self.beginResetModel()
+        self.rows = [self.make_row(item) for item in messages]
+        self.endResetModel()
+
+    def clear(self):
+        """Removes all the messages."""
+
+        self.set_messages([])
+
+    def append_message(self, item):
+        """Adds a new message to the end."""
+
+        row = len(self.rows)
+        self.beginInsertRows(QModelIndex(), row, row)
+        self.rows.append(self.make_row(item))
+        self.endInsertRows()
+
+    def prepend_messages(self, messages):
+        """Inserts the page of older messages at the top."""
+
+        if not messages:
+            return
+        self.beginInsertRows(QModelIndex(), 0, len(messages) - 1)
+        self.rows[0:0] = [self.make_row(item) for item in messages]
+        self.endInsertRows()
+
+    def oldest(self):
+        """Returns (date, id) of the oldest loaded message or None if the model is empty."""
+
+        return self.rows[0][2] if self.rows else None
+
+
+class MessageDelegate(QStyledItemDelegate):
+    """
+    The delegate that paints the messages of the history as bubbles:
+    incoming at the left edge, outgoing at the right edge, each with its own background.
+    The text sizes are computed once per message and cached until the width of the list changes.
+    """
+
+    def __init__(self, view):
+        super().__init__(view)
+        self.view = view
+        # (дата, id) сообщения -> прямоугольник текста
+        self.rects = dict()
+        self.width = None
+
+    def text_rect(self, option, index):
+        """Returns the rectangle occupied by the wrapped text of the message."""
+
+        width = self.view.viewport().width()
+        if width != self.width:
+            self.width = width
+            self.rects.clear()
+        key = index.data(CURSOR_ROLE)
+        rect = self.rects.get(key)
+        if rect is None:
+            rect = QFontMetrics(option.font).boundingRect(
+                QRect(0, 0, max(int(width * BUBBLE_WIDTH) - 2 * PADDING, 1), 0),
+                Qt.TextWordWrap, index.data(Qt.DisplayRole)
+            )
+            self.rects[key] = rect
+        return rect
+
+    def sizeHint(self, option, index):
+        rect = self.text_rect(option, index)
+        return QSize(self.width, rect.height() + 2 * PADDING + 2 * MARGIN)
+
+    def paint(self, painter, option, index):
+        incoming = index.data(DIRECTION_ROLE) == 'in'
+        rect = self.text_rect(option, index)
+
+        bubble = QRect(0, 0, rect.width() + 2 * PADDING, rect.height() + 2 * PADDING)
+        if incoming:
+            bubble.moveTopLeft(option.rect.topLeft() + QPoint(MARGIN, MARGIN))
+        else:
+            bubble.moveTopRight(option.rect.topRight() + QPoint(-MARGIN, MARGIN))
+
+        painter.save()
+        painter.setRenderHint(QPainter.Antialiasing)
+        painter.setPen(Qt.NoPen)
+        painter.setBrush(IN_BRUSH if incoming else OUT_BRUSH)
+        painter.drawRoundedRect(bubble, RADIUS, RADIUS)
+        painter.setPen(TEXT_COLOR)
+        painter.setFont(option.font)
+        painter.drawText(bubble.adjusted(PADDING, PADDING, -PADDING, -PADDING),
+                         Qt.TextWordWrap | (Qt.AlignLeft if incoming else Qt.AlignRight),
+                         index.data(Qt.DisplayRole))
+        painter.restore()
@@ -0,0 +1,76 @@
+import logging
+import threading
+
+from Cryptodome.Cipher import PKCS1_OAEP
+from Cryptodome.PublicKey import RSA
+
+LOGGER = logging.getLogger('client')
+
+
+class PublicKeyCache:
+    """
+    The cache of the public keys of other users by the user name.
+    Holds the key together with the ready encryption object, so opening a chat
+    does not parse the key. The keys are saved in the client database and survive restarts;
+    the entry of a user is dropped when the server reports that the user's key has changed.
+    """
+
+    def __init__(self, database):
+        self.database = database
+        # Имя пользователя -> (ключ, объект шифрования)
+        self.keys = dict()
+        self.lock = threading.Lock()
+        self.update(database.get_public_keys(), save=False)
+
+    def get(self, name):
+        """The method that returns the pair (key, encryptor) or None if the key is unknown."""
+
+        with self.lock:
+            return self.keys.get(name)
+
+    def missing(self, names):
+        """The method that returns the names from the list whose keys are not in the cache."""
+
+        with self.lock:
+            return [name for name in names if name not in self.keys]
+
+    def update(self, keys, save=True):
+        """
+        The method that puts the received keys (name -> key) into the cache.
+        Only new and changed keys are parsed and saved to the database.
+        """
+
+        changed = dict()
+        for name, key in keys.items():
+            cached = self.get(name)
+            if cached and cached[0] == key:
+                continue
+            try:
+                encryptor = PKCS1_OAEP.new(RSA.import_key(key))
+            except (ValueError, IndexError, TypeError):
+                LOGGER.error(f'Invalid public key of the user {name}')
+                continue
+            with self.lock:
+                self.keys[name] = (key, encryptor)
+            changed[name] = key
+
+        if changed and save:
+            self.database.save_public_keys(changed)
+
+    def invalidate(self, name):
+        """The method that drops the key of the user."""
+
+        with self.lock:
+            self.keys.pop(name, None)
+        self.database.del_public_keys([name])
+
+    def retain(self, names):
+        """The method that drops the keys of the users not in the list (deleted from the server)."""
+
+        names = set(names)
+        with self.lock:
+            removed = [name for name in self.keys if name not in names]
+            for name in removed:
+                del self.keys[name]
+        if removed:
+            self.database.del_public_keys(removed)
@@ -4,17 +4,17 @@ import sys
 import logging
 
 from Cryptodome.Cipher import PKCS1_OAEP
-from Cryptodome.PublicKey import RSA
-from PyQt5.QtWidgets import QMainWindow, qApp, QMessageBox
-from PyQt5.QtGui import QStandardItemModel, QStandardItem, QBrush, QColor
+from PyQt5.QtWidgets import QAbstractItemView, QListView, QMainWindow, qApp, QMessageBox
+from PyQt5.QtGui import QStandardItemModel, QStandardItem
 from PyQt5.QtCore import pyqtSlot, Qt
 
 sys.path.append('../')
-from common.variables import ENCODING, MESSAGE_TEXT, SENDER
+from common.variables import ENCODING, HISTORY_PAGE, MESSAGE_TEXT, SENDER
 from common.qss import style
 from client.main_window_config import Ui_MainClientWindow
 from client.add_contact import AddContactDialog
 from client.del_contact import DelContactDialog
+from client.history_view import HistoryModel, MessageDelegate
 from common.errors import ServerError
 
 LOGGER = logging.getLogger('client')
@@ -54,7 +54,8 @@ class ClientMainWindow(QMainWindow):
 
         # Дополнительные требующиеся атрибуты
         self.contacts_model = None
-        self.history_model = None
+        # Есть ли в базе сообщения старше загруженных в модель истории
+        self.history_more = False
         self.current_chat = None
         self.current_chat_key = None
         self.encryptor = None
@@ -63,6 +64,18 @@ class ClientMainWindow(QMainWindow):
         self.ui.messages_list.setHorizontalScrollBarPolicy(Qt.ScrollBarAlwaysOff)
         self.ui.messages_list.setWordWrap(True)
 
+        # История: модель с загруженной частью переписки и делегат, рисующий сообщения
+        self.history_model = HistoryModel(self)
+        self.history_delegate = MessageDelegate(self.ui.messages_list)
+        self.ui.messages_list.setModel(self.history_model)
+        self.ui.messages_list.setItemDelegate(self.history_delegate)
+        self.ui.messages_list.setVerticalScrollMode(QAbstractItemView.ScrollPerPixel)
+        # Высота сообщений зависит от ширины списка
+        self.ui.messages_list.setResizeMode(QListView.Adjust)
+        self.ui.messages_list.setLayoutMode(QListView.Batched)
+        # Старые сообщения подгружаются, когда историю прокручивают до начала
+        self.ui.messages_list.verticalScrollBar().valueChanged.connect(self.history_scrolled)
+
         self.ui.contacts_list.clicked.connect(self.select_active_user)
 
         self.clients_list_update()
@@ -75,8 +88,9 @@ class ClientMainWindow(QMainWindow):
         self.ui.new_message_label.setText('Select a chat to start messaging')
 
         self.ui.message_text.clear()
-        if self.history_model:
-            self.history_model.clear()
+        # Очистка модели сбрасывает прокрутку: подгрузка старых сообщений при этом не нужна
+        self.history_more = False
+        self.history_model.clear()
 
         # Поле ввода и кнопка отправки неактивны до выбора получателя
         self.ui.clear_btn.setDisabled(True)
@@ -95,50 +109,66 @@ class ClientMainWindow(QMainWindow):
     def history_list_update(self):
         """
         The method that fills the corresponding QListView
-        with the history of correspondence with the current interlocutor.
+        with the last messages of correspondence with the current interlocutor.
+        Older messages are loaded page by page when the list is scrolled up (history_load_older)
+        and until the list gets a scroll bar (history_fill).
         """
 
-        messages_list = sorted(
-            self.database.get_history(self.current_chat),
-            key=lambda item: item[3]
-        )
+        messages_list = self.database.get_history(self.current_chat, HISTORY_PAGE)
 
-        # Создаем модель, если не создана
-        if not self.history_model:
-            self.history_model = QStandardItemModel()
-            self.ui.messages_list.setModel(self.history_model)
+        # Замена содержимого модели сбрасывает прокрутку,
+        # поэтому наличие старых сообщений отмечаем только после заполнения
+        self.history_more = False
+        self.history_delegate.rects.clear()
+        self.history_model.set_messages(messages_list)
+        self.history_more = len(messages_list) == HISTORY_PAGE
+        self.history_fill()
+        self.ui.messages_list.scrollToBottom()
 
-        # Очистим от старых записей
-        self.history_model.clear()
+    def history_fill(self):
+        """
+        The method that loads older pages while the whole loaded history fits into the list:
+        without the scroll bar the list cannot be scrolled to the top to load them.
+        """
 
-        # Берём не более 20 последних записей.
-        length = len(messages_list)
-        start_idx = 0
-        if length > 20:
-            start_idx = length - 20
-
-        # Заполнение модели записями, так же стоит разделить входящие и исходящие
-        # сообщения выравниванием и разным фоном.
-        # Записи в обратном порядке, поэтому выбираем их с конца и не более 20
-        for i in range(start_idx, length):
-            item = messages_list[i]
-
-            if item[1] == 'in':
-                msg = QStandardItem(f'{self.current_chat}:\n{item[2]}\n{item[3].replace(microsecond=0)}')
-                msg.setEditable(False)
-                msg.setBackground(QBrush(QColor(255, 213, 213)))
-                msg.setForeground(QBrush(QColor(27, 31, 37)))
-                msg.setTextAlignment(Qt.AlignLeft)
-                self.history_model.appendRow(msg)
-            else:
-                msg = QStandardItem(f'{item[2]}\n{item[3].replace(microsecond=0)}')
-                msg.setEditable(False)
-                msg.setTextAlignment(Qt.AlignRight)
-                msg.setBackground(QBrush(QColor(204, 255, 204)))
-                msg.setForeground(QBrush(QColor(27, 31, 37)))
-                self.history_model.appendRow(msg)
+        scroll_bar = self.ui.messages_list.verticalScrollBar()
+        while self.history_more and self.current_chat:
+            # Пакетная раскладка выполняется отложенно: раскладываем сейчас, чтобы узнать высоту списка
+            self.ui.messages_list.doItemsLayout()
+            if scroll_bar.maximum() > 0:
+                break
+            self.history_load_older()
+
+    def history_append(self, item):
+        """The method that adds a new message of the current chat to the end of the history."""
+
+        self.history_model.append_message(item)
         self.ui.messages_list.scrollToBottom()
 
+    def history_scrolled(self, value):
+        """The slot that loads the previous page of the history when the list is scrolled to the top."""
+
+        if value == self.ui.messages_list.verticalScrollBar().minimum():
+            self.history_load_older()
+
+    def history_load_older(self):
+        """
+        The method that adds the previous page of the history to the top of the list.
+        The list stays on the message that was at the top before loading.
+        """
+
+        if not self.history_more or not self.current_chat:
+            return
+        messages_list = self.database.get_history(self.current_chat, HISTORY_PAGE, self.history_model.oldest())
+        self.history_more = len(messages_list) == HISTORY_PAGE
+        if not messages_list:
+            return
+
+        self.history_model.prepend_messages(messages_list)
+        self.ui.messages_list.scrollTo(
+            self.history_model.index(len(messages_list), 0), QAbstractItemView.PositionAtTop
+        )
+
     def select_active_user(self):
         """The method event handler for a click on the list of contacts."""
 
@@ -153,12 +183,10 @@ class ClientMainWindow(QMainWindow):
         """Chat activation method with the interlocutor."""
 
         self.setStyleSheet(style.COMMON_THEME)
-        # Запрашиваем публичный ключ пользователя и создаём объект шифрования
+        # Ключ и объект шифрования берём из кеша; запрос на сервер только для ключа, которого там нет
         try:
-            self.current_chat_key = self.transport.key_request(self.current_chat)
+            self.current_chat_key, self.encryptor = self.transport.public_key(self.current_chat) or (None, None)
             LOGGER.debug(f'Uploaded public key for {self.current_chat}')
-            if self.current_chat_key:
-                self.encryptor = PKCS1_OAEP.new(RSA.import_key(self.current_chat_key))
         except (OSError, json.JSONDecodeError):
             self.current_chat_key = None
             self.encryptor = None
@@ -301,9 +329,9 @@ class ClientMainWindow(QMainWindow):
             self.messages.critical(self, 'Error', 'Lost connection to server')
             self.close()
         else:
-            self.database.save_message(self.current_chat, 'out', message_text)
+            item = self.database.save_message(self.current_chat, 'out', message_text)
             LOGGER.debug(f'Sent a message to {self.current_chat}: {message_text}')
-            self.history_list_update()
+            self.history_append(item)
 
     @pyqtSlot(dict)
     def message(self, message):
@@ -323,12 +351,14 @@ class ClientMainWindow(QMainWindow):
             self.messages.warning(self, 'Error', 'Failed to decode message')
             return
 
-            # Сохраняем сообщение в базу и обновляем историю сообщений или открываем новый чат
-        self.database.save_message(self.current_chat, 'in', decrypted_message.decode(ENCODING))
-
+        # Сохраняем сообщение в историю отправителя, а не открытого чата: сообщение от другого
+        # собеседника не попадает в чужую переписку. Сохранение выполняется один раз -
+        # чат, открытый ниже, читает сообщение из базы
         sender = message[SENDER]
+        item = self.database.save_message(sender, 'in', decrypted_message.decode(ENCODING))
+
         if sender == self.current_chat:
-            self.history_list_update()
+            self.history_append(item)
         else:
             # Проверим есть ли такой пользователь у нас в контактах:
             if self.database.check_contact(sender):
@@ -353,7 +383,6 @@ class ClientMainWindow(QMainWindow):
                 ) == QMessageBox.Yes:
                     self.add_contact(sender)
                     self.current_chat = sender
-                    self.database.save_message(self.current_chat, 'in', decrypted_message.decode(ENCODING))
                     self.set_active_user()
 
     @pyqtSlot()
@@ -381,9 +410,22 @@ class ClientMainWindow(QMainWindow):
             self.current_chat = None
         self.clients_list_update()
 
+    @pyqtSlot(str)
+    def sig_206(self, user):
+        """A handler slot for the change of the user's public key: replaces the key of the active chat."""
+
+        if user != self.current_chat:
+            return
+        self.current_chat_key, self.encryptor = self.transport.key_cache.get(user) or (None, None)
+        if not self.current_chat_key:
+            self.setStyleSheet(style.COMMON_THEME)
+            self.messages.warning(self, 'Error', 'The selected user does not have an encryption key')
+            self.set_disabled_input()
+
     def make_connection(self, trans_obj):
         """The method for connecting signals and slots."""
 
         trans_obj.new_message.connect(self.message)
         trans_obj.connection_lost.connect(self.connection_lost)
         trans_obj.message_205.connect(self.sig_205)
+        trans_obj.message_206.connect(self.sig_206)
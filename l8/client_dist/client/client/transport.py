@@ -1,38 +1,49 @@
 import binascii
+import errno
 import hashlib
 import hmac
-import json
 import sys
 import time
 import logging
 import threading
+from collections import deque
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+from itertools import count
 
 from socket import socket, AF_INET, SOCK_STREAM
 from PyQt5.QtCore import pyqtSignal, QObject
 
 sys.path.append('../')
+from client.key_cache import PublicKeyCache
+from common.compression import Compression
 from common.errors import ServerError
-from common.utils import get_message, send_message
-from common.variables import (ACCOUNT_NAME, ACTION, ADD_CONTACT, CONNECTION_TIMEOUT, DATA, DESTINATION, ENCODING, ERROR,
-                              EXIT, GET_CONTACTS, LIST_INFO, MESSAGE, MESSAGE_TEXT, PRESENCE, PUBLIC_KEY,
-                              PUBLIC_KEY_REQUEST, REMOVE_CONTACT, RESPONSE, RESPONSE_511, SENDER, TIME, USER,
-                              USERS_REQUEST)
-
-# Логгер и объект блокировки для работы с сокетом.
+from common.utils import ReceiveBuffer, get_message, send_message
+from common.variables import (ACCOUNT_NAME, ACTION, ADD_CONTACT, CODEC, CODEC_BINARY, COMPRESSION, COMPRESSION_ZLIB,
+                              DATA, DELAY, DESTINATION, ENCODING, ERROR, EXIT, FRAMING, FRAMING_LENGTH,
+                              GET_CONTACTS, LIST_INFO, MESSAGE, MESSAGE_TEXT, PRESENCE, PUBLIC_KEY, PUBLIC_KEY_REQUEST,
+                              REMOVE_CONTACT, REQUEST_ID, RESPONSE, RESPONSE_511, SENDER, TIME, UPDATE_LISTS_SPREAD,
+                              USER, USERS_ADDED, USERS_REMOVED, USERS_REQUEST, VERSION)
+
+# Логгер и объект блокировки для записи в сокет.
 LOGGER = logging.getLogger('client')
 socket_lock = threading.Lock()
+# Время ожидания ответа сервера на запрос (секунды)
+REQUEST_TIMEOUT = 5
 
 
 class ClientTransport(threading.Thread, QObject):
     """
     Implements the transport subsystem of the client module.
     Responsible for interacting with the server.
+    The thread reads the socket all the time: the answers complete the futures
+    of the requests, the messages of users and 205/206 notifications are passed to the signals.
     """
     new_message = pyqtSignal(dict)
     message_205 = pyqtSignal()
+    message_206 = pyqtSignal(str)
     connection_lost = pyqtSignal()
 
-    def __init__(self, port, ip, database, username, pswd, keys):
+    def __init__(self, port, ip, database, username, pswd, keys, binary=False):
         # Вызываем конструктор предка
         threading.Thread.__init__(self)
         QObject.__init__(self)
@@ -41,18 +52,37 @@ class ClientTransport(threading.Thread, QObject):
         self.username = username
         self.password = pswd
         self.keys = keys
+        # Двоичный формат предлагается серверу только по запросу: по умолчанию JSON,
+        # под который составлен словарь сжатия
+        self.binary = binary
+        # Открытые ключи собеседников, загружаются одним запросом при входе
+        self.key_cache = PublicKeyCache(database)
         self.transport = None
+        # Буфер приёма; режим кадрирования согласуется с сервером при авторизации
+        self.buffer = ReceiveBuffer()
+        # Сообщения пользователей, пришедшие до запуска потока чтения.
+        # Обрабатываются потоком, когда окно уже подписано на сигналы
+        self.incoming_messages = deque()
+        # Номера запросов, по которым сопоставляются ответы сервера,
+        # и ожидаемые ответы: номер запроса -> Future
+        self.request_ids = count(1)
+        self.pending = dict()
+        self.pending_lock = threading.Lock()
+        # Версия списка известных пользователей: после 205 запрашиваются только изменения с неё.
+        # Обновления по уведомлениям выполняются по одному
+        self.users_version = None
+        self.lists_lock = threading.Lock()
         self.connection_init(port, ip)
 
         try:
-            self.user_list_update()
-            self.contacts_list_update()
+            self.update_lists()
+            self.update_keys(self.database.get_contacts())
         except OSError as err:
             if err.errno:
                 LOGGER.critical('Lost connection to server')
                 raise ServerError('Lost connection to server')
             LOGGER.error('Connection timeout when updating users lists')
-        except json.JSONDecodeError:
+        except ValueError:
             LOGGER.critical('Lost connection to server')
             raise ServerError('Lost connection to server')
 
@@ -108,14 +138,18 @@ class ClientTransport(threading.Thread, QObject):
                 USER: {
                     ACCOUNT_NAME: self.username,
                     PUBLIC_KEY: public_key
-                }
+                },
+                FRAMING: FRAMING_LENGTH,
+                COMPRESSION: COMPRESSION_ZLIB
             }
+            if self.binary:
+                presence[CODEC] = CODEC_BINARY
             LOGGER.debug(f'Presence message: {presence}')
 
             # Отправляем серверу приветственное сообщение
             try:
-                send_message(self.transport, presence)
-                answer = get_message(self.transport)
+                self.write(presence)
+                answer = get_message(self.transport, self.buffer)
                 LOGGER.debug(f'Server response: {answer}')
 
                 # Если сервер вернул ошибку, бросаем исключение
@@ -125,15 +159,22 @@ class ClientTransport(threading.Thread, QObject):
 
                     elif answer[RESPONSE] == 511:
                         # Если всё нормально, то продолжаем процедуру авторизации
+                        # Сервер, поддерживающий кадрирование, подтверждает его в ответе 511
+                        self.buffer.framed = answer.get(FRAMING) == FRAMING_LENGTH
+                        # и двоичный формат, если клиент его предложил; иначе остаётся JSON
+                        self.buffer.binary = self.buffer.framed and answer.get(CODEC) == CODEC_BINARY
+                        # Сжатие больших кадров (списки пользователей и контактов)
+                        if self.buffer.framed and answer.get(COMPRESSION) == COMPRESSION_ZLIB:
+                            self.buffer.compression = Compression()
                         answer_data = answer[DATA]
                         hash = hmac.new(pswd_hash_str, answer_data.encode(ENCODING), 'MD5')
                         digest = hash.digest()
                         my_answer = RESPONSE_511
                         my_answer[DATA] = binascii.b2a_base64(digest).decode('ascii')
-                        send_message(self.transport, my_answer)
-                        self.process_server_answer(get_message(self.transport))
+                        self.write(my_answer)
+                        self.process_server_answer(get_message(self.transport, self.buffer))
 
-            except (OSError, json.JSONDecodeError) as err:
+            except (OSError, ValueError) as err:
                 LOGGER.critical('Connection error.', exc_info=err)
                 raise ServerError('Connection failure during authorization process')
 
@@ -148,9 +189,11 @@ class ClientTransport(threading.Thread, QObject):
             elif message[RESPONSE] == 400:
                 raise ServerError(f'{message[ERROR]}')
             elif message[RESPONSE] == 205:
-                self.user_list_update()
-                self.contacts_list_update()
-                self.message_205.emit()
+                # Поток чтения не может ждать ответов на запросы списков: обновляем их в отдельном потоке
+                threading.Thread(target=self.lists_changed, args=(message.get(VERSION), message.get(DELAY)),
+                                 daemon=True).start()
+            elif message[RESPONSE] == 206 and isinstance(message.get(ACCOUNT_NAME), str):
+                threading.Thread(target=self.key_changed, args=(message[ACCOUNT_NAME],), daemon=True).start()
             else:
                 LOGGER.debug(f'Unknown verification code received: {message[RESPONSE]}')
 
@@ -163,45 +206,200 @@ class ClientTransport(threading.Thread, QObject):
             LOGGER.debug(f'Message from user {message[SENDER]}: {message[MESSAGE_TEXT]}')
             self.new_message.emit(message)
 
-    def contacts_list_update(self):
-        """The method that updates the list of contacts from the server."""
+    def write(self, message):
+        """The method that sends a message to the server in the format agreed at authorization."""
 
-        self.database.contacts_clear()
-        LOGGER.debug(f'Request a contact list for user {self.name}')
-        req = {
+        send_message(self.transport, message, self.buffer.framed, self.buffer.binary, self.buffer.compression)
+
+    def route(self, message):
+        """
+        The method that routes a message received from the server. The answer completes the future
+        of its request; user messages and 205/206 notifications are processed by process_server_answer,
+        before the start of the reader thread they are put aside for it.
+        """
+
+        if message.get(ACTION) == MESSAGE or message.get(RESPONSE) in (205, 206):
+            if self.is_alive():
+                self.process_server_answer(message)
+            else:
+                self.incoming_messages.append(message)
+            return
+
+        with self.pending_lock:
+            future = self.pending.pop(message.pop(REQUEST_ID, None), None)
+            # Сервер, не возвращающий номера запросов, отвечает в порядке запросов
+            if future is None and self.pending:
+                future = self.pending.pop(next(iter(self.pending)))
+        if future is None:
+            LOGGER.error(f'Unexpected answer from the server: {message}')
+        else:
+            future.set_result(message)
+
+    def pipeline(self, requests):
+        """
+        The method that sends several requests without waiting for the answers
+        and returns the answers in the order of the requests, so all of them take one round trip.
+        The answers are matched by the request id; a server that does not return the ids
+        answers in the order of the requests.
+        """
+
+        futures = dict()
+        with socket_lock:
+            for request in requests:
+                request[REQUEST_ID] = next(self.request_ids)
+                future = futures[request[REQUEST_ID]] = Future()
+                with self.pending_lock:
+                    self.pending[request[REQUEST_ID]] = future
+                try:
+                    self.write(request)
+                except OSError:
+                    with self.pending_lock:
+                        self.pending.pop(request[REQUEST_ID], None)
+                    raise
+
+        # До запуска потока чтения (авторизация и загрузка списков) ответы читаются здесь же
+        if not self.is_alive():
+            while not all(future.done() for future in futures.values()):
+                self.route(get_message(self.transport, self.buffer))
+
+        answers = []
+        for request_id, future in futures.items():
+            try:
+                answers.append(future.result(REQUEST_TIMEOUT))
+            except FutureTimeoutError:
+                with self.pending_lock:
+                    self.pending.pop(request_id, None)
+                raise TimeoutError('No answer from the server')
+        LOGGER.debug(f'Answers received {answers}')
+        return answers
+
+    def request(self, request):
+        """The method that sends one request to the server and returns the answer."""
+
+        return self.pipeline([request])[0]
+
+    def lists_changed(self, version=None, delay=None):
+        """
+        The method that updates the lists after the 205 notification and notifies the window.
+        The request is sent after the delay given by the server, so the clients do not request the lists at once.
+        """
+
+        if isinstance(delay, (int, float)) and delay > 0:
+            time.sleep(min(delay, UPDATE_LISTS_SPREAD))
+        with self.lists_lock:
+            # Список уже этой версии (изменения получены по другому уведомлению)
+            if version is not None and version == self.users_version:
+                return
+            try:
+                self.sync_users()
+                # Ключи новых контактов загружаем заранее
+                self.update_keys(self.key_cache.missing(self.database.get_contacts()))
+            except (OSError, ServerError) as err:
+                LOGGER.error(f'Failed to update lists: {err}')
+                return
+        self.message_205.emit()
+
+    def key_changed(self, user):
+        """
+        The method that drops the cached key of the user after the 206 notification,
+        loads the new key of a contact in advance and notifies the window.
+        """
+
+        # Базу меняет и поток обновления списков: работаем с ней по очереди
+        with self.lists_lock:
+            self.key_cache.invalidate(user)
+            if self.database.check_contact(user):
+                try:
+                    self.update_keys([user])
+                except (OSError, ServerError) as err:
+                    LOGGER.error(f'Failed to update the key of {user}: {err}')
+        self.message_206.emit(user)
+
+    def update_lists(self):
+        """The method that updates the lists of known users and contacts with one round trip to the server."""
+
+        users, contacts = self.pipeline([self.users_request(), self.contacts_request()])
+        self.save_users(users)
+        self.save_contacts(contacts)
+
+    def contacts_request(self):
+        """The method that creates the request for the contact list."""
+
+        LOGGER.debug(f'Request a contact list for user {self.username}')
+        return {
             ACTION: GET_CONTACTS,
             TIME: time.time(),
             USER: self.username,
         }
-        LOGGER.debug(f'Request generated: {req}')
 
-        with socket_lock:
-            send_message(self.transport, req)
-            ans = get_message(self.transport)
-        LOGGER.debug(f'Answer received {ans}')
+    def save_contacts(self, ans):
+        """The method that saves the contact list received from the server."""
 
         if RESPONSE in ans and ans[RESPONSE] == 202:
+            self.database.contacts_clear()
             for contact in ans[LIST_INFO]:
                 self.database.add_contact(contact)
         else:
             LOGGER.error('Failed to update contacts list')
 
-    def user_list_update(self):
-        """The method that updates the list of users from the server."""
+    def contacts_list_update(self):
+        """The method that updates the list of contacts from the server."""
+
+        self.save_contacts(self.request(self.contacts_request()))
+
+    def users_request(self):
+        """
+        The method that creates the request for the known users.
+        With the known version of the list the server answers with the changes since it.
+        """
+
         LOGGER.debug(f'Query a list of known users {self.username}')
-        req = {
+        request = {
             ACTION: USERS_REQUEST,
             TIME: time.time(),
             ACCOUNT_NAME: self.username
         }
-        with socket_lock:
-            send_message(self.transport, req)
-            ans = get_message(self.transport)
-        if RESPONSE in ans and ans[RESPONSE] == 202:
+        if self.users_version is not None:
+            request[VERSION] = self.users_version
+        return request
+
+    def save_users(self, ans):
+        """
+        The method that saves the list of known users received from the server.
+        Returns the removed users if the answer contains the changes of the list, otherwise None.
+        """
+
+        if RESPONSE in ans and ans[RESPONSE] == 202 and LIST_INFO in ans:
             self.database.add_users(ans[LIST_INFO])
+            self.users_version = ans.get(VERSION)
+        elif RESPONSE in ans and ans[RESPONSE] == 202 and USERS_ADDED in ans and USERS_REMOVED in ans:
+            self.database.update_users(ans[USERS_ADDED], ans[USERS_REMOVED])
+            self.users_version = ans[VERSION]
+            return ans[USERS_REMOVED]
         else:
             LOGGER.error('Failed to update list of known users.')
 
+    def sync_users(self):
+        """
+        The method that brings the list of known users up to date after the 205 notification.
+        The contacts of the removed users are deleted locally; the server that sends
+        the whole list is asked for the contact list too.
+        """
+
+        removed = self.save_users(self.request(self.users_request()))
+        if removed is None:
+            self.key_cache.retain(self.database.get_users())
+            self.contacts_list_update()
+            return
+        for user in removed:
+            self.database.del_contact(user)
+            self.key_cache.invalidate(user)
+
+    def user_list_update(self):
+        """The method that updates the list of users from the server."""
+
+        self.save_users(self.request(self.users_request()))
+
     def key_request(self, user):
         """The method that requests the user's public key from the server."""
         LOGGER.debug(f'Public key request for {user}')
@@ -210,14 +408,44 @@ class ClientTransport(threading.Thread, QObject):
             TIME: time.time(),
             ACCOUNT_NAME: user
         }
-        with socket_lock:
-            send_message(self.transport, req)
-            ans = get_message(self.transport)
+        ans = self.request(req)
         if RESPONSE in ans and ans[RESPONSE] == 511:
             return ans[DATA]
         else:
             LOGGER.error(f'Failed to get key from {user}')
 
+    def update_keys(self, users):
+        """The method that requests the public keys of several users with one request and caches them."""
+
+        if not users:
+            return
+        LOGGER.debug(f'Public keys request for {users}')
+        ans = self.request({
+            ACTION: PUBLIC_KEY_REQUEST,
+            TIME: time.time(),
+            ACCOUNT_NAME: list(users)
+        })
+        if RESPONSE in ans and ans[RESPONSE] == 511 and isinstance(ans.get(DATA), dict):
+            self.key_cache.update(ans[DATA])
+        else:
+            # Старый сервер не умеет отвечать списком: ключи запрашиваются по одному при открытии чата
+            LOGGER.error('Failed to get public keys of contacts')
+
+    def public_key(self, user):
+        """
+        The method that returns the pair (key, encryptor) of the user from the cache.
+        The key that is not in the cache yet is requested from the server.
+        Returns None if the user has no key.
+        """
+
+        cached = self.key_cache.get(user)
+        if cached is None:
+            key = self.key_request(user)
+            if key:
+                self.key_cache.update({user: key})
+                cached = self.key_cache.get(user)
+        return cached
+
     def add_contact(self, contact):
         """The method that sends information about adding a contact to the server."""
 
@@ -228,9 +456,7 @@ class ClientTransport(threading.Thread, QObject):
             USER: self.username,
             ACCOUNT_NAME: contact
         }
-        with socket_lock:
-            send_message(self.transport, req)
-            self.process_server_answer(get_message(self.transport))
+        self.process_server_answer(self.request(req))
 
     def remove_contact(self, contact):
         """The method that sends information about deleting a contact to the server."""
@@ -242,9 +468,7 @@ class ClientTransport(threading.Thread, QObject):
             USER: self.username,
             ACCOUNT_NAME: contact
         }
-        with socket_lock:
-            send_message(self.transport, req)
-            self.process_server_answer(get_message(self.transport))
+        self.process_server_answer(self.request(req))
 
     def transport_shutdown(self):
         """The method that notifies the server that the client is shutting down."""
@@ -257,11 +481,11 @@ class ClientTransport(threading.Thread, QObject):
         }
         with socket_lock:
             try:
-                send_message(self.transport, message)
+                self.write(message)
             except OSError:
                 pass
+        # Сервер закрывает соединение в ответ на exit, и поток чтения завершается
         LOGGER.debug('Transport shuts down')
-        time.sleep(CONNECTION_TIMEOUT)
 
     def send_message(self, to, message):
         """The method that sends messages to the server for the user."""
@@ -275,42 +499,44 @@ class ClientTransport(threading.Thread, QObject):
         }
         LOGGER.debug(f'Message dictionary generated: {message_dict}')
 
-        # Необходимо дождаться освобождения сокета для отправки сообщения
-        with socket_lock:
-            send_message(self.transport, message_dict)
-            self.process_server_answer(get_message(self.transport))
-            LOGGER.info(f'Sent message to user {to}')
+        self.process_server_answer(self.request(message_dict))
+        LOGGER.info(f'Sent message to user {to}')
 
     def run(self):
-        """Method containing the main cycle of the transport stream."""
+        """
+        Method containing the main cycle of the transport stream: blocks on the socket
+        and routes every received message, so the messages are delivered without delay.
+        """
 
         LOGGER.debug('The process is running - the receiver of messages from the server')
-        while self.running:
-            # Отдыхаем секунду и снова пробуем захватить сокет. Если не сделать тут задержку,
-            # то отправка может достаточно долго ждать освобождения сокета.
-            time.sleep(1)
-            message = None
+        while self.incoming_messages:
+            self.process_server_answer(self.incoming_messages.popleft())
 
-            with socket_lock:
-                try:
-                    self.transport.settimeout(CONNECTION_TIMEOUT)
-                    message = get_message(self.transport)
-                except OSError as err:
-                    if err.errno:
-                        # выход по таймауту вернёт номер ошибки err.errno равный None
-                        # поэтому, при выходе по таймауту мы сюда попросту не попадём
-                        LOGGER.critical(f'Lost connection to server')
-                        self.running = False
-                        self.connection_lost.emit()
-                # Проблемы с соединением
-                except (ConnectionError, ConnectionAbortedError, ConnectionResetError, json.JSONDecodeError, TypeError):
-                    LOGGER.debug(f'Lost connection to server')
+        while self.running:
+            try:
+                message = get_message(self.transport, self.buffer)
+            except OSError as err:
+                # выход по таймауту вернёт номер ошибки err.errno равный None,
+                # тогда просто продолжаем ждать
+                if not err.errno and self.running:
+                    continue
+                if self.running:
+                    LOGGER.critical(f'Lost connection to server')
                     self.running = False
                     self.connection_lost.emit()
-                finally:
-                    self.transport.settimeout(5)
+                break
+            # Проблемы с соединением
+            except (ValueError, TypeError):
+                LOGGER.critical(f'Lost connection to server')
+                self.running = False
+                self.connection_lost.emit()
+                break
 
-            # Если сообщение получено, то вызываем функцию обработчик:
-            if message:
-                LOGGER.debug(f'Message received from the server: {message}')
-                self.process_server_answer(message)
+            LOGGER.debug(f'Message received from the server: {message}')
+            self.route(message)
+
+        # Ожидающие ответа запросы завершаются ошибкой соединения
+        with self.pending_lock:
+            pending, self.pending = self.pending, dict()
+        for future in pending.values():
+            future.set_exception(ConnectionResetError(errno.ECONNRESET, 'Lost connection to server'))
@@ -0,0 +1,251 @@
+"""
+Compact binary encoding of JIM messages.
+
+The format is a subset of MessagePack: nil, booleans, integers up to 64 bits,
+double precision floats, UTF-8 strings, arrays and maps. Dictionary keys from
+KEYS are written as one byte (a positive fixint) instead of a string,
+other keys are written as strings.
+"""
+import struct
+
+from .variables import (ACCOUNT_NAME, ACTION, CODEC, COMPRESSION, DATA, DELAY, DESTINATION, ENCODING, ERROR,
+                        FRAMING, LIST_INFO, MESSAGE_TEXT, PUBLIC_KEY, REQUEST_ID, RESPONSE, SENDER, TIME, USER,
+                        USERS_ADDED, USERS_REMOVED, VERSION)
+
+# Коды ключей - номера в этом кортеже. Порядок менять нельзя, новые ключи добавляются в конец
+KEYS = (ACTION, TIME, USER, ACCOUNT_NAME, SENDER, DESTINATION, DATA, PUBLIC_KEY, FRAMING, RESPONSE, ERROR,
+        MESSAGE_TEXT, LIST_INFO, CODEC, COMPRESSION, REQUEST_ID, VERSION, USERS_ADDED, USERS_REMOVED,
+        DELAY)
+KEY_CODES = {key: code for code, key in enumerate(KEYS)}
+
+UINT8 = struct.Struct('!B')
+UINT16 = struct.Struct('!H')
+UINT32 = struct.Struct('!I')
+UINT64 = struct.Struct('!Q')
+INT8 = struct.Struct('!b')
+INT16 = struct.Struct('!h')
+INT32 = struct.Struct('!i')
+INT64 = struct.Struct('!q')
+DOUBLE = struct.Struct('!d')
+# Тег -> формат целого числа
+INTEGERS = {
+    0xcc: UINT8, 0xcd: UINT16, 0xce: UINT32, 0xcf: UINT64,
+    0xd0: INT8, 0xd1: INT16, 0xd2: INT32, 0xd3: INT64,
+}
+
+
+def pack(obj):
+    """
+    The function that encodes an object into the binary format.
+    Throws TypeError for the types that can not be encoded.
+    :param obj: dictionary, list, string, number, bool or None.
+    :return: bytes.
+    """
+
+    out = bytearray()
+    _pack(obj, out)
+    return bytes(out)
+
+
+def _pack_header(out, length, fix_tag, fix_limit, tag16, tag32):
+    if length < fix_limit:
+        out.append(fix_tag | length)
+    elif length < 0x10000:
+        out.append(tag16)
+        out += UINT16.pack(length)
+    else:
+        out.append(tag32)
+        out += UINT32.pack(length)
+
+
+def _pack_str(obj, out):
+    data = obj.encode(ENCODING)
+    length = len(data)
+    if length < 32:
+        out.append(0xa0 | length)
+    elif length < 0x100:
+        out.append(0xd9)
+        out.append(length)
+    elif length < 0x10000:
+        out.append(0xda)
+        out += UINT16.pack(length)
+    else:
+        out.append(0xdb)
+        out += UINT32.pack(length)
+    out += data
+
+
+def _pack_int(obj, out):
+    if 0 <= obj < 0x80:
+        out.append(obj)
+    elif -32 <= obj < 0:
+        out.append(obj & 0xff)
+    elif obj >= 0:
+        if obj < 0x100:
+            out.append(0xcc)
+            out.append(obj)
+        elif obj < 0x10000:
+            out.append(0xcd)
+            out += UINT16.pack(obj)
+        elif obj < 0x100000000:
+            out.append(0xce)
+            out += UINT32.pack(obj)
+        else:
+            out.append(0xcf)
+            out += UINT64.pack(obj)
+    elif obj >= -0x80:
+        out.append(0xd0)
+        out += INT8.pack(obj)
+    elif obj >= -0x8000:
+        out.append(0xd1)
+        out += INT16.pack(obj)
+    elif obj >= -0x80000000:
+        out.append(0xd2)
+        out += INT32.pack(obj)
+    else:
+        out.append(0xd3)
+        out += INT64.pack(obj)
+
+
+def _pack(obj, out):
+    kind = type(obj)
+    if kind is str:
+        _pack_str(obj, out)
+    elif kind is dict:
+        _pack_header(out, len(obj), 0x80, 16, 0xde, 0xdf)
+        for key, value in obj.items():
+            code = KEY_CODES.get(key)
+            if code is not None:
+                out.append(code)
+            elif type(key) is str:
+                _pack_str(key, out)
+            else:
+                raise TypeError(f'Dictionary key {key!r} is not a string')
+            _pack(value, out)
+    elif kind is int:
+        try:
+            _pack_int(obj, out)
+        except struct.error:
+            raise TypeError(f'Integer {obj} is out of range')
+    elif kind is float:
+        out.append(0xcb)
+        out += DOUBLE.pack(obj)
+    elif kind is list or kind is tuple:
+        _pack_header(out, len(obj), 0x90, 16, 0xdc, 0xdd)
+        for item in obj:
+            # Списки пользователей и контактов состоят из коротких строк: кодируем их на месте
+            if type(item) is str:
+                data = item.encode(ENCODING)
+                if len(data) < 32:
+                    out.append(0xa0 | len(data))
+                    out += data
+                    continue
+            _pack(item, out)
+    elif obj is None:
+        out.append(0xc0)
+    elif kind is bool:
+        out.append(0xc3 if obj else 0xc2)
+    else:
+        raise TypeError(f'Object of type {kind.__name__} can not be encoded')
+
+
+def unpack(data):
+    """
+    The function that decodes bytes in the binary format.
+    Throws ValueError if the data is damaged or contains something after the object.
+    :param data: bytes.
+    :return: the decoded object.
+    """
+
+    try:
+        obj, offset = _unpack(data, 0)
+    except (IndexError, struct.error, RecursionError) as err:
+        raise ValueError(f'Damaged binary message: {err!r}')
+    if offset != len(data):
+        raise ValueError('Extra data after the binary message')
+    return obj
+
+
+def _unpack_str(data, offset, length):
+    end = offset + length
+    if end > len(data):
+        raise ValueError('Truncated string in the binary message')
+    return data[offset:end].decode(ENCODING), end
+
+
+def _unpack_map(data, offset, length):
+    result = {}
+    for _ in range(length):
+        tag = data[offset]
+        # Однобайтовый код ключа
+        if tag < 0x80:
+            key = KEYS[tag] if tag < len(KEYS) else None
+            if key is None:
+                raise ValueError(f'Unknown key code {tag}')
+            offset += 1
+        else:
+            key, offset = _unpack(data, offset)
+            if type(key) is not str:
+                raise ValueError('Dictionary key is not a string')
+        result[key], offset = _unpack(data, offset)
+    return result, offset
+
+
+def _unpack_array(data, offset, length):
+    result = []
+    append = result.append
+    size = len(data)
+    for _ in range(length):
+        tag = data[offset]
+        # Короткая строка - самый частый элемент списка
+        if 0xa0 <= tag < 0xc0:
+            end = offset + 1 + (tag & 0x1f)
+            if end > size:
+                raise ValueError('Truncated string in the binary message')
+            append(data[offset + 1:end].decode(ENCODING))
+            offset = end
+        else:
+            item, offset = _unpack(data, offset)
+            append(item)
+    return result, offset
+
+
+def _unpack(data, offset):
+    tag = data[offset]
+    offset += 1
+    if tag < 0x80:
+        return tag, offset
+    if tag >= 0xe0:
+        return tag - 0x100, offset
+    if tag >= 0xa0 and tag < 0xc0:
+        return _unpack_str(data, offset, tag & 0x1f)
+    if tag < 0x90:
+        return _unpack_map(data, offset, tag & 0x0f)
+    if tag < 0xa0:
+        return _unpack_array(data, offset, tag & 0x0f)
+    if tag == 0xc0:
+        return None, offset
+    if tag == 0xc2:
+        return False, offset
+    if tag == 0xc3:
+        return True, offset
+    if tag == 0xcb:
+        return DOUBLE.unpack_from(data, offset)[0], offset + 8
+    if tag == 0xd9:
+        return _unpack_str(data, offset + 1, data[offset])
+    if tag == 0xda:
+        return _unpack_str(data, offset + 2, UINT16.unpack_from(data, offset)[0])
+    if tag == 0xdb:
+        return _unpack_str(data, offset + 4, UINT32.unpack_from(data, offset)[0])
+    if tag in INTEGERS:
+        structure = INTEGERS[tag]
+        return structure.unpack_from(data, offset)[0], offset + structure.size
+    if tag == 0xdc:
+        return _unpack_array(data, offset + 2, UINT16.unpack_from(data, offset)[0])
+    if tag == 0xdd:
+        return _unpack_array(data, offset + 4, UINT32.unpack_from(data, offset)[0])
+    if tag == 0xde:
+        return _unpack_map(data, offset + 2, UINT16.unpack_from(data, offset)[0])
+    if tag == 0xdf:
+        return _unpack_map(data, offset + 4, UINT32.unpack_from(data, offset)[0])
+    raise ValueError(f'Unsupported type tag 0x{tag:02x}')
@@ -8,3 +8,10 @@ class ServerError(Exception):
 
     def __str__(self):
         return self.text
+
+
+class SendBufferOverflow(ConnectionError):
+    """
+    Exception raised when the outbound queue of a connection exceeds its limit:
+    the client does not read the data sent to it, so the connection has to be closed.
+    """
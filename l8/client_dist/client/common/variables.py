@@ -6,7 +6,17 @@ DEFAULT_IP_ADDRESS = '127.0.0.1'
 DEFAULT_PORT = 7777
 MAX_CONNECTIONS = 5
 CONNECTION_TIMEOUT = 0.5
+# Время, за которое клиент должен ответить на запрос авторизации 511
+AUTH_TIMEOUT = 5
+# Окно, в течение которого запросы на рассылку 205 объединяются в одно уведомление
+UPDATE_LISTS_DELAY = 0.5
+# Клиенты разносят запросы списков после 205 случайно на время до UPDATE_LISTS_SPREAD секунд,
+# так чтобы сервер получал не больше UPDATE_LISTS_RATE запросов в секунду
+UPDATE_LISTS_SPREAD = 5.0
+UPDATE_LISTS_RATE = 500
 MAX_PACKAGE_LENGTH = 10240
+MAX_FRAME_LENGTH = 16 * 1024 * 1024
+SEND_BUFFER_LIMIT = 4 * 1024 * 1024
 ENCODING = 'utf-8'
 LOGGING_LVL = logging.DEBUG
 DEFAULT_LOG_NAME = 'server' if 'run_server.py' in sys.argv[0] else 'client'
@@ -15,6 +25,8 @@ SERVER_CONFIG = 'server.ini'
 # GUI CONFIG
 WIDTH = 800
 HEIGHT = 595
+# Число сообщений истории, подгружаемых за раз при прокрутке чата вверх
+HISTORY_PAGE = 20
 
 # JIM (JSON Instant Messaging) MAIN KEYS:
 ACTION = 'action'
@@ -25,6 +37,16 @@ SENDER = 'from'
 DESTINATION = 'to'
 DATA = 'bin'
 PUBLIC_KEY = 'pubkey'
+FRAMING = 'framing'
+CODEC = 'codec'
+COMPRESSION = 'compression'
+REQUEST_ID = 'id'
+# Версия списка пользователей и изменения списка с указанной версии
+VERSION = 'version'
+USERS_ADDED = 'added'
+USERS_REMOVED = 'removed'
+# Задержка (секунд), с которой клиент запрашивает списки после 205
+DELAY = 'delay'
 
 # JIM OTHER KEYS:
 PRESENCE = 'presence'
@@ -40,9 +62,23 @@ ADD_CONTACT = 'add'
 USERS_REQUEST = 'get_users'
 PUBLIC_KEY_REQUEST = 'pubkey_need'
 
+# FRAMING MODES:
+# Каждое сообщение предваряется 4 байтами длины (big-endian)
+FRAMING_LENGTH = 'length'
+
+# CODECS:
+# Компактный двоичный формат (common/codec.py), только вместе с кадрированием
+CODEC_BINARY = 'binary'
+
+# COMPRESSION MODES:
+# Потоковое сжатие больших кадров (common/compression.py), только вместе с кадрированием
+COMPRESSION_ZLIB = 'zlib'
+
 # SERVER RESPONSES:
 RESPONSE_200 = {RESPONSE: 200}
 RESPONSE_202 = {RESPONSE: 202, LIST_INFO: None}
 RESPONSE_205 = {RESPONSE: 205}
+# Открытый ключ пользователя ACCOUNT_NAME изменился
+RESPONSE_206 = {RESPONSE: 206, ACCOUNT_NAME: None}
 RESPONSE_400 = {RESPONSE: 400, ERROR: None}
 RESPONSE_511 = {RESPONSE: 511, DATA: None}
@@ -1,6 +1,6 @@
 import datetime
 import pathlib
-from sqlalchemy import create_engine, Column, Integer, String, Text, DateTime
+from sqlalchemy import bindparam, create_engine, inspect, text, tuple_, Column, Index, Integer, String, Text, DateTime
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.ext.declarative import declarative_base
 
@@ -18,7 +18,7 @@ class ClientDB:
 
         __tablename__ = 'known_users'
         id = Column(Integer, primary_key=True)
-        username = Column(String)
+        username = Column(String, unique=True, index=True)
 
         def __init__(self, username):
             self.username = username
@@ -27,6 +27,8 @@ class ClientDB:
         """Display for the transmitted message statistics table."""
 
         __tablename__ = 'messages_history'
+        # История читается страницами с конца: последние сообщения с контактом в порядке времени
+        __table_args__ = (Index('ix_messages_history_contact_date', 'contact', 'date'),)
         id = Column(Integer, primary_key=True)
         contact = Column(String)
         direction = Column(String)
@@ -48,6 +50,17 @@ class ClientDB:
         def __init__(self, contact):
             self.name = contact
 
+    class PublicKeys(Base):
+        """Display for the table of the public keys of other users."""
+        __tablename__ = 'public_keys'
+        id = Column(Integer, primary_key=True)
+        username = Column(String, unique=True)
+        key = Column(Text)
+
+        def __init__(self, username, key):
+            self.username = username
+            self.key = key
+
     def __init__(self, name):
         path_to_db = pathlib.Path(__file__).absolute().joinpath(f'../client_{name}.db3')
 
@@ -59,15 +72,33 @@ class ClientDB:
         )
 
         self.Base.metadata.create_all(self.engine)
+        self.create_indexes()
         Session = sessionmaker(bind=self.engine)
         self.session = Session()
 
         self.session.query(self.Contacts).delete()
         self.session.commit()
 
+    def create_indexes(self):
+        """
+        A method that adds the indexes missing in a database created by an older version.
+        The table of known users could contain repeated names: they are removed before its unique index is created.
+        """
+        with self.engine.begin() as connection:
+            for table in self.Base.metadata.sorted_tables:
+                indexes = {index['name'] for index in inspect(connection).get_indexes(table.name)}
+                for index in table.indexes:
+                    if index.name in indexes:
+                        continue
+                    if table is self.KnownUsers.__table__:
+                        connection.execute(text(
+                            'DELETE FROM known_users WHERE id NOT IN (SELECT MIN(id) FROM known_users GROUP BY username)'
+                        ))
+                    index.create(connection)
+
     def add_contact(self, contact):
         """A method that adds a contact to the database."""
-        if not self.session.query(self.Contacts).filter_by(name=contact).count():
+        if not self.check_contact(contact):
             contact_row = self.Contacts(contact)
             self.session.add(contact_row)
             self.session.commit()
@@ -83,18 +114,36 @@ class ClientDB:
         self.session.commit()
 
     def add_users(self, users_list):
-        """A method that populates the table of known users."""
-        self.session.query(self.KnownUsers).delete()
-        for user in users_list:
-            user_row = self.KnownUsers(user)
-            self.session.add(user_row)
+        """
+        A method that populates the table of known users.
+        The list is compared with the saved one, only the added and removed names are written.
+        """
+        known = set(self.get_users())
+        users = set(users_list)
+        self.update_users(users - known, known - users)
+
+    def update_users(self, added, removed):
+        """A method that applies the changes of the table of known users."""
+        table = self.KnownUsers.__table__
+        # Изменения записываются пакетами (executemany), без создания объектов ORM
+        if removed:
+            self.session.execute(table.delete().where(table.c.username == bindparam('name')),
+                                 [{'name': user} for user in removed])
+        if added:
+            # Уникальный индекс отбрасывает уже известные имена
+            self.session.execute(table.insert().prefix_with('OR IGNORE'),
+                                 [{'username': user} for user in added])
         self.session.commit()
 
     def save_message(self, contact, direction, message):
-        """A method that saves the message to the database."""
+        """
+        A method that saves the message to the database.
+        Returns the saved message as a tuple of get_history (contact, direction, message, date, id).
+        """
         message_row = self.MessageHistory(contact, direction, message)
         self.session.add(message_row)
         self.session.commit()
+        return contact, direction, message, message_row.date, message_row.id
 
     def get_contacts(self):
         """A method that returns a list of all contacts."""
@@ -106,23 +155,49 @@ class ClientDB:
 
     def check_user(self, user):
         """A method that checks if the user exists."""
-        if self.session.query(self.KnownUsers).filter_by(username=user).count():
-            return True
-        return False
+        return self.session.query(self.KnownUsers.id).filter_by(username=user).first() is not None
 
     def check_contact(self, contact):
         """A method that checks if a contact exists."""
-        if self.session.query(self.Contacts).filter_by(name=contact).count():
-            return True
-        return False
+        return self.session.query(self.Contacts.id).filter_by(name=contact).first() is not None
 
-    def get_history(self, contact):
-        """A method that returns the history of messages with a specific user."""
-        query = self.session.query(self.MessageHistory).filter_by(contact=contact)
+    def get_public_keys(self):
+        """A method that returns the saved public keys: username -> key."""
+        return dict(self.session.query(self.PublicKeys.username, self.PublicKeys.key).all())
 
-        return [(history_row.contact, history_row.direction, history_row.message, history_row.date)
-                for history_row in query.all()]
+    def save_public_keys(self, keys):
+        """A method that saves the public keys of users (username -> key), replacing the old ones."""
+        self.session.query(self.PublicKeys).filter(self.PublicKeys.username.in_(list(keys))).delete(
+            synchronize_session=False
+        )
+        self.session.add_all([self.PublicKeys(username, key) for username, key in keys.items()])
+        self.session.commit()
+
+    def del_public_keys(self, usernames):
+        """A method that removes the saved public keys of users."""
+        self.session.query(self.PublicKeys).filter(self.PublicKeys.username.in_(list(usernames))).delete(
+            synchronize_session=False
+        )
+        self.session.commit()
 
+    def get_history(self, contact, limit=None, before=None):
+        """
+        A method that returns the history of messages with a specific user in the order of time
+        as tuples (contact, direction, message, date, id).
+        With limit only the last limit messages are returned, before is the pair (date, id)
+        of the oldest message already shown: then the messages preceding it are returned.
+        """
+        history = self.MessageHistory
+        query = self.session.query(history.contact, history.direction, history.message, history.date, history.id)\
+            .filter(history.contact == contact)
+        if before is not None:
+            query = query.filter(tuple_(history.date, history.id) < tuple_(*before))
+        if limit is None:
+            return [tuple(row) for row in query.order_by(history.date, history.id)]
+
+        # Страница берётся по индексу с конца и разворачивается в порядок времени
+        rows = query.order_by(history.date.desc(), history.id.desc()).limit(limit).all()
+        return [tuple(row) for row in reversed(rows)]
 
 if __name__ == '__main__':
     test_db = ClientDB('test1')
@@ -143,7 +218,7 @@ if __name__ == '__main__':
     print(test_db.check_user('test1'))
     print(test_db.check_user('test10'))
     print(test_db.get_history('test2'))
-    print(sorted(test_db.get_history('t2'), key=lambda item: item[3]))
+    print(test_db.get_history('test2', limit=1))
     print(test_db.get_history('test3'))
     test_db.del_contact('test4')
     print(test_db.get_contacts())
@@ -19,7 +19,8 @@ from common.variables import DEFAULT_IP_ADDRESS, DEFAULT_PORT
 @Log
 def args_parser():
     """
-    Command line argument parser, returns a tuple of 4 elements: server address, port, username, password.
+    Command line argument parser, returns a tuple of 5 elements: server address, port, username, password
+    and the flag of the binary message format.
     Performs validation of the port number.
     """
 
@@ -28,18 +29,20 @@ def args_parser():
     parser.add_argument('port', default=DEFAULT_PORT, type=int, nargs='?')
     parser.add_argument('-n', '--name', default=None, nargs='?')
     parser.add_argument('-p', '--password', default='', nargs='?')
+    parser.add_argument('-b', '--binary', action='store_true')
     namespace = parser.parse_args(sys.argv[1:])
     server_addr = namespace.addr
     server_port = namespace.port
     client_name = namespace.name
     client_pswd = namespace.password
+    binary = namespace.binary
 
     # Проверяем порт
     if not 1023 < server_port < 65536:
         LOGGER.error(f'Порт {server_port} недопустим. Возможны варианты от 1024 до 65535.')
         exit(1)
 
-    return server_addr, server_port, client_name, client_pswd
+    return server_addr, server_port, client_name, client_pswd, binary
 
 
 def main():
@@ -48,7 +51,7 @@ def main():
     global transport
 
     # Загружаем параметы коммандной строки
-    server_addr, server_port, client_name, client_pswd = args_parser()
+    server_addr, server_port, client_name, client_pswd, binary = args_parser()
     # Создаём клиентское приложение
     client_app = QApplication(sys.argv)
 
@@ -92,21 +95,23 @@ def main():
             database,
             client_name,
             client_pswd,
-            keys
+            keys,
+            binary
         )
     except ServerError as err:
         message = QMessageBox()
         message.critical(start_dialog, 'Server error', err.text)
         exit(1)
 
-    transport.daemon = True
-    transport.start()
-
     del start_dialog
 
     # Создаём GUI
     main_window = ClientMainWindow(database, transport, keys)
     main_window.make_connection(transport)
+
+    # Поток чтения запускается после подключения сигналов, чтобы не потерять первые сообщения
+    transport.daemon = True
+    transport.start()
     main_window.setWindowTitle(f'Telegram на минималках :: {client_name}')
     client_app.exec_()
 
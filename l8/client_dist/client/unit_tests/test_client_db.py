@@ -0,0 +1,135 @@
+import unittest
+import sys
+import os
+import datetime
+
+sys.path.insert(0, os.path.join(os.getcwd(), '..'))
+from db.client_db_config import ClientDB
+
+# Кеш ключей разбирает ключи средствами pycryptodome
+try:
+    from Cryptodome.PublicKey import RSA
+    from client.key_cache import PublicKeyCache
+except ImportError:
+    RSA = None
+
+
+class TestHistoryPages(unittest.TestCase):
+    """
+    Тестирует постраничное чтение истории сообщений.
+    """
+
+    def setUp(self):
+        self.name = f'unit_test_{os.getpid()}'
+        self.database = ClientDB(self.name)
+        # Сообщения 2-5 отправлены в одну и ту же секунду: порядок между ними задаёт id
+        dates = [datetime.datetime(2020, 1, 1, 10, 0, second) for second in (0, 1, 1, 1, 1, 2, 3)]
+        for number, date in enumerate(dates, 1):
+            row = ClientDB.MessageHistory('bob', 'in' if number % 2 else 'out', f'message {number}')
+            row.date = date
+            self.database.session.add(row)
+        self.database.session.add(ClientDB.MessageHistory('carol', 'in', 'other chat'))
+        self.database.session.commit()
+
+    def tearDown(self):
+        self.database.session.close()
+        self.database.engine.dispose()
+        os.remove(os.path.normpath(self.database.engine.url.database))
+
+    def texts(self, rows):
+        return [row[2] for row in rows]
+
+    def test_pages(self):
+        pages = []
+        page = self.database.get_history('bob', limit=3)
+        while page:
+            pages.append(self.texts(page))
+            page = self.database.get_history('bob', limit=3, before=(page[0][3], page[0][4]))
+        self.assertEqual(pages, [['message 5', 'message 6', 'message 7'],
+                                 ['message 2', 'message 3', 'message 4'],
+                                 ['message 1']])
+
+    def test_cursor_inside_same_date(self):
+        page = self.database.get_history('bob', limit=2, before=(datetime.datetime(2020, 1, 1, 10, 0, 1), 4))
+        self.assertEqual(self.texts(page), ['message 2', 'message 3'])
+
+    def test_whole_history(self):
+        history = self.database.get_history('bob')
+        self.assertEqual(self.texts(history), [f'message {number}' for number in range(1, 8)])
+        self.assertEqual(history[0][:2], ('bob', 'in'))
+
+
+class ClientDatabaseTestCase(unittest.TestCase):
+    """
+    Новая база клиента, удаляемая после теста.
+    """
+
+    def setUp(self):
+        self.database = ClientDB(f'unit_test_{os.getpid()}')
+
+    def tearDown(self):
+        self.database.session.close()
+        self.database.engine.dispose()
+        os.remove(os.path.normpath(self.database.engine.url.database))
+
+
+class TestPublicKeys(ClientDatabaseTestCase):
+    """
+    Тестирует хранение открытых ключей собеседников.
+    """
+
+    def test_save_replaces(self):
+        self.database.save_public_keys({'bob': 'key 1', 'carol': 'key 2'})
+        self.database.save_public_keys({'bob': 'key 3'})
+        self.assertEqual(self.database.get_public_keys(), {'bob': 'key 3', 'carol': 'key 2'})
+
+    def test_delete(self):
+        self.database.save_public_keys({'bob': 'key 1', 'carol': 'key 2'})
+        self.database.del_public_keys(['bob', 'nobody'])
+        self.assertEqual(self.database.get_public_keys(), {'carol': 'key 2'})
+
+
+@unittest.skipIf(RSA is None, 'pycryptodome is not installed')
+class TestPublicKeyCache(ClientDatabaseTestCase):
+    """
+    Тестирует кеш открытых ключей: разбор, сохранение в базе и сброс по уведомлению 206.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        cls.bob_key = RSA.generate(1024).publickey().export_key().decode('ascii')
+        cls.carol_key = RSA.generate(1024).publickey().export_key().decode('ascii')
+
+    def test_update_and_reload(self):
+        cache = PublicKeyCache(self.database)
+        cache.update({'bob': self.bob_key, 'carol': 'not a key'})
+        self.assertEqual(cache.get('bob')[0], self.bob_key)
+        self.assertIsNone(cache.get('carol'))
+        self.assertEqual(cache.missing(['bob', 'carol']), ['carol'])
+        # Ключи читаются из базы при следующем запуске
+        self.assertEqual(PublicKeyCache(self.database).get('bob')[0], self.bob_key)
+
+    def test_unchanged_key_not_parsed(self):
+        cache = PublicKeyCache(self.database)
+        cache.update({'bob': self.bob_key})
+        encryptor = cache.get('bob')[1]
+        cache.update({'bob': self.bob_key})
+        self.assertIs(cache.get('bob')[1], encryptor)
+
+    def test_invalidate(self):
+        cache = PublicKeyCache(self.database)
+        cache.update({'bob': self.bob_key, 'carol': self.carol_key})
+        cache.invalidate('bob')
+        self.assertIsNone(cache.get('bob'))
+        self.assertEqual(self.database.get_public_keys(), {'carol': self.carol_key})
+
+    def test_retain(self):
+        cache = PublicKeyCache(self.database)
+        cache.update({'bob': self.bob_key, 'carol': self.carol_key})
+        cache.retain(['carol'])
+        self.assertEqual(cache.missing(['bob', 'carol']), ['bob'])
+        self.assertEqual(self.database.get_public_keys(), {'carol': self.carol_key})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -4,8 +4,11 @@ import os
 import json
 
 sys.path.insert(0, os.path.join(os.getcwd(), '..'))
-from common.variables import ACCOUNT_NAME, ACTION, ENCODING, ERROR, PRESENCE, RESPONSE, TIME, USER
-from common.utils import get_message, send_message
+from common.variables import ACCOUNT_NAME, ACTION, ENCODING, ERROR, LIST_INFO, PRESENCE, RESPONSE, TIME, USER
+from common.compression import Compression
+from common.errors import SendBufferOverflow
+from common.utils import (COMPRESSED_FRAME, FRAME_HEADER, ReceiveBuffer, SendBuffer, encode_message, get_message,
+                          send_message)
 
 
 class TestSocket:
@@ -30,6 +33,14 @@ class TestSocket:
         self.encoded_msg = json_test_msg.encode(ENCODING)
         self.received_msg = msg
 
+    def sendall(self, msg):
+        """
+        Отправляет сообщение целиком.
+        :param msg:
+        :return:
+        """
+        self.send(msg)
+
     def recv(self, max_len):
         """
         Получает данные из сокета.
@@ -74,5 +85,126 @@ class TestUtils(unittest.TestCase):
         self.assertEqual(get_message(test_sock), self.test_dict_recv_err)
 
 
+class TestReceiveBuffer(unittest.TestCase):
+    test_dict = {
+            ACTION: PRESENCE,
+            TIME: 111.111,
+            USER: {
+                    ACCOUNT_NAME: 'test_guest'
+            }
+    }
+
+    def test_two_frames_in_one_read(self):
+        buffer = ReceiveBuffer(framed=True)
+        buffer.feed(encode_message(self.test_dict, True) + encode_message({RESPONSE: 200}, True))
+        self.assertEqual(list(buffer.messages), [self.test_dict, {RESPONSE: 200}])
+
+    def test_frame_split_between_reads(self):
+        buffer = ReceiveBuffer(framed=True)
+        data = encode_message(self.test_dict, True)
+        buffer.feed(data[:3])
+        buffer.feed(data[3:10])
+        self.assertFalse(buffer.messages)
+        buffer.feed(data[10:])
+        self.assertEqual(buffer.messages.popleft(), self.test_dict)
+        self.assertFalse(buffer.data)
+
+    def test_large_frame(self):
+        buffer = ReceiveBuffer(framed=True)
+        message = {RESPONSE: 202, ERROR: ['user'] * 10000}
+        data = encode_message(message, True)
+        for i in range(0, len(data), 1024):
+            buffer.feed(data[i:i + 1024])
+        self.assertEqual(buffer.messages.popleft(), message)
+
+    def test_frame_too_large(self):
+        buffer = ReceiveBuffer(framed=True)
+        self.assertRaises(ValueError, buffer.feed, FRAME_HEADER.pack(2 ** 30))
+
+    def test_unframed_read(self):
+        buffer = ReceiveBuffer()
+        buffer.feed(encode_message(self.test_dict))
+        self.assertEqual(buffer.messages.popleft(), self.test_dict)
+
+    def test_connection_closed(self):
+        buffer = ReceiveBuffer(framed=True)
+        self.assertRaises(ConnectionResetError, buffer.feed, b'')
+
+    def test_compressed_frames(self):
+        sender = Compression()
+        buffer = ReceiveBuffer(framed=True)
+        buffer.compression = Compression()
+        users = {RESPONSE: 202, LIST_INFO: [f'user_{i}' for i in range(1000)]}
+        first = encode_message(users, True, compression=sender)
+        small = encode_message(self.test_dict, True, compression=sender)
+        second = encode_message(users, True, compression=sender)
+        self.assertTrue(FRAME_HEADER.unpack_from(first)[0] & COMPRESSED_FRAME)
+        self.assertFalse(FRAME_HEADER.unpack_from(small)[0] & COMPRESSED_FRAME)
+        # Повторный список сжимается по предыдущему кадру потока
+        self.assertLess(len(second), len(first) // 10)
+        buffer.feed(first + small + second)
+        self.assertEqual(list(buffer.messages), [users, self.test_dict, users])
+
+    def test_compressed_frame_without_compression(self):
+        message = {RESPONSE: 202, LIST_INFO: ['user'] * 1000}
+        buffer = ReceiveBuffer(framed=True)
+        self.assertRaises(ValueError, buffer.feed, encode_message(message, True, compression=Compression()))
+
+
+class SlowSocket:
+    """
+    Неблокирующий сокет, который принимает не больше capacity байт, пока их не прочитают.
+    """
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.data = b''
+
+    def send(self, data):
+        if not self.capacity:
+            raise BlockingIOError
+        sent = bytes(data[:self.capacity])
+        self.capacity -= len(sent)
+        self.data += sent
+        return len(sent)
+
+    def read(self, size):
+        self.capacity += size
+
+
+class TestSendBuffer(unittest.TestCase):
+    """
+    Тестирует очередь отправки соединения.
+    """
+
+    def test_partial_send(self):
+        buffer = SendBuffer()
+        sock = SlowSocket(5)
+        buffer.put(b'first')
+        buffer.put(b'second')
+        self.assertFalse(buffer.flush(sock))
+        self.assertEqual(buffer.size, 6)
+        sock.read(3)
+        self.assertFalse(buffer.flush(sock))
+        # Недоотправленная часть остаётся в начале очереди
+        self.assertEqual(bytes(buffer.chunks[0]), b'ond')
+        sock.read(10)
+        self.assertTrue(buffer.flush(sock))
+        self.assertEqual((sock.data, buffer.size), (b'firstsecond', 0))
+
+    def test_overflow(self):
+        buffer = SendBuffer(limit=10)
+        buffer.put(b'x' * 6)
+        self.assertRaises(SendBufferOverflow, buffer.put, b'x' * 5)
+        # Отправленные данные освобождают место в очереди
+        buffer.flush(SlowSocket(4))
+        buffer.put(b'x' * 5)
+        self.assertEqual(buffer.size, 7)
+
+    def test_overflow_is_connection_error(self):
+        # Движки закрывают соединение по OSError при отправке
+        self.assertTrue(issubclass(SendBufferOverflow, OSError))
+
+
 if __name__ == '__main__':
     unittest.main()
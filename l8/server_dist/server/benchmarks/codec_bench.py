@@ -0,0 +1,80 @@
+"""
+Benchmark of the message formats.
+
+Compares JSON with the compact binary format (common/codec.py) on typical
+JIM messages: the size of the encoded message and the time of encoding
+and decoding of one message.
+
+Usage (from the server directory):
+    python benchmarks/codec_bench.py --users 1000 --repeat 2000
+"""
+import argparse
+import base64
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from common.utils import decode_message, encode_message
+from common.variables import (ACCOUNT_NAME, ACTION, DATA, DESTINATION, FRAMING, FRAMING_LENGTH, GET_CONTACTS,
+                              LIST_INFO, MESSAGE, MESSAGE_TEXT, PRESENCE, PUBLIC_KEY, RESPONSE, SENDER, TIME, USER,
+                              CODEC, CODEC_BINARY)
+
+
+def sample_messages(users):
+    """Returns the named set of typical messages."""
+
+    # Текст сообщения клиенты шифруют RSA 2048 и передают в base64
+    encrypted_text = base64.b64encode(os.urandom(256)).decode('ascii')
+    public_key = '-----BEGIN PUBLIC KEY-----\n' + base64.b64encode(os.urandom(294)).decode('ascii') + \
+                 '\n-----END PUBLIC KEY-----'
+    return {
+        'response 200': {RESPONSE: 200},
+        'presence': {
+            ACTION: PRESENCE,
+            TIME: 1650000000.123,
+            USER: {ACCOUNT_NAME: 'user_name', PUBLIC_KEY: public_key},
+            FRAMING: FRAMING_LENGTH,
+            CODEC: CODEC_BINARY
+        },
+        'message': {
+            ACTION: MESSAGE,
+            SENDER: 'user_name',
+            DESTINATION: 'contact_name',
+            TIME: 1650000000.123,
+            MESSAGE_TEXT: encrypted_text
+        },
+        'get contacts': {ACTION: GET_CONTACTS, TIME: 1650000000.123, USER: 'user_name'},
+        'contacts (50)': {RESPONSE: 202, LIST_INFO: [f'contact_{i}' for i in range(50)]},
+        f'users ({users})': {RESPONSE: 202, LIST_INFO: [f'user_{i}' for i in range(users)]},
+        'public key': {RESPONSE: 511, DATA: public_key},
+    }
+
+
+def measure(message, binary, repeat):
+    """Returns the size in bytes and the encode/decode time of one message in microseconds."""
+
+    encoded = encode_message(message, binary=binary)
+    encode_time = timeit.timeit(lambda: encode_message(message, binary=binary), number=repeat) / repeat
+    decode_time = timeit.timeit(lambda: decode_message(encoded, binary), number=repeat) / repeat
+    return len(encoded), encode_time * 1e6, decode_time * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--repeat', type=int, default=2000)
+    namespace = parser.parse_args()
+
+    print(f'{"message":<14} {"format":<7} {"bytes":>7} {"encode us":>10} {"decode us":>10}')
+    for name, message in sample_messages(namespace.users).items():
+        # Большие списки меряем меньшее число раз
+        repeat = max(10, namespace.repeat * 20 // len(encode_message(message)))
+        repeat = min(repeat, namespace.repeat)
+        for codec, binary in (('json', False), ('binary', True)):
+            size, encode_time, decode_time = measure(message, binary, repeat)
+            print(f'{name:<14} {codec:<7} {size:>7} {encode_time:>10.2f} {decode_time:>10.2f}')
+
+
+if __name__ == '__main__':
+    main()
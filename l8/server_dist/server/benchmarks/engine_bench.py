@@ -0,0 +1,263 @@
+"""
+Benchmark of the server engines.
+
+For every engine and every number of connections the script starts the server
+in a separate process, logs in N idle clients plus two active ones and measures:
+    * CPU time consumed by the idle server process;
+    * latency of message delivery between two clients (p50 / p99).
+
+Usage (from the server directory):
+    python benchmarks/engine_bench.py --engines select selectors --connections 1000 10000
+"""
+import argparse
+import binascii
+import concurrent.futures
+import hmac
+import multiprocessing
+import os
+import resource
+import socket
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from server.engines import ENGINES
+from common.compression import Compression
+from common.utils import ReceiveBuffer, get_message, send_message
+from common.variables import (ACCOUNT_NAME, ACTION, CODEC, CODEC_BINARY, COMPRESSION, COMPRESSION_ZLIB, DATA,
+                              DESTINATION, FRAMING, FRAMING_LENGTH, MESSAGE, MESSAGE_TEXT, PRESENCE, PUBLIC_KEY,
+                              RESPONSE, RESPONSE_511, SENDER, TIME, USER)
+
+PSWD_HASH = b'bench'
+
+
+class MemoryDB:
+    """
+    In-memory stand-in for ServerDB: the benchmark measures the network engine,
+    so every user is registered and every query is answered from dictionaries.
+    """
+
+    def __init__(self):
+        self.keys = {}
+
+    def check_user(self, name):
+        return True
+
+    def get_hash(self, name):
+        return PSWD_HASH
+
+    def get_public_key(self, name):
+        return self.keys.get(name)
+
+    def get_public_keys(self, names):
+        return {name: self.keys[name] for name in names if name in self.keys}
+
+    def user_login(self, username, ip, port, key):
+        self.keys[username] = key
+
+    def user_changed(self, name, public_key=None):
+        if public_key is not None:
+            self.keys[name] = public_key
+
+    def warm_cache(self):
+        pass
+
+    def user_logout(self, username):
+        pass
+
+    def process_message(self, sender, recipient):
+        pass
+
+    def store_offline_message(self, recipient, message):
+        pass
+
+    def get_offline_messages(self, recipient):
+        return []
+
+    def remove_offline_messages(self, recipient, last_id):
+        pass
+
+    def add_contact(self, user, contact):
+        pass
+
+    def remove_contact(self, user, contact):
+        pass
+
+    def get_contacts(self, username):
+        return []
+
+    def users_list(self):
+        return [(name, None) for name in self.keys]
+
+    def users_version(self):
+        return 0
+
+    def users_snapshot(self):
+        return 0, list(self.keys)
+
+    def users_changes(self, version):
+        return 0, [], []
+
+    def close(self):
+        pass
+
+
+def raise_nofile_limit():
+    """Raises the limit of open descriptors up to the hard limit."""
+
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    return resource.getrlimit(resource.RLIMIT_NOFILE)[0]
+
+
+def server_process(engine, port, pipe):
+    """Runs the engine and answers CPU time requests from the benchmark."""
+
+    raise_nofile_limit()
+    server = ENGINES[engine]('127.0.0.1', port, MemoryDB())
+    server.daemon = True
+    server.start()
+    pipe.send('ready')
+
+    while True:
+        command = pipe.recv()
+        if command == 'cpu':
+            pipe.send(time.process_time())
+        elif command == 'alive':
+            pipe.send(server.is_alive())
+        elif command == 'stop':
+            server.running = False
+            server.join()
+            pipe.send('stopped')
+            return
+
+
+class Client:
+    """Benchmark client: a socket with its receive buffer."""
+
+    def __init__(self, port, name, binary=False, compressed=False):
+        self.sock = socket.create_connection(('127.0.0.1', port), timeout=30)
+        self.buffer = ReceiveBuffer()
+        self.login(name, binary, compressed)
+
+    def send(self, message):
+        send_message(self.sock, message, self.buffer.framed, self.buffer.binary, self.buffer.compression)
+
+    def get(self):
+        return get_message(self.sock, self.buffer)
+
+    def login(self, name, binary=False, compressed=False):
+        """Passes the authorization procedure, optionally offering the binary format and the compression."""
+
+        presence = {
+            ACTION: PRESENCE,
+            TIME: time.time(),
+            USER: {ACCOUNT_NAME: name, PUBLIC_KEY: name},
+            FRAMING: FRAMING_LENGTH
+        }
+        if binary:
+            presence[CODEC] = CODEC_BINARY
+        if compressed:
+            presence[COMPRESSION] = COMPRESSION_ZLIB
+        self.send(presence)
+        answer = self.get()
+        if answer.get(RESPONSE) != 511:
+            raise RuntimeError(f'Unexpected answer: {answer}')
+        self.buffer.framed = answer.get(FRAMING) == FRAMING_LENGTH
+        self.buffer.binary = self.buffer.framed and answer.get(CODEC) == CODEC_BINARY
+        if self.buffer.framed and answer.get(COMPRESSION) == COMPRESSION_ZLIB:
+            self.buffer.compression = Compression()
+        digest = hmac.new(PSWD_HASH, answer[DATA].encode('ascii'), 'MD5').digest()
+        reply = dict(RESPONSE_511)
+        reply[DATA] = binascii.b2a_base64(digest).decode('ascii')
+        self.send(reply)
+        answer = self.get()
+        if answer.get(RESPONSE) != 200:
+            raise RuntimeError(f'Unexpected answer: {answer}')
+
+    def close(self):
+        self.sock.close()
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+
+def run_case(engine, connections, port, samples, idle_time):
+    """Measures one engine with the given number of idle connections."""
+
+    parent, child = multiprocessing.Pipe()
+    proc = multiprocessing.Process(target=server_process, args=(engine, port, child), daemon=True)
+    proc.start()
+    parent.recv()
+    time.sleep(0.5)
+
+    idle = []
+    result = {'engine': engine, 'connections': connections}
+    try:
+        # Число одновременных подключений не превышает очередь listen() сервера
+        with concurrent.futures.ThreadPoolExecutor(max_workers=4) as pool:
+            idle.extend(pool.map(lambda i: Client(port, f'idle_{i}'), range(connections)))
+        sender = Client(port, 'ping')
+        recipient = Client(port, 'pong')
+
+        # Потребление процессора сервером без нагрузки
+        parent.send('cpu')
+        cpu_start = parent.recv()
+        time.sleep(idle_time)
+        parent.send('cpu')
+        result['idle_cpu'] = (parent.recv() - cpu_start) / idle_time * 100
+
+        # Задержка доставки сообщения между двумя клиентами
+        latencies = []
+        for i in range(samples):
+            message = {ACTION: MESSAGE, SENDER: 'ping', DESTINATION: 'pong', TIME: time.time(), MESSAGE_TEXT: str(i)}
+            start = time.perf_counter()
+            sender.send(message)
+            recipient.get()
+            latencies.append((time.perf_counter() - start) * 1000)
+            sender.get()
+        result['p50'] = percentile(latencies, 50)
+        result['p99'] = percentile(latencies, 99)
+    except (OSError, RuntimeError, ValueError) as err:
+        result['error'] = f'{type(err).__name__}: {err}'
+        parent.send('alive')
+        if not parent.recv():
+            result['error'] += ' (server thread died)'
+    finally:
+        for client in idle:
+            client.close()
+        proc.terminate()
+        proc.join()
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--engines', nargs='+', default=['select', 'selectors'])
+    parser.add_argument('--connections', nargs='+', type=int, default=[1000, 10000])
+    parser.add_argument('--samples', type=int, default=500)
+    parser.add_argument('--idle-time', type=float, default=5.0)
+    parser.add_argument('--port', type=int, default=17777)
+    namespace = parser.parse_args()
+
+    limit = raise_nofile_limit()
+    print(f'RLIMIT_NOFILE: {limit}')
+    print(f'{"engine":<10} {"conns":>7} {"idle CPU %":>11} {"p50 ms":>8} {"p99 ms":>8}')
+
+    port = namespace.port
+    for engine in namespace.engines:
+        for connections in namespace.connections:
+            result = run_case(engine, connections, port, namespace.samples, namespace.idle_time)
+            port += 1
+            if 'error' in result:
+                print(f'{engine:<10} {connections:>7} failed: {result["error"]}')
+            else:
+                print(f'{engine:<10} {connections:>7} {result["idle_cpu"]:>11.2f} '
+                      f'{result["p50"]:>8.3f} {result["p99"]:>8.3f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,118 @@
+"""
+Benchmark of the multi-process server mode.
+
+Measures the message throughput of the selectors engine in one process
+and of the worker pool with different numbers of processes. The load is
+generated by client processes, each with one sender/recipient pair;
+the pairs are spread over the workers by the kernel, so most messages
+cross the router.
+
+Usage (from the server directory):
+    python benchmarks/workers_bench.py --workers 0 2 4 --pairs 8 --messages 2000
+"""
+import argparse
+import multiprocessing
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from server.engines import ENGINES
+from server.workers import WorkerPool
+from common.variables import ACTION, DESTINATION, MESSAGE, MESSAGE_TEXT, RESPONSE, SENDER, TIME
+from engine_bench import Client, MemoryDB, raise_nofile_limit
+
+# Сообщений в полёте у одного отправителя
+WINDOW = 32
+
+
+def server_process(workers, port, pipe):
+    """Runs the server in one process or the worker pool."""
+
+    raise_nofile_limit()
+    if workers:
+        server = WorkerPool('127.0.0.1', port, MemoryDB, workers)
+    else:
+        server = ENGINES['selectors']('127.0.0.1', port, MemoryDB())
+    server.daemon = True
+    server.start()
+    pipe.send('ready')
+    pipe.recv()
+    server.running = False
+    server.join()
+
+
+def pair_process(port, index, messages, start_event, result):
+    """Sends the messages from one client to another with a window of unconfirmed messages."""
+
+    sender = Client(port, f'send_{index}')
+    recipient = Client(port, f'recv_{index}')
+    start_event.wait()
+
+    message = {ACTION: MESSAGE, SENDER: f'send_{index}', DESTINATION: f'recv_{index}', TIME: 0, MESSAGE_TEXT: 'x' * 64}
+    sent = received = confirmed = 0
+    while received < messages:
+        while sent < messages and sent - confirmed < WINDOW:
+            sender.send(message)
+            sent += 1
+        answer = sender.get()
+        if answer.get(RESPONSE) == 200:
+            confirmed += 1
+        while received < confirmed:
+            recipient.get()
+            received += 1
+    result.put(time.perf_counter())
+    sender.close()
+    recipient.close()
+
+
+def run_case(workers, pairs, messages, port):
+    """Returns the throughput of the server in messages per second."""
+
+    parent, child = multiprocessing.Pipe()
+    server = multiprocessing.Process(target=server_process, args=(workers, port, child))
+    server.start()
+    parent.recv()
+    time.sleep(0.5)
+
+    start_event = multiprocessing.Event()
+    result = multiprocessing.Queue()
+    clients = [
+        multiprocessing.Process(target=pair_process, args=(port, index, messages, start_event, result))
+        for index in range(pairs)
+    ]
+    for client in clients:
+        client.start()
+    # Ждём, пока все пары авторизуются
+    time.sleep(1 + pairs * 0.05)
+
+    start = time.perf_counter()
+    start_event.set()
+    finish = max(result.get(timeout=300) for _ in clients)
+    for client in clients:
+        client.join()
+
+    parent.send('stop')
+    server.join()
+    return pairs * messages / (finish - start)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--workers', nargs='+', type=int, default=[0, 2, 4])
+    parser.add_argument('--pairs', type=int, default=8)
+    parser.add_argument('--messages', type=int, default=2000)
+    parser.add_argument('--port', type=int, default=17877)
+    namespace = parser.parse_args()
+
+    print(f'CPUs: {os.cpu_count()}')
+    print(f'{"workers":>8} {"msg/s":>10}')
+    port = namespace.port
+    for workers in namespace.workers:
+        rate = run_case(workers, namespace.pairs, namespace.messages, port)
+        port += 1
+        print(f'{workers:>8} {rate:>10.0f}')
+
+
+if __name__ == '__main__':
+    main()
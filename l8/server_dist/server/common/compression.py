@@ -0,0 +1,95 @@
+"""
+Per-connection stream compression of large frames.
+
+Each direction of a connection has its own raw deflate stream, so repeated
+data (the user list sent again after every 205) is compressed against the
+previous frames. Both streams start with the shared dictionary of JIM keys
+and values written as JSON text, so it helps the JSON frames: JSON with zlib
+is the default combination of the client, the binary codec is compressed
+without the benefit of the dictionary. Every compressed frame ends with a sync
+flush: the receiver decompresses it completely without waiting for the next one.
+"""
+import time
+import zlib
+
+from .variables import (ACCOUNT_NAME, ACTION, ADD_CONTACT, DATA, DESTINATION, ERROR, EXIT, GET_CONTACTS, LIST_INFO,
+                        MAX_FRAME_LENGTH, MESSAGE, MESSAGE_TEXT, PRESENCE, PUBLIC_KEY, PUBLIC_KEY_REQUEST,
+                        REMOVE_CONTACT, RESPONSE, SENDER, TIME, USER, USERS_REQUEST)
+
+# Сжимаются только кадры не меньше порога (байт): короткие сообщения чата идут как есть
+COMPRESSION_THRESHOLD = 512
+COMPRESSION_LEVEL = 6
+
+# Общий словарь: ключи и значения JIM в том виде, в котором они встречаются в JSON.
+# zlib лучше находит совпадения с концом словаря, поэтому самые частые строки стоят последними
+ZDICT = ''.join([
+    '-----BEGIN PUBLIC KEY-----\n', '\n-----END PUBLIC KEY-----',
+    f'"{ERROR}": ', f'"{PUBLIC_KEY}": ', f'"{DATA}": ',
+    f'"{ACTION}": "{PRESENCE}"', f'"{ACTION}": "{EXIT}"', f'"{ACTION}": "{ADD_CONTACT}"',
+    f'"{ACTION}": "{REMOVE_CONTACT}"', f'"{ACTION}": "{PUBLIC_KEY_REQUEST}"',
+    f'"{ACTION}": "{GET_CONTACTS}"', f'"{ACTION}": "{USERS_REQUEST}"',
+    f'"{USER}": ', f'"{ACCOUNT_NAME}": ', f'"{TIME}": ',
+    f'{{"{ACTION}": "{MESSAGE}", "{SENDER}": "', f'", "{DESTINATION}": "', f'", "{MESSAGE_TEXT}": "',
+    f'{{"{RESPONSE}": 202, "{LIST_INFO}": ["', '", "',
+]).encode('utf-8')
+
+# Хвост, которым заканчивается каждый блок после Z_SYNC_FLUSH: не передаём его по сети
+SYNC_TAIL = b'\x00\x00\xff\xff'
+
+
+class CompressionStats:
+    """
+    The compression counters of the process: bytes before and after compression
+    in both directions and the time spent on compression and decompression.
+    """
+
+    __slots__ = ('frames_out', 'raw_out', 'compressed_out', 'compress_time',
+                 'frames_in', 'raw_in', 'compressed_in', 'decompress_time')
+
+    def __init__(self):
+        for name in self.__slots__:
+            setattr(self, name, 0)
+
+    def as_dict(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+
+STATS = CompressionStats()
+
+
+class Compression:
+    """The pair of deflate streams of one connection: compression of sent and decompression of received frames."""
+
+    __slots__ = ('threshold', 'compressor', 'decompressor')
+
+    def __init__(self, threshold=COMPRESSION_THRESHOLD, level=COMPRESSION_LEVEL):
+        self.threshold = threshold
+        self.compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS, zdict=ZDICT)
+        self.decompressor = zlib.decompressobj(-zlib.MAX_WBITS, zdict=ZDICT)
+
+    def compress(self, data):
+        """Compresses one frame, returns the bytes without the sync flush tail."""
+
+        start = time.perf_counter()
+        result = self.compressor.compress(data) + self.compressor.flush(zlib.Z_SYNC_FLUSH)
+        STATS.compress_time += time.perf_counter() - start
+        STATS.frames_out += 1
+        STATS.raw_out += len(data)
+        STATS.compressed_out += len(result) - len(SYNC_TAIL)
+        return result[:-len(SYNC_TAIL)]
+
+    def decompress(self, data):
+        """Decompresses one frame. Throws ValueError if the data is damaged or the frame is too large."""
+
+        start = time.perf_counter()
+        try:
+            result = self.decompressor.decompress(data + SYNC_TAIL, MAX_FRAME_LENGTH)
+        except zlib.error as err:
+            raise ValueError(f'Damaged compressed frame: {err}')
+        if self.decompressor.unconsumed_tail:
+            raise ValueError(f'Decompressed frame exceeds {MAX_FRAME_LENGTH} bytes')
+        STATS.decompress_time += time.perf_counter() - start
+        STATS.frames_in += 1
+        STATS.raw_in += len(result)
+        STATS.compressed_in += len(data)
+        return result
@@ -1,41 +1,191 @@
 import sys
 import os
+import errno
 import json
+import struct
+from collections import deque
 
 sys.path.insert(0, os.path.join(os.getcwd(), '..'))
+from .codec import pack, unpack
 from .decorators import Log
-from .variables import ENCODING, MAX_PACKAGE_LENGTH
+from .errors import SendBufferOverflow
+from .variables import ENCODING, MAX_FRAME_LENGTH, MAX_PACKAGE_LENGTH, SEND_BUFFER_LIMIT
+
+# Заголовок кадра: длина сообщения в байтах, 4 байта big-endian
+FRAME_HEADER = struct.Struct('!I')
+# Старший бит длины отмечает сжатый кадр
+COMPRESSED_FRAME = 0x80000000
 
 
 @Log
-def get_message(client):
+def get_message(client, buffer=None):
     """
     The function of receiving messages from remote computers.
     Receives JSON messages, decodes the received message,
     and checks that a dictionary has received.
+    If a receive buffer is passed, the message is taken from it,
+    and the socket is read only until the buffer contains a complete message.
     :param client: socket for data transfer.
+    :param buffer: ReceiveBuffer of the connection.
     :return: dictionary - message.
     """
 
-    encoded_response = client.recv(MAX_PACKAGE_LENGTH)
-    json_response = encoded_response.decode(ENCODING)
-    response = json.loads(json_response)
-    if isinstance(response, dict):
-        return response
-    else:
-        raise TypeError
+    if buffer is None:
+        encoded_response = client.recv(MAX_PACKAGE_LENGTH)
+        return decode_message(encoded_response)
+
+    while not buffer.messages:
+        buffer.feed(client.recv(MAX_PACKAGE_LENGTH))
+    return buffer.messages.popleft()
 
 
 @Log
-def send_message(sock, message):
+def send_message(sock, message, framed=False, binary=False, compression=None):
     """
     The function for sending dictionaries via a socket.
     Encodes a dictionary into JSON format and sends it over a socket.
     :param sock: socket to send
     :param message: dictionary to send
+    :param framed: prefix the message with its length
+    :param binary: use the compact binary format instead of JSON
+    :param compression: Compression of the connection, large frames are compressed
     :return: returns nothing.
     """
 
-    js_message = json.dumps(message)
-    encoded_message = js_message.encode(ENCODING)
-    sock.send(encoded_message)
+    sock.sendall(encode_message(message, framed, binary, compression))
+
+
+def encode_message(message, framed=False, binary=False, compression=None):
+    """
+    The function that converts a dictionary into bytes for transmission.
+    :param message: dictionary to encode
+    :param framed: prefix the message with its length
+    :param binary: use the compact binary format instead of JSON
+    :param compression: Compression of the connection, frames not smaller than its threshold are compressed
+    :return: bytes in JSON or binary format.
+    """
+
+    if not isinstance(message, dict):
+        raise TypeError
+    if binary:
+        encoded_message = pack(message)
+    else:
+        encoded_message = json.dumps(message).encode(ENCODING)
+    if framed:
+        if compression is not None and len(encoded_message) >= compression.threshold:
+            encoded_message = compression.compress(encoded_message)
+            return FRAME_HEADER.pack(len(encoded_message) | COMPRESSED_FRAME) + encoded_message
+        return FRAME_HEADER.pack(len(encoded_message)) + encoded_message
+    return encoded_message
+
+
+def decode_message(encoded_message, binary=False):
+    """
+    The function that converts received bytes into a dictionary.
+    Throws TypeError if the data is not a dictionary.
+    :param encoded_message: bytes in JSON format.
+    :param binary: the bytes are in the compact binary format
+    :return: dictionary - message.
+    """
+
+    if binary:
+        response = unpack(encoded_message)
+    else:
+        response = json.loads(encoded_message.decode(ENCODING))
+    if isinstance(response, dict):
+        return response
+    else:
+        raise TypeError
+
+
+class ReceiveBuffer:
+    """
+    The receive buffer of a connection.
+    Accumulates the received bytes and puts complete messages into the messages queue.
+    Without framing, every read is treated as one message (the original JIM behaviour).
+    With length framing, one read may contain any number of messages or a part of one,
+    and a message is not limited by the size of one read.
+    The binary flag switches the connection to the compact binary format in both directions,
+    the compression (a Compression object) enables compression of large frames.
+    """
+
+    def __init__(self, framed=False, binary=False):
+        self.framed = framed
+        self.binary = binary
+        self.compression = None
+        self.data = bytearray()
+        self.messages = deque()
+
+    def feed(self, data):
+        """
+        Adds the received bytes to the buffer and decodes all complete messages.
+        Throws ConnectionResetError if the connection was closed by the other side
+        and ValueError if the data can not be decoded.
+        """
+
+        if not data:
+            raise ConnectionResetError(errno.ECONNRESET, 'Connection closed by the remote side')
+
+        if not self.framed:
+            self.messages.append(decode_message(data, self.binary))
+            return
+
+        self.data += data
+        offset = 0
+        while len(self.data) - offset >= FRAME_HEADER.size:
+            length, = FRAME_HEADER.unpack_from(self.data, offset)
+            compressed = length & COMPRESSED_FRAME
+            length &= ~COMPRESSED_FRAME
+            if length > MAX_FRAME_LENGTH:
+                raise ValueError(f'Frame length {length} exceeds the limit')
+            end = offset + FRAME_HEADER.size + length
+            if len(self.data) < end:
+                break
+            payload = bytes(self.data[offset + FRAME_HEADER.size:end])
+            if compressed:
+                if self.compression is None:
+                    raise ValueError('Compressed frame on a connection without compression')
+                payload = self.compression.decompress(payload)
+            self.messages.append(decode_message(payload, self.binary))
+            offset = end
+        del self.data[:offset]
+
+
+class SendBuffer:
+    """
+    The outbound queue of a connection.
+    Keeps the encoded messages until the socket accepts them; a partially sent
+    chunk stays at the head of the queue. The total size is bounded by the limit.
+    """
+
+    def __init__(self, limit=SEND_BUFFER_LIMIT):
+        self.limit = limit
+        self.size = 0
+        self.chunks = deque()
+
+    def put(self, data):
+        """Adds the data to the queue. Throws SendBufferOverflow if the limit is exceeded."""
+
+        if self.size + len(data) > self.limit:
+            raise SendBufferOverflow(f'Send buffer limit of {self.limit} bytes exceeded')
+        self.chunks.append(memoryview(data))
+        self.size += len(data)
+
+    def flush(self, sock):
+        """
+        Sends the queued data while the socket accepts it.
+        Returns True if the queue is empty, False if the socket would block.
+        """
+
+        while self.chunks:
+            chunk = self.chunks[0]
+            try:
+                sent = sock.send(chunk)
+            except (BlockingIOError, InterruptedError):
+                return False
+            self.size -= sent
+            if sent < len(chunk):
+                self.chunks[0] = chunk[sent:]
+                return False
+            self.chunks.popleft()
+        return True
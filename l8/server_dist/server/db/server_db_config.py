@@ -1,8 +1,287 @@
 import datetime
+import json
+import logging
+import queue
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import Future
 from pprint import pprint
-from sqlalchemy import create_engine, Column, Integer, String, DateTime, ForeignKey, Text
+from sqlalchemy import (create_engine, bindparam, event, inspect, update, Boolean, Column, Integer, String, DateTime,
+                        ForeignKey, Index, Text, UniqueConstraint)
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.schema import CreateIndex, CreateTable
+from sqlalchemy.orm import scoped_session, sessionmaker
+
+LOGGER = logging.getLogger('server')
+
+# Запись в базу выполняется пачками: не реже одного раза за интервал (секунды)
+# и не больше указанного числа операций в одной транзакции
+WRITE_INTERVAL = 0.05
+WRITE_BATCH_SIZE = 500
+# Счётчики сообщений копятся в памяти и переносятся в users_history с этим интервалом (секунды)
+STATS_INTERVAL = 1.0
+# Сообщения для пользователей не в сети: не больше указанного числа на получателя,
+# хранятся заданное время (секунды), устаревшие удаляются с указанным интервалом
+OFFLINE_LIMIT = 1000
+OFFLINE_TTL = 30 * 24 * 60 * 60
+OFFLINE_PURGE_INTERVAL = 60 * 60
+# Число пользователей в кеше ServerDB; при большем числе вытесняются давно не использованные
+USER_CACHE_SIZE = 100000
+# Число последних изменений списка пользователей, по которым клиенту отдаются изменения;
+# отставшим сильнее отдаётся весь список
+DIRECTORY_LOG_LIMIT = 1000
+# Версия схемы базы (PRAGMA user_version): 1 - числовые внешние ключи с индексами и каскадным удалением
+SCHEMA_VERSION = 1
+# Настройки соединений SQLite. Журнал WAL: чтение не блокирует запись и наоборот,
+# при synchronous=NORMAL фиксация транзакции не ждёт записи на диск (sync только при checkpoint).
+# Размер страничного кеша соединения (КБ) и размер отображаемой в память части файла (байты)
+SQLITE_CACHE_SIZE = 16 * 1024
+SQLITE_MMAP_SIZE = 64 * 1024 * 1024
+
+
+class DBWriter(threading.Thread):
+    """
+    The database writer thread. Receives mutation records from the server,
+    applies them in batches with one commit per batch, so message routing
+    does not wait for SQLite commits.
+    Keeps the number of queued operations per user, so reads can wait for the writes of that user.
+    Periodically and at the stop moves the in-memory message counters into the database,
+    at the start and then hourly deletes the expired offline messages.
+    The session of the writer is the only one that changes the database: other threads
+    pass their changes with call and wait for the result.
+    """
+
+    # Маркеры очереди: досрочная запись пачки, остановка потока и вызов функции в потоке записи
+    FLUSH = object()
+    STOP = object()
+    CALL = object()
+
+    def __init__(self, database, session, interval=WRITE_INTERVAL, batch_size=WRITE_BATCH_SIZE,
+                 stats_interval=STATS_INTERVAL):
+        self.database = database
+        self.session = session
+        self.interval = interval
+        self.batch_size = batch_size
+        self.stats_interval = stats_interval
+        self.queue = queue.Queue()
+        # Имя пользователя -> число ещё не записанных операций
+        self.pending = dict()
+        self.condition = threading.Condition()
+        super().__init__(daemon=True)
+
+    def put(self, operation, users, *args):
+        """Queues the mutation: the name of the ServerDB apply_ method, the affected users and the arguments."""
+
+        with self.condition:
+            for user in users:
+                self.pending[user] = self.pending.get(user, 0) + 1
+        self.queue.put((operation, users, args))
+
+    def wait(self, user=None):
+        """Waits until the queued operations of the user (or all operations) are written."""
+
+        with self.condition:
+            if user is None:
+                done = lambda: not self.pending
+            else:
+                done = lambda: user not in self.pending
+            if done() or not self.is_alive():
+                return
+            # Не ждём окончания интервала: просим записать пачку сразу
+            self.queue.put(self.FLUSH)
+            self.condition.wait_for(lambda: done() or not self.is_alive())
+
+    def call(self, function, *args):
+        """
+        Calls function(session, *args) in the writer thread after the queued operations,
+        commits the transaction and returns the result of the function.
+        The exception of the function or of the commit is raised in the calling thread.
+        """
+
+        future = Future()
+        if self.is_alive():
+            self.queue.put((self.CALL, function, args, future))
+        else:
+            self.execute(function, args, future)
+        return future.result()
+
+    def stop(self):
+        """Writes the remaining operations and stops the thread."""
+
+        if self.is_alive():
+            self.queue.put(self.STOP)
+            self.join()
+
+    def run(self):
+        running = True
+        stats_time = time.monotonic() + self.stats_interval
+        purge_time = time.monotonic()
+        while running:
+            try:
+                record = self.queue.get(timeout=max(0, stats_time - time.monotonic()))
+            except queue.Empty:
+                record = self.FLUSH
+            batch = []
+            call = None
+            deadline = time.monotonic() + self.interval
+            # Собираем пачку до истечения интервала, заполнения или запроса немедленной записи
+            while True:
+                if record is self.STOP:
+                    running = False
+                    break
+                if record is self.FLUSH:
+                    break
+                if record[0] is self.CALL:
+                    call = record
+                    break
+                batch.append(record)
+                timeout = deadline - time.monotonic()
+                if len(batch) >= self.batch_size or timeout <= 0:
+                    break
+                try:
+                    record = self.queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+            if batch:
+                self.write(batch)
+            if call:
+                self.execute(*call[1:])
+            if not running or time.monotonic() >= stats_time:
+                self.database.flush_message_stats(self.session)
+                stats_time = time.monotonic() + self.stats_interval
+            if running and time.monotonic() >= purge_time:
+                self.database.purge_offline_messages(self.session)
+                purge_time = time.monotonic() + OFFLINE_PURGE_INTERVAL
+
+    def execute(self, function, args, future):
+        """Runs the function passed with call in its own transaction and sets the result of the future."""
+
+        try:
+            result = function(self.session, *args)
+            self.session.commit()
+        except Exception as err:
+            self.session.rollback()
+            future.set_exception(err)
+        else:
+            future.set_result(result)
+
+    def commit(self, batch):
+        """Applies the operations and commits the transaction. Returns False if the commit failed."""
+
+        for operation, users, args in batch:
+            try:
+                getattr(self.database, f'apply_{operation}')(self.session, *args)
+            except Exception as err:
+                LOGGER.error(f'Database operation {operation}{args} failed: {err}')
+        try:
+            self.session.commit()
+        except Exception as err:
+            LOGGER.error(f'Database commit of {len(batch)} operations failed: {err}')
+            self.session.rollback()
+            return False
+        return True
+
+    def write(self, batch):
+        """
+        Applies the batch in one transaction. If the transaction fails (for example, an operation
+        refers to a user deleted by another process), the operations are applied one by one,
+        so only the failed operation is lost.
+        """
+
+        if not self.commit(batch) and len(batch) > 1:
+            LOGGER.warning(f'Writing {len(batch)} operations one by one')
+            for record in batch:
+                self.commit([record])
+
+        with self.condition:
+            for operation, users, args in batch:
+                for user in users:
+                    self.pending[user] -= 1
+                    if not self.pending[user]:
+                        del self.pending[user]
+            self.condition.notify_all()
+
+
+class CachedUser:
+    """The cached record of a user: id, password hash, public key and the contact names (None until loaded)."""
+
+    __slots__ = ('id', 'pswd_hash', 'public_key', 'contacts')
+
+    def __init__(self, user_id, pswd_hash, public_key, contacts=None):
+        self.id = user_id
+        self.pswd_hash = pswd_hash
+        self.public_key = public_key
+        self.contacts = contacts
+
+
+class UserCache:
+    """
+    LRU cache of the user records by the user name with hit and miss counters.
+    While all users of the database fit into the cache (complete), a name
+    that is not in the cache is known to be missing without a query.
+    """
+
+    # Результат поиска имени, которого нет в кеше: нужно обратиться к базе
+    MISS = object()
+
+    def __init__(self, size=USER_CACHE_SIZE):
+        self.size = size
+        self.users = OrderedDict()
+        self.lock = threading.Lock()
+        self.complete = False
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, name):
+        """Returns the record of the user, None if the user does not exist or MISS."""
+
+        with self.lock:
+            record = self.users.get(name)
+            if record is not None:
+                self.users.move_to_end(name)
+                self.hits += 1
+                return record
+            if self.complete:
+                self.hits += 1
+                return None
+            self.misses += 1
+            return self.MISS
+
+    def put(self, name, record):
+        """Puts the record of the user into the cache, evicting the least recently used ones."""
+
+        with self.lock:
+            self.users[name] = record
+            self.users.move_to_end(name)
+            while len(self.users) > self.size:
+                self.users.popitem(last=False)
+                self.evictions += 1
+                self.complete = False
+        return record
+
+    def pop(self, name):
+        """Removes the record of the user."""
+
+        with self.lock:
+            self.users.pop(name, None)
+
+    def clear(self):
+        with self.lock:
+            self.users.clear()
+            self.complete = False
+
+    def metrics(self):
+        with self.lock:
+            return {
+                'size': self.size,
+                'users': len(self.users),
+                'complete': self.complete,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
 
 
 class ServerDB:
@@ -33,7 +312,7 @@ class ServerDB:
         """Displaying a table of active users."""
         __tablename__ = 'active_users'
         id = Column(Integer, primary_key=True)
-        user = Column(String, ForeignKey('all_users.id'), unique=True)
+        user = Column(Integer, ForeignKey('all_users.id', ondelete='CASCADE'), unique=True)
         ip = Column(String)
         port = Column(Integer)
         login_time = Column(DateTime)
@@ -48,7 +327,7 @@ class ServerDB:
         """Displaying the login history table."""
         __tablename__ = 'login_history'
         id = Column(Integer, primary_key=True)
-        user = Column(String, ForeignKey('all_users.id'))
+        user = Column(Integer, ForeignKey('all_users.id', ondelete='CASCADE'), index=True)
         login_time = Column(DateTime)
         ip = Column(String)
         port = Column(Integer)
@@ -62,9 +341,11 @@ class ServerDB:
     class UsersContacts(Base):
         """Displaying the table of user contacts."""
         __tablename__ = 'contacts'
+        # Уникальная пара служит и индексом для выборки контактов пользователя
+        __table_args__ = (UniqueConstraint('user', 'contact', name='uq_contacts_user_contact'),)
         id = Column(Integer, primary_key=True)
-        user = Column(String, ForeignKey('all_users.id'))
-        contact = Column(String, ForeignKey('all_users.id'))
+        user = Column(Integer, ForeignKey('all_users.id', ondelete='CASCADE'))
+        contact = Column(Integer, ForeignKey('all_users.id', ondelete='CASCADE'), index=True)
 
         def __init__(self, user, contact):
             self.user = user
@@ -74,7 +355,7 @@ class ServerDB:
         """Displaying the activity history table."""
         __tablename__ = 'users_history'
         id = Column(Integer, primary_key=True)
-        user = Column(String, ForeignKey('all_users.id'))
+        user = Column(Integer, ForeignKey('all_users.id', ondelete='CASCADE'), index=True)
         sent = Column(Integer)
         accepted = Column(Integer)
 
@@ -83,7 +364,34 @@ class ServerDB:
             self.sent = 0
             self.accepted = 0
 
-    def __init__(self, path):
+    class OfflineMessages(Base):
+        """Displaying the table of messages waiting for the recipient to log in."""
+        __tablename__ = 'offline_messages'
+        # Выборка при входе получателя - один проход по индексу в порядке поступления
+        __table_args__ = (Index('ix_offline_messages_recipient_id', 'recipient', 'id'),)
+        id = Column(Integer, primary_key=True)
+        recipient = Column(Integer, ForeignKey('all_users.id', ondelete='CASCADE'))
+        created = Column(DateTime, index=True)
+        message = Column(Text)
+
+        def __init__(self, recipient, created, message):
+            self.recipient = recipient
+            self.created = created
+            self.message = message
+
+    class DirectoryLog(Base):
+        """Displaying the log of registrations and deletions of users: the id is the version of the user list."""
+        __tablename__ = 'directory_log'
+        id = Column(Integer, primary_key=True)
+        name = Column(String)
+        added = Column(Boolean)
+
+        def __init__(self, name, added):
+            self.name = name
+            self.added = added
+
+    def __init__(self, path, write_interval=WRITE_INTERVAL, write_batch_size=WRITE_BATCH_SIZE,
+                 stats_interval=STATS_INTERVAL, cache_size=USER_CACHE_SIZE, clear_active=True):
 
         self.engine = create_engine(
             f'sqlite:///{path}',
@@ -91,158 +399,586 @@ class ServerDB:
             pool_recycle=7200,
             connect_args={'check_same_thread': False}
         )
+        event.listen(self.engine, 'connect', self.set_pragmas)
+        # Соединения только для чтения: запросы окна сервера и обработчика сообщений
+        # идут мимо сессии записи и не блокируют её фиксацию
+        self.read_engine = create_engine(
+            f'sqlite:///{path}',
+            echo=False,
+            pool_recycle=7200,
+            connect_args={'check_same_thread': False}
+        )
+        event.listen(self.read_engine, 'connect', self.set_read_pragmas)
 
+        # Таблицы базы прежней версии перестраиваются под текущую схему
+        existing = inspect(self.engine).get_table_names()
         self.Base.metadata.create_all(self.engine)
+        self.migrate(existing)
         Session = sessionmaker(bind=self.engine)
-        self.session = Session()
+        # У каждого потока своя сессия чтения
+        self.reader = scoped_session(sessionmaker(bind=self.read_engine))
 
         # Если в таблице активных пользователей есть записи, то их необходимо удалить
-        # Когда устанавливаем соединение, очищаем таблицу активных пользователей
-        self.session.query(self.ActiveUsers).delete()
-        self.session.commit()
+        # Когда устанавливаем соединение, очищаем таблицу активных пользователей.
+        # Процессы многопроцессного сервера открывают уже очищенную базу (clear_active=False)
+        if clear_active:
+            with self.engine.begin() as connection:
+                connection.execute(self.ActiveUsers.__table__.delete())
+
+        # Счётчики сообщений, ещё не перенесённые в базу: имя -> [отправлено, принято].
+        # stats_lock защищает счётчики, которые записываются в базу в данный момент
+        self.message_counters = dict()
+        self.counters_lock = threading.Lock()
+        self.flushing_counters = dict()
+        self.stats_lock = threading.Lock()
+
+        # Изменения от сервера пишет отдельный поток через собственную сессию
+        self.writer = DBWriter(self, Session(), write_interval, write_batch_size, stats_interval)
+        self.writer.start()
+
+        # Кеш пользователей: запросы клиентов обслуживаются без обращения к базе.
+        # Изменения попадают в кеш сразу, в базу - через поток записи
+        self.cache = UserCache(cache_size)
+        # Версия списка пользователей и последние изменения: (версия, имя, добавлен)
+        self.directory_version = 0
+        self.directory_log = deque(maxlen=DIRECTORY_LOG_LIMIT)
+        self.directory_lock = threading.Lock()
+        self.warm_cache()
+
+    @staticmethod
+    def set_pragmas(connection, record):
+        """
+        Sets up a new connection to the database: SQLite checks foreign keys only when asked to,
+        the WAL journal lets the readers work while the writer commits.
+        """
+
+        cursor = connection.cursor()
+        cursor.execute('PRAGMA journal_mode=WAL')
+        cursor.execute('PRAGMA synchronous=NORMAL')
+        cursor.execute(f'PRAGMA cache_size=-{SQLITE_CACHE_SIZE}')
+        cursor.execute(f'PRAGMA mmap_size={SQLITE_MMAP_SIZE}')
+        cursor.execute('PRAGMA foreign_keys=ON')
+        cursor.close()
+
+    @staticmethod
+    def set_read_pragmas(connection, record):
+        """Sets up a new reading connection: any attempt to change the database through it fails."""
+
+        cursor = connection.cursor()
+        cursor.execute(f'PRAGMA cache_size=-{SQLITE_CACHE_SIZE}')
+        cursor.execute(f'PRAGMA mmap_size={SQLITE_MMAP_SIZE}')
+        cursor.execute('PRAGMA query_only=ON')
+        cursor.close()
+
+    def migrate(self, existing):
+        """
+        The method that brings a database created by an older version to the current schema.
+        SQLite can not change the type of a column, so the tables referring to the users are rebuilt
+        in one transaction: the ids are converted to numbers, the rows of deleted users and repeated contacts
+        are dropped. existing is the list of tables that were in the database before it was opened.
+        """
+
+        connection = self.engine.raw_connection()
+        try:
+            cursor = connection.cursor()
+            if cursor.execute('PRAGMA user_version').fetchone()[0] >= SCHEMA_VERSION:
+                return
+            if self.UsersContacts.__tablename__ not in existing:
+                # Новая база уже создана по текущей схеме
+                cursor.execute(f'PRAGMA user_version = {SCHEMA_VERSION}')
+                return
+            LOGGER.info(f'Migrating the database to the schema version {SCHEMA_VERSION}')
+
+            # Транзакцией управляем сами: драйвер не включает в неё изменения схемы
+            driver = connection.connection
+            driver.isolation_level = None
+            cursor.execute('PRAGMA foreign_keys=OFF')
+            cursor.execute('BEGIN')
+            try:
+                for table in self.Base.metadata.sorted_tables:
+                    references = [column.name for column in table.columns if column.foreign_keys]
+                    if references:
+                        self.rebuild_table(cursor, table, references)
+                cursor.execute(f'PRAGMA user_version = {SCHEMA_VERSION}')
+                cursor.execute('COMMIT')
+            except Exception:
+                cursor.execute('ROLLBACK')
+                raise
+            finally:
+                cursor.execute('PRAGMA foreign_keys=ON')
+                driver.isolation_level = ''
+        finally:
+            connection.close()
+
+    def rebuild_table(self, cursor, table, references):
+        """Rebuilds the table by the current schema, copying the rows that refer to existing users."""
+
+        name = table.name
+        old_columns = {row[1] for row in cursor.execute(f'PRAGMA table_info("{name}")').fetchall()}
+        # Индексы старой таблицы удаляем, чтобы создать их заново с теми же именами
+        for index in cursor.execute(f'PRAGMA index_list("{name}")').fetchall():
+            if index[3] == 'c':
+                cursor.execute(f'DROP INDEX "{index[1]}"')
+        cursor.execute(f'ALTER TABLE "{name}" RENAME TO "{name}_old"')
+        cursor.execute(str(CreateTable(table).compile(self.engine)))
+        for index in table.indexes:
+            cursor.execute(str(CreateIndex(index).compile(self.engine)))
+
+        columns = [column.name for column in table.columns if column.name in old_columns]
+        names = [f'"{column}"' for column in columns]
+        values = [f'CAST("{column}" AS INTEGER)' if column in references else f'"{column}"' for column in columns]
+        conditions = [f'CAST("{column}" AS INTEGER) IN (SELECT id FROM all_users)' for column in references]
+        if table is self.UsersContacts.__table__:
+            conditions.append(f'id IN (SELECT MIN(id) FROM "{name}_old" '
+                              f'GROUP BY CAST("user" AS INTEGER), CAST("contact" AS INTEGER))')
+        cursor.execute(
+            f'INSERT INTO "{name}" ({", ".join(names)}) '
+            f'SELECT {", ".join(values)} FROM "{name}_old" WHERE {" AND ".join(conditions)}'
+        )
+        cursor.execute(f'DROP TABLE "{name}_old"')
+
+    def flush(self):
+        """The method that waits until all queued changes are written to the database."""
+
+        self.writer.wait()
+
+    def close(self):
+        """The method that writes the queued changes, stops the writer thread and closes the connections."""
+
+        self.writer.stop()
+        self.reader.remove()
+        self.read_engine.dispose()
+        self.engine.dispose()
+
+    def warm_cache(self):
+        """
+        The method that loads the users with their contacts into the cache
+        and the last changes of the user list.
+        If the cache is smaller than the table, the first users are loaded.
+        """
+
+        # Изменения в очереди записи уже есть в кеше: записываем их, чтобы не потерять
+        self.flush()
+        self.cache.clear()
+        rows = self.reader.query(self.AllUsers.name, self.AllUsers.id, self.AllUsers.pswd_hash,
+                                  self.AllUsers.public_key).limit(self.cache.size + 1).all()
+        records = dict()
+        for name, user_id, pswd_hash, public_key in rows[:self.cache.size]:
+            records[user_id] = self.cache.put(name, CachedUser(user_id, pswd_hash, public_key, []))
+
+        query = self.reader.query(self.UsersContacts.user, self.AllUsers.name) \
+            .join(self.AllUsers, self.UsersContacts.contact == self.AllUsers.id) \
+            .order_by(self.UsersContacts.id)
+        for user_id, contact in query.all():
+            record = records.get(user_id)
+            if record is not None:
+                record.contacts.append(contact)
+        self.cache.complete = len(rows) <= self.cache.size
+
+        log = self.reader.query(self.DirectoryLog.id, self.DirectoryLog.name, self.DirectoryLog.added) \
+            .order_by(self.DirectoryLog.id.desc()).limit(DIRECTORY_LOG_LIMIT).all()
+        with self.directory_lock:
+            self.directory_log.clear()
+            self.directory_log.extend(reversed(log))
+            self.directory_version = log[0][0] if log else 0
+        LOGGER.debug(f'User cache warmed: {self.cache.metrics()}, user list version {self.directory_version}')
+
+    def cache_metrics(self):
+        """The method that returns the counters of the user cache: size, hits, misses, evictions."""
+
+        return self.cache.metrics()
+
+    def user_changed(self, name, public_key=None):
+        """
+        The method that reloads the cached record of the user changed by another server process.
+        The new public key, if given, is put into the cache at once: the other process may not have written it yet.
+        """
+
+        record = self.load_user(name)
+        if record is not None and public_key is not None:
+            record.public_key = public_key
+
+    def load_user(self, name, session=None):
+        """The method that loads the record of the user from the database into the cache."""
+
+        row = (session or self.reader) \
+            .query(self.AllUsers.id, self.AllUsers.pswd_hash, self.AllUsers.public_key) \
+            .filter_by(name=name).first()
+        if row is None:
+            self.cache.pop(name)
+            return None
+        return self.cache.put(name, CachedUser(*row))
+
+    def get_user(self, name, session=None):
+        """
+        The method that returns the cached record of the user (CachedUser) or None if there is no such user.
+        On a cache miss the record is loaded with the given session (the reading one by default).
+        """
+
+        record = self.cache.get(name)
+        if record is not UserCache.MISS:
+            return record
+        return self.load_user(name, session)
+
+    def get_user_id(self, name, session=None):
+        """The method that returns the user id or None."""
+
+        record = self.get_user(name, session)
+        return record.id if record is not None else None
 
     def user_login(self, username, ip, port, key):
         """
-        The method that executed when the user logs in, writes the login fact to the database.
+        The method that executed when the user logs in, queues writing the login fact to the database.
         Updates the user's public key when it changes.
         """
 
-        # Запрос в таблицу пользователей на наличие там пользователя с таким именем
-        rez = self.session.query(self.AllUsers).filter_by(name=username)
-
-        # Если имя пользователя уже присутствует в таблице, обновляем время последнего входа
-        # Проверяем корректность ключа. Если пришел новый ключ - сохраняем
-        if rez.count():
-            user = rez.first()
-            user.last_login = datetime.datetime.now()
-            if user.public_key != key:
-                user.public_key = key
-        # Если нет, то создаём нового пользователя
-        else:
+        record = self.get_user(username)
+        if record is not None:
+            record.public_key = key
+        self.writer.put('user_login', (username,), username, ip, port, key, datetime.datetime.now())
+
+    def apply_user_login(self, session, username, ip, port, key, login_time):
+        """Writes the login fact, called by the writer thread."""
+
+        # id пользователя берём из кеша
+        user_id = self.get_user_id(username, session)
+        if user_id is None:
             raise ValueError('User not registered')
 
+        # Обновляем время последнего входа и ключ без чтения строки пользователя
+        session.query(self.AllUsers).filter_by(id=user_id) \
+            .update({'last_login': login_time, 'public_key': key}, synchronize_session=False)
+
         # Теперь можно создать запись в таблицу активных пользователей о факте входа.
         # Создаем экземпляр класса self.ActiveUsers, через который передаем данные в таблицу
-        new_active_user = self.ActiveUsers(user.id, ip, port, datetime.datetime.now())
-        self.session.add(new_active_user)
+        new_active_user = self.ActiveUsers(user_id, ip, port, login_time)
+        session.add(new_active_user)
 
         # и сохранить в историю входов
         # Создаем экземпляр класса self.LoginHistory, через который передаем данные в таблицу
-        history = self.LoginHistory(user.id, datetime.datetime.now(), ip, port)
-        self.session.add(history)
-
-        # Сохраняем изменения
-        self.session.commit()
+        history = self.LoginHistory(user_id, login_time, ip, port)
+        session.add(history)
 
     def add_user(self, name, pswd_hash):
         """
         User registration method. Accepts a name and password hash, creates an entry in the statistics table.
         """
 
+        user_id, version = self.writer.call(self.apply_add_user, name, pswd_hash)
+
+        with self.directory_lock:
+            self.cache.put(name, CachedUser(user_id, pswd_hash, None, []))
+            self.directory_log.append((version, name, True))
+            self.directory_version = version
+
+    def apply_add_user(self, session, name, pswd_hash):
+        """Writes the new user, called by the writer thread. Returns the user id and the new version of the list."""
+
         user_row = self.AllUsers(name, pswd_hash)
-        self.session.add(user_row)
-        self.session.commit()
+        session.add(user_row)
+        session.flush()
 
         history_row = self.UsersHistory(user_row.id)
-        self.session.add(history_row)
-        self.session.commit()
+        session.add(history_row)
+        return user_row.id, self.log_directory_change(session, name, True)
 
     def remove_user(self, name):
         """A method that removes a user from the database."""
 
-        user = self.session.query(self.AllUsers).filter_by(name=name).first()
-        self.session.query(self.ActiveUsers).filter_by(user=user.id).delete()
-        self.session.query(self.LoginHistory).filter_by(user=user.id).delete()
-        self.session.query(self.UsersContacts).filter_by(user=user.id).delete()
-        self.session.query(self.UsersContacts).filter_by(contact=user.id).delete()
-        self.session.query(self.UsersHistory).filter_by(user=user.id).delete()
-        self.session.query(self.AllUsers).filter_by(name=name).delete()
-        self.session.commit()
+        with self.counters_lock:
+            self.message_counters.pop(name, None)
+        # Отложенные операции записываются раньше удаления, иначе они сошлются на удалённого пользователя
+        version = self.writer.call(self.apply_remove_user, name)
+
+        with self.directory_lock:
+            self.cache.pop(name)
+            # Удалённый пользователь мог оставаться в контактах других пользователей
+            with self.cache.lock:
+                for record in self.cache.users.values():
+                    if record.contacts and name in record.contacts:
+                        record.contacts.remove(name)
+            self.directory_log.append((version, name, False))
+            self.directory_version = version
+
+    def apply_remove_user(self, session, name):
+        """Deletes the user, called by the writer thread. Returns the new version of the user list."""
+
+        # Строки пользователя в остальных таблицах удаляет база (ON DELETE CASCADE)
+        session.query(self.AllUsers).filter_by(name=name).delete()
+        return self.log_directory_change(session, name, False)
+
+    def log_directory_change(self, session, name, added):
+        """
+        The method that writes the registration or deletion of the user into the log in the current transaction
+        and deletes the old records. Returns the new version of the user list.
+        """
+
+        log_row = self.DirectoryLog(name, added)
+        session.add(log_row)
+        session.flush()
+        session.query(self.DirectoryLog) \
+            .filter(self.DirectoryLog.id <= log_row.id - DIRECTORY_LOG_LIMIT) \
+            .delete(synchronize_session=False)
+        return log_row.id
+
+    def users_version(self):
+        """The method that returns the current version of the user list."""
+
+        return self.directory_version
+
+    def users_snapshot(self):
+        """The method that returns the version of the user list and the names of all users."""
+
+        with self.directory_lock:
+            if self.cache.complete:
+                with self.cache.lock:
+                    return self.directory_version, list(self.cache.users)
+            return self.directory_version, [user[0] for user in self.reader.query(self.AllUsers.name).all()]
+
+    def users_changes(self, version):
+        """
+        The method that returns the changes of the user list since the version as the tuple
+        (current version, added names, removed names) or None if the version is too old
+        and the client needs the whole list.
+        """
+
+        with self.directory_lock:
+            current = self.directory_version
+            if version == current:
+                return current, [], []
+            log = self.directory_log
+            if version > current or not log or version < log[0][0] - 1:
+                return None
+            # Для каждого имени важно только последнее изменение
+            changes = dict()
+            for entry_version, name, added in log:
+                if entry_version > version:
+                    changes[name] = added
+        return (current,
+                [name for name, added in changes.items() if added],
+                [name for name, added in changes.items() if not added])
 
     def get_hash(self, name):
         """A method to get the hash of the user's password."""
 
-        user = self.session.query(self.AllUsers).filter_by(name=name).first()
-        return user.pswd_hash
+        record = self.get_user(name)
+        return record.pswd_hash if record is not None else None
 
     def get_public_key(self, name):
         """A method for getting the user's public key."""
 
-        user = self.session.query(self.AllUsers).filter_by(name=name).first()
-        return user.public_key
+        # Новый ключ попадает в кеш при входе, не дожидаясь записи в базу
+        record = self.get_user(name)
+        return record.public_key if record is not None else None
+
+    def get_public_keys(self, names):
+        """A method for getting the public keys of several users: name -> key."""
+
+        keys = dict()
+        for name in names:
+            key = self.get_public_key(name)
+            if key is not None:
+                keys[name] = key
+        return keys
 
     def check_user(self, name):
         """A method that checks for the existence of a user."""
 
-        if self.session.query(self.AllUsers).filter_by(name=name).count():
-            return True
-        return False
+        return self.get_user(name) is not None
 
     def user_logout(self, username):
         """A method fixing user disconnections."""
 
-        # Запрашиваем пользователя, что покидает нас
-        # получаем запись из таблицы AllUsers
-        user = self.session.query(self.AllUsers).filter_by(name=username).first()
+        self.writer.put('user_logout', (username,), username)
 
-        # Удаляем его из таблицы активных пользователей
-        self.session.query(self.ActiveUsers).filter_by(user=user.id).delete()
+    def apply_user_logout(self, session, username):
+        """Writes the disconnection, called by the writer thread."""
 
-        # Применяем изменения
-        self.session.commit()
+        # Удаляем его из таблицы активных пользователей
+        session.query(self.ActiveUsers).filter_by(user=self.get_user_id(username, session)).delete()
 
     def process_message(self, sender, recipient):
-        """A method that writes the fact of message transmission to the statistics table."""
+        """
+        A method that counts the fact of message transmission.
+        The counters are kept in memory and moved to the statistics table by the writer thread.
+        """
+
+        with self.counters_lock:
+            counters = self.message_counters
+            if sender not in counters:
+                counters[sender] = [0, 0]
+            counters[sender][0] += 1
+            if recipient not in counters:
+                counters[recipient] = [0, 0]
+            counters[recipient][1] += 1
+
+    def flush_message_stats(self, session):
+        """
+        Moves the accumulated message counters to the statistics table
+        with one bulk UPDATE, called by the writer thread.
+        """
+
+        with self.counters_lock:
+            if not self.message_counters:
+                return
+            counters, self.message_counters = self.message_counters, dict()
+
+        with self.stats_lock:
+            self.flushing_counters = counters
+        try:
+            ids = {name: self.get_user_id(name, session) for name in counters}
+            history = self.UsersHistory.__table__
+            statement = update(history) \
+                .where(history.c.user == bindparam('user_id')) \
+                .values(sent=history.c.sent + bindparam('sent_delta'),
+                        accepted=history.c.accepted + bindparam('accepted_delta'))
+            rows = [
+                {'user_id': ids[name], 'sent_delta': sent, 'accepted_delta': accepted}
+                for name, (sent, accepted) in counters.items() if ids[name] is not None
+            ]
+            if rows:
+                session.execute(statement, rows)
+            # Коммит и сброс записываемых счётчиков атомарны для message_history
+            with self.stats_lock:
+                session.commit()
+                self.flushing_counters = dict()
+        except Exception as err:
+            LOGGER.error(f'Writing message statistics failed: {err}')
+            session.rollback()
+            # Возвращаем счётчики, чтобы записать их в следующий раз
+            with self.stats_lock, self.counters_lock:
+                for name, (sent, accepted) in counters.items():
+                    current = self.message_counters.setdefault(name, [0, 0])
+                    current[0] += sent
+                    current[1] += accepted
+                self.flushing_counters = dict()
+
+    def store_offline_message(self, recipient, message):
+        """A method that queues saving the message for the user who is not online."""
+
+        self.writer.put('store_offline_message', (recipient,), recipient, json.dumps(message),
+                        datetime.datetime.now())
+
+    def apply_store_offline_message(self, session, recipient, message, created):
+        """Saves the offline message, called by the writer thread."""
+
+        user_id = self.get_user_id(recipient, session)
+        if user_id is None:
+            return
+        session.add(self.OfflineMessages(user_id, created, message))
+
+        # Если очередь получателя переполнена, удаляем самые старые сообщения
+        overflow = session.query(self.OfflineMessages.id) \
+            .filter_by(recipient=user_id) \
+            .order_by(self.OfflineMessages.id.desc()) \
+            .offset(OFFLINE_LIMIT).limit(1).scalar()
+        if overflow is not None:
+            LOGGER.warning(f'Offline queue of the user {recipient} is full, the oldest messages are dropped')
+            session.query(self.OfflineMessages) \
+                .filter(self.OfflineMessages.recipient == user_id, self.OfflineMessages.id <= overflow) \
+                .delete(synchronize_session=False)
+
+    def get_offline_messages(self, recipient):
+        """
+        A method that returns the messages stored for the user in the order of arrival,
+        as a list of tuples (message id, message dictionary).
+        """
+
+        # Сообщения, поставленные в очередь записи, тоже должны попасть в выборку
+        self.writer.wait(recipient)
+        expired = datetime.datetime.now() - datetime.timedelta(seconds=OFFLINE_TTL)
+        query = self.reader.query(self.OfflineMessages.id, self.OfflineMessages.message) \
+            .filter(self.OfflineMessages.recipient == self.get_user_id(recipient),
+                    self.OfflineMessages.created >= expired) \
+            .order_by(self.OfflineMessages.id)
+        return [(message_id, json.loads(message)) for message_id, message in query.all()]
+
+    def remove_offline_messages(self, recipient, last_id):
+        """A method that queues deleting the delivered messages of the user up to last_id inclusive."""
+
+        self.writer.put('remove_offline_messages', (recipient,), recipient, last_id)
+
+    def apply_remove_offline_messages(self, session, recipient, last_id):
+        """Deletes the delivered offline messages, called by the writer thread."""
+
+        user_id = self.get_user_id(recipient, session)
+        session.query(self.OfflineMessages) \
+            .filter(self.OfflineMessages.recipient == user_id, self.OfflineMessages.id <= last_id) \
+            .delete(synchronize_session=False)
 
-        # Получаем ID отправителя и получателя
-        sender = self.session.query(self.AllUsers).filter_by(name=sender).first().id
-        recipient = self.session.query(self.AllUsers).filter_by(name=recipient).first().id
-        # Запрашиваем строки из истории и увеличиваем счётчики
-        sender_row = self.session.query(self.UsersHistory).filter_by(user=sender).first()
-        sender_row.sent += 1
-        recipient_row = self.session.query(self.UsersHistory).filter_by(user=recipient).first()
-        recipient_row.accepted += 1
+    def purge_offline_messages(self, session):
+        """Deletes the expired offline messages, called by the writer thread."""
 
-        self.session.commit()
+        expired = datetime.datetime.now() - datetime.timedelta(seconds=OFFLINE_TTL)
+        try:
+            count = session.query(self.OfflineMessages) \
+                .filter(self.OfflineMessages.created < expired) \
+                .delete(synchronize_session=False)
+            session.commit()
+        except Exception as err:
+            LOGGER.error(f'Deleting expired offline messages failed: {err}')
+            session.rollback()
+            return
+        if count:
+            LOGGER.info(f'Deleted {count} expired offline messages')
 
     def add_contact(self, user, contact):
         """A method for adding a contact for the user."""
 
+        record = self.get_user(user)
+        if record is not None and self.check_user(contact):
+            # Список контактов читают и меняют потоки разных клиентов
+            with self.cache.lock:
+                if record.contacts is not None and contact not in record.contacts:
+                    record.contacts.append(contact)
+        self.writer.put('add_contact', (user,), user, contact)
+
+    def apply_add_contact(self, session, user, contact):
+        """Adds the contact, called by the writer thread."""
+
         # Получаем ID пользователей
-        user = self.session.query(self.AllUsers).filter_by(name=user).first()
-        contact = self.session.query(self.AllUsers).filter_by(name=contact).first()
+        user_id = self.get_user_id(user, session)
+        contact_id = self.get_user_id(contact, session)
 
         # Проверяем что не дубль и что контакт может существовать (полю пользователь мы доверяем)
-        if not contact or self.session.query(self.UsersContacts).filter_by(user=user.id, contact=contact.id).count():
+        if contact_id is None \
+                or session.query(self.UsersContacts).filter_by(user=user_id, contact=contact_id).count():
             return
 
         # Создаём объект и заносим его в базу
-        contact_row = self.UsersContacts(user.id, contact.id)
-        self.session.add(contact_row)
-        self.session.commit()
+        contact_row = self.UsersContacts(user_id, contact_id)
+        session.add(contact_row)
 
     def remove_contact(self, user, contact):
         """A method for deleting a user's contact."""
 
+        record = self.get_user(user)
+        if record is not None:
+            with self.cache.lock:
+                if record.contacts is not None and contact in record.contacts:
+                    record.contacts.remove(contact)
+        self.writer.put('remove_contact', (user,), user, contact)
+
+    def apply_remove_contact(self, session, user, contact):
+        """Deletes the contact, called by the writer thread."""
+
         # Получаем ID пользователей
-        user = self.session.query(self.AllUsers).filter_by(name=user).first()
-        contact = self.session.query(self.AllUsers).filter_by(name=contact).first()
+        user_id = self.get_user_id(user, session)
+        contact_id = self.get_user_id(contact, session)
 
         # Проверяем что контакт может существовать (полю пользователь мы доверяем)
-        if not contact:
+        if contact_id is None:
             return
 
         # Удаляем требуемое
-        self.session.query(self.UsersContacts) \
-            .filter(self.UsersContacts.user == user.id, self.UsersContacts.contact == contact.id).delete()
-
-        self.session.commit()
+        session.query(self.UsersContacts) \
+            .filter(self.UsersContacts.user == user_id, self.UsersContacts.contact == contact_id).delete()
 
     def users_list(self):
         """A method that returns a list of known users with last login time."""
 
         # Запрос строк таблицы пользователей.
-        query = self.session.query(self.AllUsers.name, self.AllUsers.last_login)
+        query = self.reader.query(self.AllUsers.name, self.AllUsers.last_login)
         # Возвращаем список кортежей
         return query.all()
 
@@ -250,7 +986,7 @@ class ServerDB:
         """A method returning a list of active users."""
 
         # Запрашиваем соединение таблиц и собираем кортежи имя, адрес, порт, время.
-        query = self.session \
+        query = self.reader \
             .query(self.AllUsers.name, self.ActiveUsers.ip, self.ActiveUsers.port, self.ActiveUsers.login_time) \
             .join(self.AllUsers)
         # Возвращаем список тюплов
@@ -260,7 +996,7 @@ class ServerDB:
         """A method that returns the login history."""
 
         # Запрашиваем историю входа
-        query = self.session \
+        query = self.reader \
             .query(self.AllUsers.name, self.LoginHistory.login_time, self.LoginHistory.ip, self.LoginHistory.port) \
             .join(self.AllUsers)
         # Если было указано имя пользователя, то фильтруем по нему
@@ -271,21 +1007,47 @@ class ServerDB:
     def get_contacts(self, username):
         """A method that returns a list of the user's contacts."""
 
-        # Запрашиваем указанного пользователя
-        user = self.session.query(self.AllUsers).filter_by(name=username).one()
+        record = self.get_user(username)
+        if record is None:
+            return []
+
+        with self.cache.lock:
+            if record.contacts is not None:
+                return list(record.contacts)
+
+        # Список должен включать только что добавленные и удалённые контакты
+        self.writer.wait(username)
 
         # Запрашиваем его список контактов
-        query = self.session.query(self.UsersContacts, self.AllUsers.name) \
-            .filter_by(user=user.id).join(self.AllUsers, self.UsersContacts.contact == self.AllUsers.id)
+        query = self.reader.query(self.AllUsers.name) \
+            .join(self.UsersContacts, self.UsersContacts.contact == self.AllUsers.id) \
+            .filter(self.UsersContacts.user == record.id) \
+            .order_by(self.UsersContacts.id)
+        contacts = [contact[0] for contact in query.all()]
 
-        # выбираем только имена пользователей и возвращаем их.
-        return [contact[1] for contact in query.all()]
+        with self.cache.lock:
+            if record.contacts is None:
+                record.contacts = contacts
+            return list(record.contacts)
 
     def message_history(self):
-        """A method that returns message statistics."""
+        """A method that returns message statistics, including the counters not yet written to the database."""
 
-        query = self.session \
+        query = self.reader \
             .query(self.AllUsers.name, self.AllUsers.last_login, self.UsersHistory.sent, self.UsersHistory.accepted) \
             .join(self.AllUsers)
+        with self.stats_lock:
+            rows = query.all()
+            deltas = [self.flushing_counters]
+            with self.counters_lock:
+                deltas.append({name: list(value) for name, value in self.message_counters.items()})
+
         # Возвращаем список кортежей
-        return query.all()
+        history = []
+        for name, last_login, sent, accepted in rows:
+            for counters in deltas:
+                if name in counters:
+                    sent += counters[name][0]
+                    accepted += counters[name][1]
+            history.append((name, last_login, sent, accepted))
+        return history
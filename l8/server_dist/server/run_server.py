@@ -1,12 +1,15 @@
 import argparse
 import configparser
 import os.path
+import socket
 import sys
+from functools import partial
 from PyQt5.QtCore import Qt
 from PyQt5.QtWidgets import QApplication
 
-from db.server_db_config import ServerDB
-from server.core import MessageProcessor
+from db.server_db_config import USER_CACHE_SIZE, ServerDB
+from server.engines import ENGINES
+from server.workers import WorkerPool
 
 from common.decorators import Log
 from common.variables import DEFAULT_PORT
@@ -21,11 +24,21 @@ def args_parser(default_port, default_addr):
     parser.add_argument('-p', default=default_port, type=int, nargs='?')
     parser.add_argument('-a', default=default_addr, nargs='?')
     parser.add_argument('--no-gui', action='store_true')
+    parser.add_argument('--engine', default='select', choices=ENGINES.keys())
+    # Несколько процессов на одном порту, каждый со своим движком selectors
+    parser.add_argument('--workers', default=0, type=int)
+    # Число пользователей в кеше базы
+    parser.add_argument('--cache-size', default=USER_CACHE_SIZE, type=int)
     namespace = parser.parse_args(sys.argv[1:])
+    if namespace.workers and not hasattr(socket, 'SO_REUSEPORT'):
+        parser.error('--workers requires SO_REUSEPORT support in the OS')
     listen_addr = namespace.a
     listen_port = namespace.p
     gui_flag = namespace.no_gui
-    return listen_addr, listen_port, gui_flag
+    engine = namespace.engine
+    workers = namespace.workers
+    cache_size = namespace.cache_size
+    return listen_addr, listen_port, gui_flag, engine, workers, cache_size
 
 
 @Log
@@ -54,20 +67,29 @@ def main():
 
     config = config_load()
 
-    listen_addr, listen_port, gui_flag = args_parser(
+    listen_addr, listen_port, gui_flag, engine, workers, cache_size = args_parser(
         config['SETTINGS']['Default_port'],
         config['SETTINGS']['Listen_addr']
     )
-    db = ServerDB(
-        os.path.join(
-            config['SETTINGS']['Database_path'],
-            config['SETTINGS']['Database_file']
-        )
+    db_path = os.path.join(
+        config['SETTINGS']['Database_path'],
+        config['SETTINGS']['Database_file']
     )
-
-    server = MessageProcessor(listen_addr, listen_port, db)
-    server.daemon = True
-    server.start()
+    if workers:
+        # Соединения SQLite и поток записи нельзя переносить через fork: база открывается после запуска
+        # процессов, каждым процессом отдельно. До этого база один раз открывается, чтобы обновить схему
+        # и очистить таблицу активных пользователей, и закрывается
+        ServerDB(db_path, cache_size=cache_size).close()
+        server = WorkerPool(listen_addr, listen_port,
+                            partial(ServerDB, db_path, cache_size=cache_size, clear_active=False), workers)
+        server.daemon = True
+        server.start()
+        db = ServerDB(db_path, cache_size=cache_size, clear_active=False)
+    else:
+        db = ServerDB(db_path, cache_size=cache_size)
+        server = ENGINES[engine](listen_addr, listen_port, db)
+        server.daemon = True
+        server.start()
 
     if gui_flag:
         while True:
@@ -84,6 +106,10 @@ def main():
 
         server_app.exec_()
         server.running = False
+        server.join()
+
+    # Дописываем в базу изменения, оставшиеся в очереди
+    db.close()
 
 
 if __name__ == '__main__':
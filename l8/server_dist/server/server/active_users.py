@@ -0,0 +1,130 @@
+import datetime
+import threading
+from collections import deque
+
+from PyQt5.QtCore import QAbstractTableModel, QModelIndex, QObject, Qt, pyqtSignal
+
+# Роль с исходным значением ячейки для сортировки (порт - число, время - метка времени)
+SORT_ROLE = Qt.UserRole
+
+
+class SessionEvents(QObject):
+    """
+    The queue of logins and logouts of users between the engine thread and the GUI.
+    The engine puts the events with push (the session listener of the engine),
+    the signal is emitted only for the first event of a batch, the window takes all the collected events at once.
+    """
+
+    arrived = pyqtSignal()
+
+    def __init__(self):
+        super().__init__()
+        self.events = deque()
+        self.lock = threading.Lock()
+
+    def push(self, name, address=None):
+        """Puts the login (address is (ip, port)) or the logout (address is None) of the user into the queue."""
+
+        with self.lock:
+            self.events.append((name, address, datetime.datetime.now()))
+            first = len(self.events) == 1
+        if first:
+            self.arrived.emit()
+
+    def take(self):
+        """Returns and removes all the collected events."""
+
+        with self.lock:
+            events = list(self.events)
+            self.events.clear()
+        return events
+
+
+class ActiveUsersModel(QAbstractTableModel):
+    """
+    The table of active users. Filled from the database once, then changed by the login and logout events:
+    a login appends a row, a logout removes one row. The order of rows is not kept
+    (the last row takes the place of the removed one), the table is sorted by QSortFilterProxyModel.
+    """
+
+    HEADERS = ('Client name', 'IP address', 'Port', 'Connection time')
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        # Строки [имя, ip, порт, время входа] и номер строки по имени
+        self.rows = []
+        self.positions = dict()
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.rows)
+
+    def columnCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.HEADERS)
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid():
+            return None
+        value = self.rows[index.row()][index.column()]
+        if role == Qt.DisplayRole:
+            if index.column() == 3:
+                return str(value.replace(microsecond=0))
+            return str(value)
+        if role == SORT_ROLE:
+            return value.timestamp() if index.column() == 3 else value
+        if role == Qt.TextAlignmentRole and index.column():
+            return Qt.AlignCenter
+        return None
+
+    def headerData(self, section, orientation, role=Qt.DisplayRole):
+        if role == Qt.DisplayRole and orientation == Qt.Horizontal:
+            return self.HEADERS[section]
+        return super().headerData(section, orientation, role)
+
+    def reset(self, users_list):
+        """Replaces the contents of the table with the list of tuples (name, ip, port, login time)."""
+
+        self.beginResetModel()
+        self.rows = [list(row) for row in users_list]
+        self.positions = {row[0]: position for position, row in enumerate(self.rows)}
+        self.endResetModel()
+
+    def apply(self, events):
+        """
+        Applies the batch of events (name, address, time) from SessionEvents.
+        New users of the batch are appended with one insertion.
+        """
+
+        added = dict()
+        for name, address, time in events:
+            if address is None:
+                if added.pop(name, None) is None:
+                    self.remove_user(name)
+            elif name in self.positions:
+                position = self.positions[name]
+                self.rows[position] = [name, address[0], address[1], time]
+                self.dataChanged.emit(self.index(position, 0), self.index(position, len(self.HEADERS) - 1))
+            else:
+                added[name] = [name, address[0], address[1], time]
+
+        if added:
+            first = len(self.rows)
+            self.beginInsertRows(QModelIndex(), first, first + len(added) - 1)
+            for position, row in enumerate(added.values(), first):
+                self.rows.append(row)
+                self.positions[row[0]] = position
+            self.endInsertRows()
+
+    def remove_user(self, name):
+        """Removes the row of the user: the last row is moved to its place."""
+
+        position = self.positions.pop(name, None)
+        if position is None:
+            return
+        last = len(self.rows) - 1
+        if position != last:
+            self.rows[position] = self.rows[last]
+            self.positions[self.rows[position][0]] = position
+            self.dataChanged.emit(self.index(position, 0), self.index(position, len(self.HEADERS) - 1))
+        self.beginRemoveRows(QModelIndex(), last, last)
+        self.rows.pop()
+        self.endRemoveRows()
@@ -0,0 +1,186 @@
+import asyncio
+import logging
+import sys
+import threading
+
+sys.path.append('../')
+from server.core import MessageProcessor
+from server.connection import STATE_CLOSED, Connection
+from common.errors import SendBufferOverflow
+from common.compression import Compression
+from common.utils import encode_message
+from common.variables import (ACCOUNT_NAME, ACTION, AUTH_TIMEOUT, CONNECTION_TIMEOUT, MAX_PACKAGE_LENGTH, PRESENCE,
+                              SEND_BUFFER_LIMIT, USER)
+
+LOGGER = logging.getLogger('server')
+
+
+class AsyncMessageProcessor(MessageProcessor):
+    """
+    Server engine built on asyncio streams. The event loop runs in a separate thread,
+    every connection is served by its own coroutine, so a slow client does not stall the others.
+    The JIM actions are processed by the MessageProcessor methods, the client objects are StreamWriters.
+    """
+
+    def __init__(self, listen_addr, listen_port, database):
+        # Цикл создаётся заранее: call_soon из других потоков может прийти до запуска run
+        self.loop = asyncio.new_event_loop()
+        # Задачи обслуживания соединений: при остановке сервера отменяются
+        self.tasks = set()
+        super().__init__(listen_addr, listen_port, database)
+
+    def run(self):
+        """The method that runs the event loop in the engine thread."""
+
+        asyncio.set_event_loop(self.loop)
+        try:
+            self.loop.run_until_complete(self.serve())
+        finally:
+            self.loop.close()
+
+    async def serve(self):
+        """The coroutine that accepts connections until the server is stopped."""
+
+        self.init_socket()
+        self.sock.setblocking(False)
+
+        server = await asyncio.start_server(self.handle_client, sock=self.sock)
+        async with server:
+            while self.running:
+                await asyncio.sleep(CONNECTION_TIMEOUT)
+                self.flush_update_lists()
+
+            for client in list(self.connections.values()):
+                self.remove_client(client)
+            # Соединения закрыты: задачи завершаются, получив конец потока.
+            # Не успевшие завершиться отменяем, чтобы цикл не закрылся с незавершёнными задачами
+            if self.tasks:
+                await asyncio.wait(set(self.tasks), timeout=CONNECTION_TIMEOUT)
+            tasks = list(self.tasks)
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def handle_client(self, reader, writer):
+        """The coroutine that serves one client connection."""
+
+        LOGGER.info(f'Connection established: {writer.get_extra_info("peername")}')
+        client = Connection(writer, writer.get_extra_info('socket').fileno())
+        self.connections[client.fd] = client
+        task = asyncio.current_task()
+        self.tasks.add(task)
+
+        try:
+            while self.running and not client.closed:
+                try:
+                    message = await self.read_message(reader, client)
+                    client.received += 1
+                    if message.get(ACTION) == PRESENCE \
+                            and not client.authorized \
+                            and self.handlers[PRESENCE].validator(message, client):
+                        await self.authorize_user_async(message, reader, client)
+                    else:
+                        self.process_client_message(message, client)
+                    # Ждём, пока данные уйдут клиенту, не мешая остальным соединениям
+                    await writer.drain()
+                except (OSError, ValueError, TypeError) as err:
+                    LOGGER.debug('Getting data from client exception.', exc_info=err)
+                    self.remove_client(client)
+        finally:
+            self.tasks.discard(task)
+
+    async def read_message(self, reader, client):
+        """The coroutine that returns the next complete message of the client."""
+
+        buffer = client.buffer
+        while not buffer.messages:
+            buffer.feed(await reader.read(MAX_PACKAGE_LENGTH))
+        return buffer.messages.popleft()
+
+    async def authorize_user_async(self, message, reader, client):
+        """
+        The coroutine that implements user authorization.
+        Waiting for the answer to the challenge blocks only this connection.
+        """
+
+        LOGGER.debug(f'Start auth process for {message[USER]}')
+
+        if not self.check_presence(message, client):
+            return
+
+        message_auth, digest = self.make_auth_challenge(message[USER][ACCOUNT_NAME])
+        framed = self.negotiate_framing(message, message_auth)
+        binary = framed and self.negotiate_codec(message, message_auth)
+        compressed = framed and self.negotiate_compression(message, message_auth)
+        try:
+            self.send_to(client, message_auth)
+            client.buffer.framed = framed
+            client.buffer.binary = binary
+            client.buffer.compression = Compression() if compressed else None
+            await client.sock.drain()
+            answer = await asyncio.wait_for(self.read_message(reader, client), AUTH_TIMEOUT)
+        except (OSError, asyncio.TimeoutError, ValueError, TypeError) as err:
+            LOGGER.debug('Error in auth, data:', exc_info=err)
+            self.remove_client(client)
+            return
+
+        self.complete_authorization(message, client, answer, digest)
+
+    def authorize_user(self, message, client):
+        """
+        Authorization is performed by the connection coroutine before the message is dispatched,
+        so a repeated presence message from the logged-in client is treated as disconnection.
+        """
+
+        self.remove_client(client)
+
+    def send_to(self, client, message):
+        """
+        The method that puts a message into the write buffer of the StreamWriter.
+        The buffer is bounded: a client that does not read its data is disconnected.
+        """
+
+        if client.closed or client.sock.is_closing():
+            raise ConnectionResetError('Connection closed')
+        if client.sock.transport.get_write_buffer_size() > SEND_BUFFER_LIMIT:
+            raise SendBufferOverflow(f'Send buffer limit of {SEND_BUFFER_LIMIT} bytes exceeded')
+        buffer = client.buffer
+        client.sock.write(encode_message(message, buffer.framed, buffer.binary, buffer.compression))
+        client.sent += 1
+
+    def get_peer_address(self, client):
+        """The method that returns the (ip, port) pair of the client."""
+
+        return client.sock.get_extra_info('peername')[:2]
+
+    def call_soon(self, function, *args):
+        """
+        The method that passes a call from another thread to the event loop.
+        Calls made before the engine starts wait in the loop queue, after the stop they are dropped.
+        """
+
+        if self.loop.is_closed():
+            return
+        self.loop.call_soon_threadsafe(function, *args)
+
+    def remove_client(self, client):
+        """
+        The client handler method with which the connection interrupted.
+        Called from another thread (the GUI), it is passed to the event loop.
+        """
+
+        if threading.current_thread() is not self:
+            self.call_soon(self.remove_client, client)
+            return
+
+        if client.closed:
+            return
+
+        LOGGER.info(f'{client.sock.get_extra_info("peername")} disconnected from the server.')
+        if client.name is not None and self.names.get(client.name) is client:
+            self.database.user_logout(client.name)
+            del self.names[client.name]
+            self.notify_sessions(client.name)
+        client.state = STATE_CLOSED
+        self.connections.pop(client.fd, None)
+        client.sock.close()
@@ -0,0 +1,54 @@
+import sys
+
+sys.path.append('../')
+from common.utils import ReceiveBuffer, SendBuffer
+from common.variables import SEND_BUFFER_LIMIT
+
+# Состояния соединения
+STATE_CONNECTED = 'connected'
+# Отправлен запрос 511, ждём ответ клиента
+STATE_AWAITING_CHALLENGE_RESPONSE = 'awaiting_challenge_response'
+STATE_AUTHORIZED = 'authorized'
+STATE_CLOSED = 'closed'
+
+
+class Connection:
+    """
+    The record of one client connection: the socket (or the StreamWriter of the asyncio engine),
+    the authorization state with the pending challenge, the user name, the buffers, the message counters
+    and the id of the request being processed.
+    The engines pass it as the client object, select() and selectors use its fileno().
+    """
+
+    __slots__ = ('sock', 'fd', 'state', 'name', 'buffer', 'send_buffer', 'received', 'sent', 'auth', 'deadline',
+                 'request_id')
+
+    def __init__(self, sock, fd=None, framed=False, limit=SEND_BUFFER_LIMIT, binary=False):
+        self.sock = sock
+        self.fd = sock.fileno() if fd is None else fd
+        self.state = STATE_CONNECTED
+        self.name = None
+        self.buffer = ReceiveBuffer(framed, binary)
+        self.send_buffer = SendBuffer(limit)
+        # Количество принятых и отправленных сообщений
+        self.received = 0
+        self.sent = 0
+        # Незавершённая авторизация: (сообщение presence, ожидаемый дайджест) и срок ответа
+        self.auth = None
+        self.deadline = None
+        # Номер обрабатываемого запроса, который возвращается в ответе
+        self.request_id = None
+
+    def __repr__(self):
+        return f'Connection(fd={self.fd}, name={self.name!r}, state={self.state})'
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    @property
+    def authorized(self):
+        return self.state == STATE_AUTHORIZED
+
+    @property
+    def closed(self):
+        return self.state == STATE_CLOSED
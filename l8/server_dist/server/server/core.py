@@ -1,21 +1,30 @@
 import threading
+import time
 import logging
 import select
-import json
 import hmac
 import binascii
+import errno
 import os
+import random
 import sys
+from collections import deque
 from socket import socket, AF_INET, SOCK_STREAM, SOL_SOCKET, SO_REUSEADDR
 
 sys.path.append('../')
+from server.connection import STATE_AUTHORIZED, STATE_AWAITING_CHALLENGE_RESPONSE, STATE_CLOSED, STATE_CONNECTED, Connection
+from server.dispatcher import ActionHandler, ActionValidator, build_handlers, handles
 from common.descriptor import Port
-from common.utils import send_message, get_message
+from common.compression import STATS as COMPRESSION_STATS, Compression
+from common.utils import encode_message
 from common.decorators import login_required
-from common.variables import (ACCOUNT_NAME, ACTION, ADD_CONTACT, CONNECTION_TIMEOUT, DATA, DESTINATION, ERROR, EXIT,
-                              GET_CONTACTS, LIST_INFO, MAX_CONNECTIONS, MESSAGE, MESSAGE_TEXT, PRESENCE, PUBLIC_KEY,
-                              PUBLIC_KEY_REQUEST, REMOVE_CONTACT, RESPONSE, RESPONSE_200, RESPONSE_202, RESPONSE_205,
-                              RESPONSE_400, RESPONSE_511, SENDER, TIME, USER, USERS_REQUEST)
+from common.variables import (ACCOUNT_NAME, ACTION, ADD_CONTACT, AUTH_TIMEOUT, CODEC, CODEC_BINARY, COMPRESSION,
+                              COMPRESSION_ZLIB, CONNECTION_TIMEOUT, DATA, DELAY, DESTINATION, ERROR, EXIT, FRAMING,
+                              FRAMING_LENGTH, GET_CONTACTS, LIST_INFO, MAX_CONNECTIONS, MAX_PACKAGE_LENGTH, MESSAGE,
+                              MESSAGE_TEXT, PRESENCE, PUBLIC_KEY, PUBLIC_KEY_REQUEST, REMOVE_CONTACT, REQUEST_ID,
+                              RESPONSE, RESPONSE_200, RESPONSE_202, RESPONSE_205, RESPONSE_206, RESPONSE_400,
+                              RESPONSE_511, SENDER, TIME, UPDATE_LISTS_DELAY, UPDATE_LISTS_RATE, UPDATE_LISTS_SPREAD,
+                              USER, USERS_ADDED, USERS_REMOVED, USERS_REQUEST, VERSION)
 
 LOGGER = logging.getLogger('server')
 
@@ -33,8 +42,23 @@ class MessageProcessor(threading.Thread):
         self.port = listen_port
         self.database = database
 
-        self.clients = []
+        # Реестр соединений: дескриптор -> Connection и имя пользователя -> Connection
+        self.connections = dict()
         self.names = dict()
+        # Соединения, у которых в очереди остались неотправленные данные
+        self.write_pending = set()
+        # Соединения, ждущие ответа на запрос 511, в порядке истечения срока
+        self.handshakes = deque()
+        # Срок рассылки отложенного уведомления 205 (None - рассылка не запрошена)
+        self.lists_update_due = None
+        self.lists_lock = threading.Lock()
+        # Ответы на запросы пользователей для текущей версии списка: версия клиента -> ответ
+        self.users_answers = dict()
+        self.users_answers_version = None
+        # Подписчики на входы и выходы пользователей (окно сервера)
+        self.session_listeners = []
+        # Вызовы из других потоков (GUI), которые выполняет цикл сервера
+        self.pending_calls = deque()
 
         # Сокеты
         self.sock = None
@@ -44,6 +68,9 @@ class MessageProcessor(threading.Thread):
         # Флаг продолжения работы
         self.running = True
 
+        # Обработчики действий JIM: action -> ActionHandler
+        self.handlers = build_handlers(self)
+
         super().__init__()
 
     def run(self):
@@ -58,43 +85,151 @@ class MessageProcessor(threading.Thread):
                 pass
             else:
                 LOGGER.info(f'Connection established: {client_addr}')
-                client.settimeout(5)
-                self.clients.append(client)
+                self.add_client(client)
 
             recv_list = []
-            send_list = []
-            err_list = []
+            self.listen_sockets = []
 
             try:
-                if self.clients:
+                if self.connections:
+                    # На запись проверяем только сокеты с данными в очереди отправки
                     recv_list, self.listen_sockets, self.error_sockets = select.select(
-                        self.clients, self.clients, [], 0
+                        list(self.connections.values()), list(self.write_pending), [], 0
                     )
             except OSError as err:
                 LOGGER.error(f'Sockets error: {err.errno}')
 
+            for client_ready in self.listen_sockets:
+                self.write_client(client_ready)
+
             if recv_list:
                 for client_with_message in recv_list:
-                    try:
-                        self.process_client_message(get_message(client_with_message), client_with_message)
-                    except (OSError, json.JSONDecodeError, TypeError) as err:
-                        LOGGER.debug('Getting data from client exception.', exc_info=err)
-                        self.remove_client(client_with_message)
+                    self.read_client(client_with_message)
+
+            self.expire_handshakes()
+            self.flush_update_lists()
+            self.run_pending_calls()
+
+    def add_client(self, sock):
+        """The method that registers a newly connected client and returns its Connection."""
+
+        sock.setblocking(False)
+        client = Connection(sock)
+        self.connections[client.fd] = client
+        return client
+
+    def read_client(self, client):
+        """
+        The method that reads data from the client socket and processes all complete messages.
+        On a read or decoding error, the client is disconnected.
+        """
+
+        # Клиент мог быть уже удалён при обработке предыдущих сообщений
+        if client.closed:
+            return
+
+        buffer = client.buffer
+        try:
+            try:
+                data = client.sock.recv(MAX_PACKAGE_LENGTH)
+            except (BlockingIOError, InterruptedError):
+                return
+            buffer.feed(data)
+            while buffer.messages and not client.closed:
+                client.received += 1
+                if client.state == STATE_AWAITING_CHALLENGE_RESPONSE:
+                    self.answer_challenge(buffer.messages.popleft(), client)
+                else:
+                    self.process_client_message(buffer.messages.popleft(), client)
+        except (OSError, ValueError, TypeError) as err:
+            LOGGER.debug('Getting data from client exception.', exc_info=err)
+            if not client.closed:
+                self.remove_client(client)
+
+    def write_client(self, client):
+        """The method that sends the queued data when the client socket becomes writable."""
+
+        if client.closed:
+            return
+
+        try:
+            self.flush_client(client)
+        except OSError as err:
+            LOGGER.debug('Sending data to client exception.', exc_info=err)
+            self.remove_client(client)
+
+    def flush_client(self, client):
+        """
+        The method that writes the queued data of the client as far as the socket accepts it.
+        Clients with data left stay in write_pending until the socket becomes writable.
+        """
+
+        if client.send_buffer.flush(client.sock):
+            self.write_pending.discard(client)
+        else:
+            self.write_pending.add(client)
 
     def remove_client(self, client):
         """
         The client handler method with which the connection interrupted.
-        Looks for a client and removes him from the lists and database.
+        Removes the connection from the registry and logs the user out in the database.
+        """
+
+        if client.closed:
+            return
+
+        try:
+            LOGGER.info(f'{client.sock.getpeername()} disconnected from the server.')
+        except OSError:
+            LOGGER.info(f'{client} disconnected from the server.')
+        if client.name is not None and self.names.get(client.name) is client:
+            self.database.user_logout(client.name)
+            del self.names[client.name]
+            self.notify_sessions(client.name)
+        client.state = STATE_CLOSED
+        self.write_pending.discard(client)
+        self.connections.pop(client.fd, None)
+        client.sock.close()
+
+    def disconnect_user(self, name):
+        """
+        The method that disconnects the user deleted in the GUI.
+        Called from the GUI thread, the disconnection is done by the server loop;
+        the logout is written and announced as for a usual disconnection.
+        """
+
+        self.call_soon(self.drop_user, name)
+
+    def drop_user(self, name):
+        """The method of the server loop that disconnects the user if it is online."""
+
+        client = self.names.get(name)
+        if client is not None:
+            self.remove_client(client)
+
+    def call_soon(self, function, *args):
+        """
+        The method that passes a call from another thread to the server loop:
+        the connection registries and the selector are changed only by the server thread.
         """
 
-        LOGGER.info(f'{client.getpeername()} disconnected from the server.')
-        for name in self.names:
-            if self.names[name] == client:
-                self.database.user_logout(name)
-                del self.names[name]
-                break
-        self.clients.remove(client)
-        client.close()
+        self.pending_calls.append((function, args))
+        self.wakeup()
+
+    def wakeup(self):
+        """
+        The method that interrupts the wait of the server loop from another thread.
+        This loop polls the sockets without waiting, so there is nothing to interrupt.
+        """
+
+        pass
+
+    def run_pending_calls(self):
+        """The method of the server loop that executes the calls passed from other threads."""
+
+        while self.pending_calls:
+            function, args = self.pending_calls.popleft()
+            function(*args)
 
     def init_socket(self):
         """The method that initializes the socket."""
@@ -105,173 +240,357 @@ class MessageProcessor(threading.Thread):
         )
 
         transport = socket(AF_INET, SOCK_STREAM)
-        transport.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
+        self.set_socket_options(transport)
         transport.bind((self.addr, self.port))
         transport.settimeout(CONNECTION_TIMEOUT)
 
         self.sock = transport
         self.sock.listen(MAX_CONNECTIONS)
 
+    def set_socket_options(self, transport):
+        """The method that sets the options of the listening socket before it is bound."""
+
+        transport.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
+
     def process_message(self, message):
         """Method for sending a message to the client."""
 
-        if message[DESTINATION] in self.names \
-                and self.names[message[DESTINATION]] in self.listen_sockets:
+        if message[DESTINATION] in self.names:
             try:
-                send_message(self.names[message[DESTINATION]], message)
+                self.send_to(self.names[message[DESTINATION]], message)
                 LOGGER.info(f'Sent a message to {message[DESTINATION]} from {message[SENDER]}')
+                return
             except OSError:
-                self.remove_client(message[DESTINATION])
-        elif message[DESTINATION] in self.names \
-                and self.names[message[DESTINATION]] not in self.listen_sockets:
-            LOGGER.error(
-                f'Communication with the client {message[DESTINATION]} was lost. Connection closed, no delivery possible'
-            )
-            self.remove_client(self.names[message[DESTINATION]])
-        else:
-            LOGGER.error(
-                f'User {message[DESTINATION]} is not registered on the server, sending a message is not possible'
-            )
+                self.remove_client(self.names[message[DESTINATION]])
+
+        # Получатель не в сети: сообщение ждёт его входа в базе
+        self.database.store_offline_message(message[DESTINATION], message)
+        LOGGER.info(f'User {message[DESTINATION]} is offline, the message from {message[SENDER]} is stored')
+
+    def send_offline_messages(self, client):
+        """Method that delivers the messages stored while the user was offline and removes them from the database."""
+
+        messages = self.database.get_offline_messages(client.name)
+        if not messages:
+            return
+        try:
+            for message_id, message in messages:
+                self.send_to(client, message)
+        except OSError:
+            # Недоставленные сообщения остаются в базе до следующего входа
+            self.remove_client(client)
+            return
+        self.database.remove_offline_messages(client.name, messages[-1][0])
+        LOGGER.info(f'Delivered {len(messages)} offline messages to {client.name}')
 
     @login_required
     def process_client_message(self, message, client):
-        """Incoming message handler method."""
+        """
+        Incoming message handler method.
+        Finds the handler of the action with one dictionary lookup and checks the message
+        with the validator of the action; invalid requests are answered with 400.
+        """
 
         LOGGER.debug(f'Parsing a message from a client: {message}')
 
-        # Если это сообщение о присутствии, принимаем и отвечаем
-        if ACTION in message \
-                and message[ACTION] == PRESENCE \
-                and TIME in message \
-                and USER in message:
-            # Если сообщение о присутствии, то вызываем функцию авторизации
-            self.authorize_user(message, client)
-
-        # Если это сообщение, то отправляем его получателю
-        elif ACTION in message \
-                and message[ACTION] == MESSAGE \
-                and DESTINATION in message \
-                and TIME in message \
-                and SENDER in message \
-                and MESSAGE_TEXT in message \
-                and self.names[message[SENDER]] == client:
-            if message[DESTINATION] in self.names:
-                self.database.process_message(message[SENDER], message[DESTINATION])
-                self.process_message(message)
-                try:
-                    send_message(client, RESPONSE_200)
-                except OSError:
-                    self.remove_client(client)
-            else:
-                response = RESPONSE_400
-                response[ERROR] = 'The user is not registered on the server'
-                try:
-                    send_message(client, response)
-                except OSError:
-                    pass
-            return
-
-        # Если клиент выходит
-        elif ACTION in message \
-                and message[ACTION] == EXIT \
-                and ACCOUNT_NAME in message \
-                and self.names[message[ACCOUNT_NAME]] == client:
-            self.remove_client(client)
+        # Необязательный номер запроса возвращается во всех ответах на него,
+        # поэтому клиент может отправлять запросы, не дожидаясь ответов на предыдущие
+        client.request_id = message.pop(REQUEST_ID, None)
+        try:
+            handler = self.handlers.get(message.get(ACTION))
+            if handler is not None and handler.validator(message, client):
+                handler(message, client)
+                return
 
-        # Если это запрос контакт-листа
-        elif ACTION in message \
-                and message[ACTION] == GET_CONTACTS \
-                and USER in message \
-                and self.names[message[USER]] == client:
-            response = RESPONSE_202
-            response[LIST_INFO] = self.database.get_contacts(message[USER])
+            if handler is not None:
+                handler.rejected += 1
+            # Иначе отдаём Bad request
+            response = RESPONSE_400
+            response[ERROR] = 'The request is invalid'
             try:
-                send_message(client, response)
+                self.respond(client, response)
             except OSError:
                 self.remove_client(client)
+        finally:
+            client.request_id = None
+
+    def respond(self, client, response):
+        """
+        The method that sends the answer to the request being processed.
+        If the request has an id, the answer is sent with the same id.
+        """
+
+        if client.request_id is not None:
+            response = dict(response)
+            response[REQUEST_ID] = client.request_id
+        self.send_to(client, response)
+
+    def add_session_listener(self, callback):
+        """
+        The method that subscribes to the logins and logouts of users, so the window of the server
+        does not poll the database. The callback is called from the engine thread as callback(name, address):
+        address is the pair (ip, port) on login and None on logout.
+        """
+
+        self.session_listeners.append(callback)
+
+    def notify_sessions(self, name, address=None):
+        """The method that passes the login (with the address) or the logout of the user to the listeners."""
+
+        for callback in self.session_listeners:
+            callback(name, address)
+
+    def register_action(self, action, handler, fields=None, owner=None):
+        """
+        The method that registers the handler of a new action (or replaces an existing one).
+        The handler is called as handler(message, client) for the messages that passed the check.
+        """
+
+        self.handlers[action] = ActionHandler(action, handler, ActionValidator(fields or {}, owner))
+
+    def action_metrics(self):
+        """The method that returns the counters of the actions: action -> (processed, rejected, total time)."""
+
+        return {
+            action: (handler.count, handler.rejected, handler.total_time)
+            for action, handler in self.handlers.items()
+        }
 
-        # Если это добавление контакта
-        elif ACTION in message \
-                and message[ACTION] == ADD_CONTACT \
-                and ACCOUNT_NAME in message \
-                and USER in message \
-                and self.names[message[USER]] == client:
-            self.database.add_contact(message[USER], message[ACCOUNT_NAME])
+    def compression_metrics(self):
+        """
+        The method that returns the compression counters of the server process: frames and bytes
+        before and after compression in both directions and the time spent on it.
+        """
+
+        return COMPRESSION_STATS.as_dict()
+
+    @handles(PRESENCE, {TIME: (int, float), USER: {ACCOUNT_NAME: str, PUBLIC_KEY: str}})
+    def handle_presence(self, message, client):
+        """Presence message: starts the authorization of the user."""
+
+        # Повторный presence сменил бы имя соединения, а запись names под прежним именем осталась бы
+        if client.authorized or client.state == STATE_AWAITING_CHALLENGE_RESPONSE:
+            self.handlers[PRESENCE].rejected += 1
             try:
-                send_message(client, RESPONSE_200)
+                self.respond(client, {**RESPONSE_400, ERROR: 'The connection is already authorized'})
             except OSError:
                 self.remove_client(client)
+            return
+
+        self.authorize_user(message, client)
 
-        # Если это удаление контакта
-        elif ACTION in message \
-                and message[ACTION] == REMOVE_CONTACT \
-                and ACCOUNT_NAME in message \
-                and USER in message \
-                and self.names[message[USER]] == client:
-            self.database.remove_contact(message[USER], message[ACCOUNT_NAME])
+    @handles(MESSAGE, {DESTINATION: str, TIME: (int, float), SENDER: str, MESSAGE_TEXT: str}, owner=SENDER)
+    def handle_message(self, message, client):
+        """User message: sends it to the recipient or stores it until the recipient logs in."""
+
+        if message[DESTINATION] in self.names or self.database.check_user(message[DESTINATION]):
+            self.database.process_message(message[SENDER], message[DESTINATION])
+            self.process_message(message)
             try:
-                send_message(client, RESPONSE_200)
+                self.respond(client, RESPONSE_200)
             except OSError:
                 self.remove_client(client)
+        else:
+            response = RESPONSE_400
+            response[ERROR] = 'The user is not registered on the server'
+            try:
+                self.respond(client, response)
+            except OSError:
+                pass
+
+    @handles(EXIT, {ACCOUNT_NAME: str}, owner=ACCOUNT_NAME)
+    def handle_exit(self, message, client):
+        """The client leaves."""
+
+        self.remove_client(client)
+
+    @handles(GET_CONTACTS, {USER: str}, owner=USER)
+    def handle_get_contacts(self, message, client):
+        """Request for the contact list."""
+
+        response = RESPONSE_202
+        response[LIST_INFO] = self.database.get_contacts(message[USER])
+        try:
+            self.respond(client, response)
+        except OSError:
+            self.remove_client(client)
+
+    @handles(ADD_CONTACT, {ACCOUNT_NAME: str, USER: str}, owner=USER)
+    def handle_add_contact(self, message, client):
+        """Adding a contact."""
+
+        self.database.add_contact(message[USER], message[ACCOUNT_NAME])
+        try:
+            self.respond(client, RESPONSE_200)
+        except OSError:
+            self.remove_client(client)
+
+    @handles(REMOVE_CONTACT, {ACCOUNT_NAME: str, USER: str}, owner=USER)
+    def handle_remove_contact(self, message, client):
+        """Removing a contact."""
+
+        self.database.remove_contact(message[USER], message[ACCOUNT_NAME])
+        try:
+            self.respond(client, RESPONSE_200)
+        except OSError:
+            self.remove_client(client)
+
+    @handles(USERS_REQUEST, {ACCOUNT_NAME: str}, owner=ACCOUNT_NAME)
+    def handle_users_request(self, message, client):
+        """
+        Request for the known users. A client that sends the version of its list (VERSION)
+        receives only the names added and removed since that version,
+        a client without the version or too far behind receives the whole list.
+        """
 
-        # Если это запрос известных пользователей
-        elif ACTION in message \
-                and message[ACTION] == USERS_REQUEST \
-                and ACCOUNT_NAME in message \
-                and self.names[message[ACCOUNT_NAME]] == client:
-            response = RESPONSE_202
-            response[LIST_INFO] = [user[0] for user in self.database.users_list()]
+        version = message.get(VERSION) if isinstance(message.get(VERSION), int) else None
+        response = self.users_answer(version)
+        try:
+            self.respond(client, response)
+        except OSError:
+            self.remove_client(client)
+
+    def users_answer(self, version):
+        """
+        The method that returns the answer to the request for the users from a client with the list of the version.
+        The answers are kept until the list changes: the clients requesting the list at the same time
+        (after the 205 notification) share one database query and one answer.
+        """
+
+        current = self.database.users_version()
+        if current != self.users_answers_version:
+            self.users_answers.clear()
+            self.users_answers_version = current
+
+        response = self.users_answers.get(version)
+        if response is not None:
+            return response
+        changes = None if version is None else self.database.users_changes(version)
+        if changes is None:
+            # Весь список одинаков для всех версий, с которых изменений уже нет в журнале
+            version = None
+            response = self.users_answers.get(None)
+            if response is not None:
+                return response
+            # Ответ собирается заново: RESPONSE_202 используется и для списка контактов
+            response = {RESPONSE: 202}
+            response[VERSION], response[LIST_INFO] = self.database.users_snapshot()
+        else:
+            response = {RESPONSE: 202}
+            response[VERSION], response[USERS_ADDED], response[USERS_REMOVED] = changes
+        # Список мог измениться во время запроса: такой ответ не сохраняем
+        if response[VERSION] == current:
+            self.users_answers[version] = response
+        return response
+
+    @handles(PUBLIC_KEY_REQUEST, {ACCOUNT_NAME: (str, list)})
+    def handle_public_key_request(self, message, client):
+        """
+        Request for the public key of a user. With a list of names in ACCOUNT_NAME
+        the keys of all these users are sent in one answer: DATA is the dictionary name -> key
+        (users without a key are not included).
+        """
+
+        if isinstance(message[ACCOUNT_NAME], list):
+            response = RESPONSE_511
+            response[DATA] = self.database.get_public_keys(
+                [name for name in message[ACCOUNT_NAME] if isinstance(name, str)]
+            )
             try:
-                send_message(client, response)
+                self.respond(client, response)
             except OSError:
                 self.remove_client(client)
+            return
 
-        # Если это запрос публичного ключа пользователя
-        elif ACTION in message \
-                and message[ACTION] == PUBLIC_KEY_REQUEST \
-                and ACCOUNT_NAME in message:
-            response = RESPONSE_511
-            response[DATA] = self.database.get_public_key(message[ACCOUNT_NAME])
-            # может быть, что ключа ещё нет (пользователь никогда не логинился,
-            # тогда шлём 400)
-            if response[DATA]:
-                try:
-                    send_message(client, response)
-                except OSError:
-                    self.remove_client(client)
-            else:
-                response = RESPONSE_400
-                response[ERROR] = 'No public key for this user'
-                try:
-                    send_message(client, response)
-                except OSError:
-                    self.remove_client(client)
-
-        # Иначе отдаём Bad request
+        response = RESPONSE_511
+        response[DATA] = self.database.get_public_key(message[ACCOUNT_NAME])
+        # может быть, что ключа ещё нет (пользователь никогда не логинился,
+        # тогда шлём 400)
+        if response[DATA]:
+            try:
+                self.respond(client, response)
+            except OSError:
+                self.remove_client(client)
         else:
             response = RESPONSE_400
-            response[ERROR] = 'The request is invalid'
+            response[ERROR] = 'No public key for this user'
             try:
-                send_message(client, response)
+                self.respond(client, response)
             except OSError:
                 self.remove_client(client)
 
-    def authorize_user(self, message, sock):
-        """The method that implements user authorization."""
+    def authorize_user(self, message, client):
+        """
+        The method that starts user authorization: sends the 511 challenge
+        and switches the connection to waiting for the answer.
+        The answer is processed by the main loop when it arrives (answer_challenge),
+        so the loop is not blocked while the client computes the digest.
+        """
 
         LOGGER.debug(f'Start auth process for {message[USER]}')
 
+        if not self.check_presence(message, client):
+            return
+
+        message_auth, digest = self.make_auth_challenge(message[USER][ACCOUNT_NAME])
+        framed = self.negotiate_framing(message, message_auth)
+        binary = framed and self.negotiate_codec(message, message_auth)
+        compressed = framed and self.negotiate_compression(message, message_auth)
+        try:
+            # Ответ на presence уходит без кадрирования,
+            # все последующие сообщения - в согласованном режиме
+            self.send_to(client, message_auth)
+        except OSError as err:
+            LOGGER.debug('Error in auth, data:', exc_info=err)
+            self.remove_client(client)
+            return
+
+        client.buffer.framed = framed
+        client.buffer.binary = binary
+        client.buffer.compression = Compression() if compressed else None
+        client.state = STATE_AWAITING_CHALLENGE_RESPONSE
+        client.auth = (message, digest)
+        client.deadline = time.monotonic() + AUTH_TIMEOUT
+        self.handshakes.append(client)
+
+    def answer_challenge(self, answer, client):
+        """The method that continues the authorization when the client's answer to the challenge arrives."""
+
+        message, digest = client.auth
+        client.auth = None
+        client.state = STATE_CONNECTED
+        self.complete_authorization(message, client, answer, digest)
+
+    def expire_handshakes(self):
+        """
+        The method that disconnects the clients that did not answer the challenge in time.
+        The timeout is the same for everyone, so the queue is ordered by the deadline.
+        """
+
+        now = time.monotonic()
+        while self.handshakes and self.handshakes[0].deadline <= now:
+            client = self.handshakes.popleft()
+            if client.state == STATE_AWAITING_CHALLENGE_RESPONSE:
+                LOGGER.debug(f'{client} did not answer the challenge in time')
+                self.remove_client(client)
+
+    def check_presence(self, message, client):
+        """
+        The first step of authorization: checks that the name is free and registered.
+        If the check fails, sends 400 to the client, disconnects it and returns False.
+        """
+
         if message[USER][ACCOUNT_NAME] in self.names.keys():
             response = RESPONSE_400
             response[ERROR] = 'Username already taken'
             try:
                 LOGGER.debug(f'Username busy, sending {response}')
-                send_message(sock, response)
+                self.send_to(client, response)
             except OSError:
                 LOGGER.debug('OS Error')
                 pass
-            self.clients.remove(sock)
-            sock.close()
+            self.remove_client(client)
+            return False
 
         # Проверяем что пользователь зарегистрирован на сервере.
         elif not self.database.check_user(message[USER][ACCOUNT_NAME]):
@@ -279,71 +598,209 @@ class MessageProcessor(threading.Thread):
             response[ERROR] = 'User not registered'
             try:
                 LOGGER.debug(f'Unknown username, sending {response}')
-                send_message(sock, response)
+                self.send_to(client, response)
             except OSError:
                 pass
-            self.clients.remove(sock)
-            sock.close()
-        else:
-            LOGGER.debug('Correct username, starting password check')
-            # Иначе отвечаем 511 и проводим процедуру авторизации
-            # Словарь - заготовка
-            message_auth = RESPONSE_511
-            # Набор байтов в hex представлении
-            random_str = binascii.hexlify(os.urandom(64))
-            # В словарь байты нельзя, декодируем (json.dumps -> TypeError)
-            message_auth[DATA] = random_str.decode('ascii')
-            # Создаём хэш пароля и связки с рандомной строкой, сохраняем серверную версию ключа
-            hash = hmac.new(self.database.get_hash(message[USER][ACCOUNT_NAME]), random_str, 'MD5')
-            digest = hash.digest()
-            LOGGER.debug(f'Auth message: {message_auth}')
+            self.remove_client(client)
+            return False
+
+        LOGGER.debug('Correct username, starting password check')
+        return True
+
+    def make_auth_challenge(self, username):
+        """
+        The second step of authorization: creates the 511 message with a random string
+        and the digest that the client has to return.
+        """
+
+        # Словарь - заготовка
+        message_auth = RESPONSE_511.copy()
+        # Набор байтов в hex представлении
+        random_str = binascii.hexlify(os.urandom(64))
+        # В словарь байты нельзя, декодируем (json.dumps -> TypeError)
+        message_auth[DATA] = random_str.decode('ascii')
+        # Создаём хэш пароля и связки с рандомной строкой, сохраняем серверную версию ключа
+        hash = hmac.new(self.database.get_hash(username), random_str, 'MD5')
+        digest = hash.digest()
+        LOGGER.debug(f'Auth message: {message_auth}')
+        return message_auth, digest
+
+    def negotiate_framing(self, message, message_auth):
+        """
+        The method that accepts the framing mode requested by the client in the presence message.
+        The accepted mode is added to the 511 answer. Returns True if the framing is enabled.
+        """
+
+        if message.get(FRAMING) == FRAMING_LENGTH:
+            message_auth[FRAMING] = FRAMING_LENGTH
+            return True
+        return False
+
+    def negotiate_codec(self, message, message_auth):
+        """
+        The method that accepts the compact binary format offered by the client in the presence message.
+        The format is used only together with the framing. Returns True if the binary format is enabled.
+        """
+
+        if message.get(CODEC) == CODEC_BINARY:
+            message_auth[CODEC] = CODEC_BINARY
+            return True
+        return False
+
+    def negotiate_compression(self, message, message_auth):
+        """
+        The method that accepts the compression of large frames offered by the client in the presence message.
+        The compression is used only together with the framing. Returns True if the compression is enabled.
+        """
+
+        if message.get(COMPRESSION) == COMPRESSION_ZLIB:
+            message_auth[COMPRESSION] = COMPRESSION_ZLIB
+            return True
+        return False
+
+    def complete_authorization(self, message, client, answer, digest):
+        """
+        The last step of authorization: checks the client's answer to the challenge.
+        On success, registers the client as logged in, otherwise disconnects it.
+        """
+
+        # Пока клиент отвечал на запрос, это имя могло авторизоваться через другое соединение
+        if message[USER][ACCOUNT_NAME] in self.names:
+            response = RESPONSE_400
+            response[ERROR] = 'Username already taken'
             try:
-                # Обмен с клиентом
-                send_message(sock, message_auth)
-                answer = get_message(sock)
-            except OSError as err:
-                LOGGER.debug('Error in auth, data:', exc_info=err)
-                sock.close()
+                self.send_to(client, response)
+            except OSError:
+                pass
+            self.remove_client(client)
+
+        # Если ответ клиента корректный, то сохраняем его в список пользователей
+        elif RESPONSE in answer \
+                and answer[RESPONSE] == 511 \
+                and isinstance(answer.get(DATA), str) \
+                and hmac.compare_digest(digest, binascii.a2b_base64(answer[DATA])):
+            client.name = message[USER][ACCOUNT_NAME]
+            client.state = STATE_AUTHORIZED
+            self.names[client.name] = client
+            client_ip, client_port = self.get_peer_address(client)
+
+            try:
+                self.send_to(client, RESPONSE_200)
+            except OSError:
+                self.remove_client(client)
                 return
-            client_digest = binascii.a2b_base64(answer[DATA])
-            # Если ответ клиента корректный, то сохраняем его в список пользователей
-            if RESPONSE in answer \
-                    and answer[RESPONSE] == 511 \
-                    and hmac.compare_digest(digest, client_digest):
-                self.names[message[USER][ACCOUNT_NAME]] = sock
-                client_ip, client_port = sock.getpeername()
-
-                try:
-                    send_message(sock, RESPONSE_200)
-                except OSError:
-                    self.remove_client(message[USER][ACCOUNT_NAME])
-
-                # добавляем пользователя в список активных и,
-                # если у него изменился открытый ключ, то сохраняем новый
-                self.database.user_login(
-                    message[USER][ACCOUNT_NAME],
-                    client_ip,
-                    client_port,
-                    message[USER][PUBLIC_KEY]
-                )
 
-            else:
-                response = RESPONSE_400
-                response[ERROR] = 'Invalid password'
+            # Сообщения, пришедшие пока пользователь был не в сети. Выбираем их до записи
+            # факта входа, чтобы не ждать записи этой операции в базу
+            self.send_offline_messages(client)
+            if client.closed:
+                return
+
+            # Клиенты хранят ключи собеседников: о новом ключе сообщаем им после записи входа
+            key_changed = self.database.get_public_key(client.name) != message[USER][PUBLIC_KEY]
+
+            # добавляем пользователя в список активных и,
+            # если у него изменился открытый ключ, то сохраняем новый
+            self.database.user_login(
+                message[USER][ACCOUNT_NAME],
+                client_ip,
+                client_port,
+                message[USER][PUBLIC_KEY]
+            )
+            self.notify_sessions(client.name, (client_ip, client_port))
+            if key_changed:
+                self.service_key_changed(client.name)
+
+        else:
+            response = RESPONSE_400
+            response[ERROR] = 'Invalid password'
+
+            try:
+                self.send_to(client, response)
+            except OSError:
+                pass
+
+            self.remove_client(client)
+
+    def send_to(self, client, message):
+        """
+        The method that puts a message into the client's send queue and writes as much as the socket accepts.
+        The rest is sent by the main loop when the socket becomes writable.
+        Throws OSError if the client is disconnected or does not read its data.
+        """
+
+        if client.closed:
+            raise ConnectionResetError(errno.ECONNRESET, 'Client disconnected')
+        buffer = client.buffer
+        client.send_buffer.put(encode_message(message, buffer.framed, buffer.binary, buffer.compression))
+        client.sent += 1
+        self.flush_client(client)
 
-                try:
-                    send_message(sock, response)
-                except OSError:
-                    pass
+    def get_peer_address(self, client):
+        """The method that returns the (ip, port) pair of the client."""
 
-                self.clients.remove(sock)
-                sock.close()
+        return client.sock.getpeername()[:2]
 
     def service_update_lists(self):
-        """Method that implements sending service message 205 to clients."""
+        """
+        Method that requests sending service message 205 to clients. Can be called from any thread.
+        The requests made during UPDATE_LISTS_DELAY are merged: registering many users
+        sends one notification, which the main loop sends at the end of the window.
+        """
+
+        with self.lists_lock:
+            scheduled = self.lists_update_due is None
+            if scheduled:
+                self.lists_update_due = time.monotonic() + UPDATE_LISTS_DELAY
+        # Цикл сервера должен пересчитать время ожидания до срока рассылки
+        if scheduled:
+            self.wakeup()
+
+    def flush_update_lists(self):
+        """The method of the main loop that sends the requested 205 notification when its window is over."""
+
+        with self.lists_lock:
+            if self.lists_update_due is None or self.lists_update_due > time.monotonic():
+                return
+            self.lists_update_due = None
+        self.broadcast_update_lists()
+
+    def broadcast_update_lists(self):
+        """
+        Method that implements sending service message 205 to clients.
+        The message contains the new version of the user list, clients that have it do not request the list.
+        """
+
+        # Общий шаблон RESPONSE_205 не меняем: версия и задержка у каждой рассылки свои
+        response = {**RESPONSE_205, VERSION: self.database.users_version()}
+        spread = self.update_lists_spread()
+        for client in list(self.names):
+            response[DELAY] = round(random.uniform(0, spread), 3)
+            try:
+                self.send_to(self.names[client], response)
+            except OSError:
+                self.remove_client(self.names[client])
+
+    def update_lists_spread(self):
+        """
+        The method that returns the interval (seconds) over which the clients spread their requests
+        after the 205 notification: each client gets its own random delay within it,
+        so the requests do not arrive all at once.
+        """
+
+        return min(UPDATE_LISTS_SPREAD, len(self.names) / UPDATE_LISTS_RATE)
+
+    def service_key_changed(self, name):
+        """
+        Method that sends service message 206 to clients: the public key of the user has changed,
+        the clients have to drop the cached key.
+        """
 
-        for client in self.names:
+        response = {**RESPONSE_206, ACCOUNT_NAME: name}
+        for client in list(self.names):
+            if client == name or client not in self.names:
+                continue
             try:
-                send_message(self.names[client], RESPONSE_205)
+                self.send_to(self.names[client], response)
             except OSError:
                 self.remove_client(self.names[client])
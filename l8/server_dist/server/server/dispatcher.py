@@ -0,0 +1,95 @@
+import time
+
+
+def handles(action, fields=None, owner=None):
+    """
+    The decorator that registers a MessageProcessor method as the handler of an action.
+    :param action: value of the ACTION key.
+    :param fields: dictionary key -> type (or tuple of types) of the required keys;
+        a nested dictionary describes the keys of a nested message dictionary.
+    :param owner: key with the user name that has to be the name of the sending connection.
+    """
+
+    def decorator(func):
+        func.action_spec = (action, fields or {}, owner)
+        return func
+
+    return decorator
+
+
+class ActionValidator:
+    """
+    Precompiled check of a request: the required keys with their types
+    and the ownership of the user name by the sending client.
+    """
+
+    __slots__ = ('checks', 'owner')
+
+    def __init__(self, fields, owner=None):
+        # Вложенные словари разворачиваются в плоский список путей один раз при запуске
+        self.checks = tuple(self.compile(fields, ()))
+        self.owner = owner
+
+    @classmethod
+    def compile(cls, fields, path):
+        for key, expected in fields.items():
+            if isinstance(expected, dict):
+                yield path + (key,), dict
+                yield from cls.compile(expected, path + (key,))
+            else:
+                yield path + (key,), expected
+
+    def __call__(self, message, client):
+        """Returns True if the message is valid and sent by the owner of the user name."""
+
+        for path, expected in self.checks:
+            value = message
+            for key in path:
+                if key not in value:
+                    return False
+                value = value[key]
+            if not isinstance(value, expected):
+                return False
+        return self.owner is None or message[self.owner] == client.name
+
+
+class ActionHandler:
+    """The registered action: handler, validator and the request counters."""
+
+    __slots__ = ('action', 'handler', 'validator', 'count', 'rejected', 'total_time')
+
+    def __init__(self, action, handler, validator):
+        self.action = action
+        self.handler = handler
+        self.validator = validator
+        self.count = 0
+        self.rejected = 0
+        self.total_time = 0.0
+
+    def __call__(self, message, client):
+        start = time.perf_counter()
+        try:
+            self.handler(message, client)
+        finally:
+            self.count += 1
+            self.total_time += time.perf_counter() - start
+
+
+def build_handlers(processor):
+    """
+    Collects the methods marked with @handles in the class hierarchy of the processor.
+    Returns the dictionary action -> ActionHandler with the bound methods,
+    so the handlers overridden in subclasses are used.
+    """
+
+    specs = {}
+    for klass in reversed(type(processor).__mro__):
+        for name, attr in vars(klass).items():
+            spec = getattr(attr, 'action_spec', None)
+            if spec is not None:
+                specs[name] = spec
+
+    handlers = {}
+    for name, (action, fields, owner) in specs.items():
+        handlers[action] = ActionHandler(action, getattr(processor, name), ActionValidator(fields, owner))
+    return handlers
@@ -0,0 +1,10 @@
+from server.core import MessageProcessor
+from server.selector_core import SelectorMessageProcessor
+from server.async_core import AsyncMessageProcessor
+
+# Доступные движки сервера: имя для командной строки -> класс
+ENGINES = {
+    'select': MessageProcessor,
+    'selectors': SelectorMessageProcessor,
+    'asyncio': AsyncMessageProcessor,
+}
@@ -1,9 +1,10 @@
 import sys
-from PyQt5.QtWidgets import (QHeaderView, QMainWindow, QAction, qApp, QApplication, QLabel, QTableView, QToolBar,
-                             QVBoxLayout, QWidget)
-from PyQt5.QtGui import QIcon, QStandardItemModel, QStandardItem
-from PyQt5.QtCore import Qt, QTimer
+from PyQt5.QtWidgets import (QHeaderView, QMainWindow, QAction, qApp, QApplication, QLabel, QLineEdit, QTableView,
+                             QToolBar, QVBoxLayout, QWidget)
+from PyQt5.QtGui import QIcon
+from PyQt5.QtCore import Qt, QSortFilterProxyModel
 
+from server.active_users import SORT_ROLE, ActiveUsersModel, SessionEvents
 from server.stat_window import StatWindow
 from server.config_window import ConfigWindow
 from server.add_user import RegisterUser
@@ -69,6 +70,20 @@ class MainWindow(QMainWindow):
         self.toolbar.addAction(self.exit_btn)
         self.toolbar.setStyleSheet(style.TOOLBAR_THEME)
 
+        # Таблица активных пользователей: модель меняется по событиям входа и выхода,
+        # сортировка и фильтр по имени - в промежуточной модели
+        self.users_model = ActiveUsersModel(self)
+        self.users_proxy = QSortFilterProxyModel(self)
+        self.users_proxy.setSourceModel(self.users_model)
+        self.users_proxy.setSortRole(SORT_ROLE)
+        self.users_proxy.setFilterKeyColumn(0)
+        self.users_proxy.setFilterCaseSensitivity(Qt.CaseInsensitive)
+
+        self.filter_edit = QLineEdit(self)
+        self.filter_edit.setPlaceholderText('Filter by client name')
+        self.filter_edit.setStyleSheet(style.INPUT_NAME_THEME)
+        self.filter_edit.textChanged.connect(self.users_proxy.setFilterFixedString)
+
         self.active_clients_table = QTableView(self)
         self.active_clients_table.setStyleSheet(style.TABLE_THEME)
         self.active_clients_table.setShowGrid(False)
@@ -78,13 +93,27 @@ class MainWindow(QMainWindow):
             self.width_window,
             self.height_window
         )
-
-        self.timer = QTimer()
-        self.timer.timeout.connect(self.create_users_model)
-        self.timer.start(1000)
+        self.active_clients_table.setModel(self.users_proxy)
+        self.active_clients_table.setSortingEnabled(True)
+        self.active_clients_table.sortByColumn(3, Qt.DescendingOrder)
+        # Высота строк постоянная: таблица не измеряет каждую строку
+        self.active_clients_table.verticalHeader().setSectionResizeMode(QHeaderView.Fixed)
+        # Первая колонка "резиновая" - тянется в зависимости от размеров окна (и таблицы)
+        header = self.active_clients_table.horizontalHeader()
+        header.setSectionResizeMode(0, QHeaderView.Stretch)
+        for column in (1, 2, 3):
+            header.setSectionResizeMode(column, QHeaderView.ResizeToContents)
+
+        # Входы и выходы приходят из потока сервера. Подписываемся до загрузки таблицы из базы,
+        # чтобы не пропустить события между загрузкой и подпиской
+        self.session_events = SessionEvents()
+        self.session_events.arrived.connect(self.apply_session_events)
+        self.server.add_session_listener(self.session_events.push)
+        self.create_users_model()
 
         self.layout = QVBoxLayout(self)
         self.layout.addWidget(self.toolbar)
+        self.layout.addWidget(self.filter_edit)
         self.layout.addWidget(self.active_clients_table)
 
         self.widget = QWidget(self)
@@ -103,32 +132,16 @@ class MainWindow(QMainWindow):
         self.show()
 
     def create_users_model(self):
-        """The method that fills the table of active users."""
-
-        users_list = self.database.active_users_list()
-        model_list = QStandardItemModel()
-        model_list.setHorizontalHeaderLabels(['Client name', 'IP address', 'Port', 'Connection time'])
-
-        for row in users_list:
-            user, ip, port, time = row
-            user = QStandardItem(user)
-            user.setEditable(False)
-            ip = QStandardItem(ip)
-            ip.setEditable(False)
-            port = QStandardItem(str(port))
-            port.setEditable(False)
-            time = QStandardItem(str(time.replace(microsecond=0)))
-            time.setEditable(False)
-            model_list.appendRow([user, ip, port, time])
-
-        self.active_clients_table.setModel(model_list)
-        # Растягиваем строки под контент
-        self.active_clients_table.resizeRowsToContents()
-        # Первая колонка "резиновая" - тянется в зависимости от размеров окна (и таблицы)
-        self.active_clients_table.horizontalHeader().setSectionResizeMode(0, QHeaderView.Stretch)
-        self.active_clients_table.resizeColumnToContents(1)
-        self.active_clients_table.resizeColumnToContents(2)
-        self.active_clients_table.resizeColumnToContents(3)
+        """The method that fills the table of active users from the database."""
+
+        # Входы пишутся в базу отложенно: дожидаемся записи очереди, иначе таблица потеряет новых клиентов
+        self.database.flush()
+        self.users_model.reset(self.database.active_users_list())
+
+    def apply_session_events(self):
+        """The slot that applies the collected logins and logouts to the table of active users."""
+
+        self.users_model.apply(self.session_events.take())
 
     def show_statistics(self):
         """Method that creates a window with customer statistics."""
@@ -76,10 +76,8 @@ class DelUserDialog(QDialog):
         """User deletion handler method."""
 
         self.database.remove_user(self.selector.currentText())
-        if self.selector.currentText() in self.server.names:
-            sock = self.server.names[self.selector.currentText()]
-            del self.server.names[self.selector.currentText()]
-            self.server.remove_client(sock)
+        # Отключаем пользователя, если он в сети: выход попадёт в таблицу активных пользователей
+        self.server.disconnect_user(self.selector.currentText())
         # Рассылаем клиентам сообщение о необходимости обновить справочники
         self.server.service_update_lists()
         self.close()
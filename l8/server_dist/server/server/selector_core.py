@@ -0,0 +1,145 @@
+import logging
+import selectors
+import socket
+import sys
+import time
+
+sys.path.append('../')
+from server.core import MessageProcessor
+from common.variables import CONNECTION_TIMEOUT, MAX_PACKAGE_LENGTH
+
+LOGGER = logging.getLogger('server')
+
+
+class SelectorMessageProcessor(MessageProcessor):
+    """
+    Server engine built on the selectors module (epoll/kqueue when available).
+    The listening socket and all client sockets are kept in one readiness set,
+    so the thread sleeps in the kernel until a connection or data arrives
+    instead of polling accept() and select() with a zero timeout.
+    """
+
+    def __init__(self, listen_addr, listen_port, database):
+        self.selector = None
+        # Пара сокетов для пробуждения цикла из других потоков (call_soon, рассылка 205)
+        self.wakeup_reader, self.wakeup_writer = socket.socketpair()
+        self.wakeup_reader.setblocking(False)
+        self.wakeup_writer.setblocking(False)
+        super().__init__(listen_addr, listen_port, database)
+
+    def run(self):
+        """The method that the main thread loop."""
+
+        self.init_socket()
+
+        while self.running:
+            try:
+                events = self.selector.select(self.select_timeout())
+            except OSError as err:
+                LOGGER.error(f'Sockets error: {err.errno}')
+                continue
+
+            for key, mask in events:
+                if key.fileobj is self.sock:
+                    self.accept_clients()
+                    continue
+                if key.fileobj is self.wakeup_reader:
+                    self.drain_wakeup()
+                    continue
+                if mask & selectors.EVENT_WRITE:
+                    self.write_client(key.fileobj)
+                if mask & selectors.EVENT_READ:
+                    self.read_client(key.fileobj)
+
+            self.expire_handshakes()
+            self.flush_update_lists()
+            self.run_pending_calls()
+
+        self.selector.close()
+        self.wakeup_reader.close()
+        self.wakeup_writer.close()
+
+    def select_timeout(self):
+        """
+        The method that returns the wait of the selector: until the due time of the requested
+        205 notification, but not longer than CONNECTION_TIMEOUT, after which the running flag
+        and the handshake deadlines are checked.
+        """
+
+        due = self.lists_update_due
+        if due is None:
+            return CONNECTION_TIMEOUT
+        return min(CONNECTION_TIMEOUT, max(0, due - time.monotonic()))
+
+    def wakeup(self):
+        """The method that interrupts the wait of the selector by writing a byte to the wakeup socket."""
+
+        try:
+            self.wakeup_writer.send(b'\0')
+        except OSError:
+            # Буфер полон - цикл и так будет разбужен; после остановки сокет закрыт
+            pass
+
+    def drain_wakeup(self):
+        """The method that reads the accumulated wakeup bytes."""
+
+        try:
+            while self.wakeup_reader.recv(MAX_PACKAGE_LENGTH):
+                pass
+        except (BlockingIOError, InterruptedError):
+            pass
+
+    def init_socket(self):
+        """The method that initializes the listening socket and registers it in the selector."""
+
+        super().init_socket()
+        self.sock.setblocking(False)
+
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.sock, selectors.EVENT_READ)
+        self.selector.register(self.wakeup_reader, selectors.EVENT_READ)
+
+    def accept_clients(self):
+        """The method that accepts all pending connections of the listening socket."""
+
+        while True:
+            try:
+                client, client_addr = self.sock.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as err:
+                LOGGER.error(f'Accept error: {err.errno}')
+                return
+
+            LOGGER.info(f'Connection established: {client_addr}')
+            self.add_client(client)
+
+    def add_client(self, sock):
+        """The method that registers a newly connected client in the selector."""
+
+        client = super().add_client(sock)
+        # Интерес на запись регистрируется только при наличии данных в очереди отправки
+        self.selector.register(client, selectors.EVENT_READ)
+        return client
+
+    def remove_client(self, client):
+        """The method that unregisters the client socket and removes the client from the lists."""
+
+        try:
+            self.selector.unregister(client)
+        except (KeyError, ValueError):
+            pass
+        super().remove_client(client)
+
+    def flush_client(self, client):
+        """
+        The method that writes the queued data of the client and switches the write interest
+        in the selector when the queue becomes empty or non-empty.
+        """
+
+        was_pending = client in self.write_pending
+        super().flush_client(client)
+        pending = client in self.write_pending
+        if pending != was_pending:
+            events = selectors.EVENT_READ | selectors.EVENT_WRITE if pending else selectors.EVENT_READ
+            self.selector.modify(client, events)
@@ -0,0 +1,522 @@
+import logging
+import multiprocessing
+import random
+import selectors
+import socket
+import sys
+import threading
+import time
+
+sys.path.append('../')
+from server.selector_core import SelectorMessageProcessor
+from server.connection import STATE_CLOSED, Connection
+from common.descriptor import Port
+from common.utils import encode_message
+from common.variables import (ACCOUNT_NAME, ACTION, CONNECTION_TIMEOUT, DATA, DELAY, DESTINATION, MAX_PACKAGE_LENGTH,
+                              PUBLIC_KEY, RESPONSE_205, RESPONSE_206, UPDATE_LISTS_DELAY, USER, VERSION)
+
+LOGGER = logging.getLogger('server')
+
+# Сообщения между процессами-обработчиками и маршрутизатором
+IPC_LOGIN = 'worker_login'
+IPC_LOGOUT = 'worker_logout'
+IPC_DELIVER = 'worker_deliver'
+IPC_DISCONNECT = 'worker_disconnect'
+IPC_UPDATE_LISTS = 'worker_update_lists'
+IPC_KEY_CHANGED = 'worker_key_changed'
+IPC_OFFLINE = 'worker_offline'
+IPC_STOP = 'worker_stop'
+WORKER = 'worker'
+# Адрес (ip, порт) вошедшего пользователя: маршрутизатор передаёт его окну сервера
+ADDRESS = 'address'
+
+# Очередь межпроцессного канала больше клиентской: через неё идёт трафик всех пользователей процесса
+IPC_BUFFER_LIMIT = 64 * 1024 * 1024
+
+
+class RemoteClient:
+    """
+    A user connected to another worker process.
+    Stands in the names dictionary instead of a socket, so sending to it
+    passes the message to the owning worker through the router.
+    """
+
+    def __init__(self, name, worker):
+        self.name = name
+        self.worker = worker
+
+    def __repr__(self):
+        return f'RemoteClient({self.name!r}, worker={self.worker})'
+
+
+class WorkerMessageProcessor(SelectorMessageProcessor):
+    """
+    Server engine of one worker process in the multi-process mode.
+    All workers listen on the same port with SO_REUSEPORT, the kernel distributes the connections.
+    Logins and logouts are announced to the router, messages for users of other workers
+    are passed through the IPC channel, which is served by the same selector loop.
+    """
+
+    def __init__(self, listen_addr, listen_port, database, index, ipc):
+        self.index = index
+        self.ipc = Connection(ipc, framed=True, limit=IPC_BUFFER_LIMIT, binary=True)
+        # Получатели сообщений, сохранённых этим процессом до их входа
+        self.offline_recipients = set()
+        # Маршрутизатор сообщил об остановке: закрытие канала ожидается
+        self.stopping = False
+        super().__init__(listen_addr, listen_port, database)
+
+    def set_socket_options(self, transport):
+        """The method that allows all workers to bind the same port."""
+
+        super().set_socket_options(transport)
+        transport.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+
+    def init_socket(self):
+        """The method that initializes the listening socket and registers the IPC channel in the selector."""
+
+        super().init_socket()
+        self.ipc.sock.setblocking(False)
+        self.selector.register(self.ipc, selectors.EVENT_READ)
+
+    def read_client(self, client):
+        """The method that reads a client socket or the IPC channel."""
+
+        if client is self.ipc:
+            self.read_ipc()
+        else:
+            super().read_client(client)
+
+    def read_ipc(self):
+        """The method that reads and processes the messages of the router."""
+
+        buffer = self.ipc.buffer
+        try:
+            try:
+                data = self.ipc.sock.recv(MAX_PACKAGE_LENGTH)
+            except (BlockingIOError, InterruptedError):
+                return
+            buffer.feed(data)
+            while buffer.messages:
+                self.process_ipc_message(buffer.messages.popleft())
+        except (OSError, ValueError, TypeError) as err:
+            if self.stopping:
+                LOGGER.info(f'Worker {self.index} stopped by the router')
+            else:
+                LOGGER.error(f'Worker {self.index} lost the router connection: {err}')
+            self.running = False
+
+    def process_ipc_message(self, message):
+        """Router message handler method."""
+
+        LOGGER.debug(f'Worker {self.index} got a router message: {message}')
+
+        # Пользователь подключился к другому процессу
+        if message[ACTION] == IPC_LOGIN:
+            if not self.is_local(message[ACCOUNT_NAME]):
+                self.names[message[ACCOUNT_NAME]] = RemoteClient(message[ACCOUNT_NAME], message[WORKER])
+                # Пока пользователь в сети, его запись в базе меняет процесс, к которому он подключён
+                self.database.user_changed(message[ACCOUNT_NAME], message.get(PUBLIC_KEY))
+                self.offline_stored(message[ACCOUNT_NAME], message[WORKER])
+
+        # Пользователь другого процесса отключился
+        elif message[ACTION] == IPC_LOGOUT:
+            client = self.names.get(message[ACCOUNT_NAME])
+            if isinstance(client, RemoteClient) and client.worker == message[WORKER]:
+                del self.names[message[ACCOUNT_NAME]]
+                # Контакты пользователя могли измениться в том процессе: перечитываем запись
+                self.database.user_changed(message[ACCOUNT_NAME])
+
+        # Сообщение для пользователя этого процесса
+        elif message[ACTION] == IPC_DELIVER:
+            if self.is_local(message[DESTINATION]):
+                self.process_message(message[DATA])
+            else:
+                # Получатель успел отключиться: сохраняем сообщение до его входа
+                self.offline_recipients.add(message[DESTINATION])
+                self.database.store_offline_message(message[DESTINATION], message[DATA])
+
+        # Отключение пользователя по требованию маршрутизатора (дубль имени или удаление из GUI).
+        # Сначала убираем имя, чтобы не отмечать выход в базе: выход объявляется маршрутизатору
+        elif message[ACTION] == IPC_DISCONNECT:
+            if self.is_local(message[ACCOUNT_NAME]):
+                self.remove_client(self.names.pop(message[ACCOUNT_NAME]))
+                self.notify_router({ACTION: IPC_LOGOUT, ACCOUNT_NAME: message[ACCOUNT_NAME]})
+
+        # Пользователи добавлены или удалены через GUI. Маршрутизатор уже объединил запросы,
+        # поэтому уведомление рассылается сразу
+        elif message[ACTION] == IPC_UPDATE_LISTS:
+            self.database.warm_cache()
+            self.broadcast_update_lists()
+
+        # Пользователь другого процесса вошёл с новым ключом
+        elif message[ACTION] == IPC_KEY_CHANGED:
+            self.service_key_changed(message[ACCOUNT_NAME], announce=False)
+
+        # Сервер останавливается: следом маршрутизатор закроет канал
+        elif message[ACTION] == IPC_STOP:
+            self.stopping = True
+
+        # Другой процесс записал сообщения для пользователя этого процесса после его входа
+        elif message[ACTION] == IPC_OFFLINE:
+            if self.is_local(message[ACCOUNT_NAME]):
+                self.send_offline_messages(self.names[message[ACCOUNT_NAME]])
+
+    def process_message(self, message):
+        """The method that sends a message or stores it for the offline recipient, remembering the recipient."""
+
+        if message[DESTINATION] not in self.names:
+            self.offline_recipients.add(message[DESTINATION])
+        super().process_message(message)
+
+    def offline_stored(self, name, worker):
+        """
+        The method called when the user logs in through another worker.
+        The process of the user reads the stored messages only after its own writes: the messages stored
+        by this process could be not written yet. They are written now and the process of the user
+        is asked to deliver them.
+        """
+
+        if name not in self.offline_recipients:
+            return
+        self.offline_recipients.discard(name)
+        self.database.writer.wait(name)
+        self.notify_router({ACTION: IPC_OFFLINE, ACCOUNT_NAME: name, WORKER: worker})
+
+    def is_local(self, name):
+        """The method that checks that the user is connected to this worker."""
+
+        return name in self.names and not isinstance(self.names[name], RemoteClient)
+
+    def notify_router(self, message):
+        """The method that sends a message to the router."""
+
+        try:
+            self.send_to(self.ipc, message)
+        except OSError as err:
+            LOGGER.error(f'Worker {self.index} failed to send to the router: {err}')
+            self.running = False
+
+    def complete_authorization(self, message, client, answer, digest):
+        """The method that completes authorization and announces the login to other workers."""
+
+        super().complete_authorization(message, client, answer, digest)
+        if client.authorized:
+            # Сообщения этого процесса уже выбраны при входе
+            self.offline_recipients.discard(client.name)
+            try:
+                address = list(self.get_peer_address(client))
+            except OSError:
+                address = None
+            self.notify_router({ACTION: IPC_LOGIN, ACCOUNT_NAME: client.name, PUBLIC_KEY: message[USER][PUBLIC_KEY],
+                                ADDRESS: address})
+
+    def send_to(self, client, message):
+        """The method that sends a message to a local client or passes it to the owning worker."""
+
+        if isinstance(client, RemoteClient):
+            self.send_to(self.ipc, {ACTION: IPC_DELIVER, WORKER: client.worker, DESTINATION: client.name, DATA: message})
+        else:
+            super().send_to(client, message)
+
+    def remove_client(self, client):
+        """
+        The method that removes a local client and announces the logout to other workers.
+        Users of other workers are disconnected only by their own worker.
+        """
+
+        if client is self.ipc:
+            self.running = False
+            return
+        if isinstance(client, RemoteClient):
+            LOGGER.debug(f'Worker {self.index} can not disconnect {client}')
+            return
+
+        announce = client.authorized and self.names.get(client.name) is client
+        super().remove_client(client)
+        if announce:
+            self.notify_router({ACTION: IPC_LOGOUT, ACCOUNT_NAME: client.name})
+
+    def broadcast_update_lists(self):
+        """
+        Method that sends service message 205 to the clients of this worker.
+        The requests are spread over the interval computed for the users of all workers.
+        """
+
+        # Общий шаблон RESPONSE_205 не меняем: версия и задержка у каждой рассылки свои
+        response = {**RESPONSE_205, VERSION: self.database.users_version()}
+        spread = self.update_lists_spread()
+        for name in list(self.names):
+            if not self.is_local(name):
+                continue
+            response[DELAY] = round(random.uniform(0, spread), 3)
+            try:
+                self.send_to(self.names[name], response)
+            except OSError:
+                self.remove_client(self.names[name])
+
+    def service_key_changed(self, name, announce=True):
+        """
+        Method that sends service message 206 to the clients of this worker.
+        The key change of a local user is announced to other workers.
+        """
+
+        response = {**RESPONSE_206, ACCOUNT_NAME: name}
+        for client_name in list(self.names):
+            if client_name == name or not self.is_local(client_name):
+                continue
+            try:
+                self.send_to(self.names[client_name], response)
+            except OSError:
+                self.remove_client(self.names[client_name])
+        if announce:
+            self.notify_router({ACTION: IPC_KEY_CHANGED, ACCOUNT_NAME: name})
+
+
+def worker_main(index, listen_addr, listen_port, database_factory, ipc, router_sockets=()):
+    """
+    The entry point of a worker process: opens its own database connection and runs the engine.
+    router_sockets are the router ends of the channels copied by fork: they are closed,
+    otherwise the worker does not see the end of its channel when the router closes it.
+    """
+
+    for sock in router_sockets:
+        sock.close()
+    database = database_factory()
+    server = WorkerMessageProcessor(listen_addr, listen_port, database, index, ipc)
+    try:
+        server.run()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        database.close()
+
+
+class WorkerPool(threading.Thread):
+    """
+    The multi-process server. Forks the worker processes and routes
+    messages between them. The router runs as a thread of the main process
+    and provides the interface of MessageProcessor used by the GUI:
+    the names dictionary, disconnect_user, service_update_lists and add_session_listener.
+    """
+
+    port = Port()
+
+    def __init__(self, listen_addr, listen_port, database_factory, workers):
+        self.addr = listen_addr
+        self.port = listen_port
+        self.database_factory = database_factory
+        self.workers = workers
+
+        # Имя пользователя -> RemoteClient с номером процесса
+        self.names = dict()
+        self.processes = []
+        # Каналы связи с процессами, по одному Connection на процесс
+        self.channels = []
+        self.selector = selectors.DefaultSelector()
+        # Отправка в каналы вызывается и из потока GUI
+        self.lock = threading.Lock()
+        # Срок рассылки отложенного уведомления 205 (None - рассылка не запрошена)
+        self.lists_update_due = None
+        # Подписчики на входы и выходы пользователей (окно сервера)
+        self.session_listeners = []
+
+        # Флаг продолжения работы
+        self.running = True
+
+        super().__init__()
+
+    def start(self):
+        """The method that forks the worker processes and starts the router thread."""
+
+        LOGGER.info(f'Starting {self.workers} worker processes on port {self.port}')
+        context = multiprocessing.get_context('fork')
+        for index in range(self.workers):
+            channel, worker_channel = socket.socketpair()
+            process = context.Process(
+                target=worker_main,
+                args=(index, self.addr, self.port, self.database_factory, worker_channel,
+                      [channel] + [item.sock for item in self.channels]),
+                daemon=True
+            )
+            process.start()
+            worker_channel.close()
+
+            channel.setblocking(False)
+            channel = Connection(channel, framed=True, limit=IPC_BUFFER_LIMIT, binary=True)
+            self.channels.append(channel)
+            self.processes.append(process)
+            self.selector.register(channel, selectors.EVENT_READ, index)
+
+        super().start()
+
+    def run(self):
+        """The router loop."""
+
+        while self.running:
+            for key, mask in self.selector.select(CONNECTION_TIMEOUT):
+                if mask & selectors.EVENT_WRITE:
+                    with self.lock:
+                        self.flush_channel(key.data)
+                if mask & selectors.EVENT_READ:
+                    self.read_channel(key.data)
+            self.flush_update_lists()
+
+        self.stop_workers()
+
+    def read_channel(self, index):
+        """The method that reads and routes the messages of a worker."""
+
+        channel = self.channels[index]
+        buffer = channel.buffer
+        try:
+            try:
+                data = channel.sock.recv(MAX_PACKAGE_LENGTH)
+            except (BlockingIOError, InterruptedError):
+                return
+            buffer.feed(data)
+            while buffer.messages:
+                self.route(index, buffer.messages.popleft())
+        except (OSError, ValueError, TypeError) as err:
+            LOGGER.error(f'Worker {index} stopped: {err}')
+            self.drop_worker(index)
+
+    def route(self, index, message):
+        """The method that routes a worker message."""
+
+        LOGGER.debug(f'Router got a message from worker {index}: {message}')
+
+        if message[ACTION] == IPC_LOGIN:
+            owner = self.names.get(message[ACCOUNT_NAME])
+            # Одно имя вошло одновременно через два процесса: второе подключение разрываем
+            if owner is not None and owner.worker != index:
+                self.send(index, {ACTION: IPC_DISCONNECT, ACCOUNT_NAME: message[ACCOUNT_NAME]})
+                return
+            self.names[message[ACCOUNT_NAME]] = RemoteClient(message[ACCOUNT_NAME], index)
+            message[WORKER] = index
+            self.broadcast(message, index)
+            address = message.get(ADDRESS)
+            self.notify_sessions(message[ACCOUNT_NAME], tuple(address) if isinstance(address, list) else None)
+
+        elif message[ACTION] == IPC_LOGOUT:
+            owner = self.names.get(message[ACCOUNT_NAME])
+            if owner is None or owner.worker == index:
+                self.names.pop(message[ACCOUNT_NAME], None)
+                self.broadcast({ACTION: IPC_LOGOUT, ACCOUNT_NAME: message[ACCOUNT_NAME], WORKER: index}, index)
+                self.notify_sessions(message[ACCOUNT_NAME])
+
+        elif message[ACTION] == IPC_DELIVER:
+            self.send(message[WORKER], message)
+
+        elif message[ACTION] == IPC_KEY_CHANGED:
+            self.broadcast(message, index)
+
+        elif message[ACTION] == IPC_OFFLINE:
+            self.send(message[WORKER], message)
+
+    def send(self, index, message):
+        """The method that puts a message into the channel queue of a worker."""
+
+        channel = self.channels[index]
+        with self.lock:
+            if channel.closed:
+                return
+            try:
+                channel.send_buffer.put(encode_message(message, True, True))
+                self.flush_channel(index)
+            except OSError as err:
+                LOGGER.error(f'Failed to send to worker {index}: {err}')
+
+    def broadcast(self, message, exclude=None):
+        """The method that sends a message to all workers except one."""
+
+        for index in range(len(self.channels)):
+            if index != exclude:
+                self.send(index, message)
+
+    def flush_channel(self, index):
+        """The method that writes the queued data of a channel and switches the write interest."""
+
+        channel = self.channels[index]
+        if channel.closed:
+            return
+        events = selectors.EVENT_READ
+        if not channel.send_buffer.flush(channel.sock):
+            events |= selectors.EVENT_WRITE
+        if self.selector.get_key(channel).events != events:
+            self.selector.modify(channel, events, index)
+
+    def drop_worker(self, index):
+        """The method that forgets a stopped worker and announces the logout of its users."""
+
+        channel = self.channels[index]
+        with self.lock:
+            self.selector.unregister(channel)
+            channel.state = STATE_CLOSED
+            channel.sock.close()
+
+        for name in [name for name, client in self.names.items() if client.worker == index]:
+            del self.names[name]
+            self.broadcast({ACTION: IPC_LOGOUT, ACCOUNT_NAME: name, WORKER: index}, index)
+            self.notify_sessions(name)
+
+    def stop_workers(self):
+        """The method that stops the workers: closing the channel ends the worker loop."""
+
+        for index, channel in enumerate(self.channels):
+            if not channel.closed:
+                self.send(index, {ACTION: IPC_STOP})
+                self.drop_worker(index)
+        for process in self.processes:
+            process.join(CONNECTION_TIMEOUT * 4)
+            if process.is_alive():
+                process.terminate()
+        self.selector.close()
+
+    def remove_client(self, client):
+        """The method that asks the owning worker to disconnect the user."""
+
+        self.send(client.worker, {ACTION: IPC_DISCONNECT, ACCOUNT_NAME: client.name})
+
+    def disconnect_user(self, name):
+        """
+        The method that disconnects the user deleted in the GUI, as in MessageProcessor.
+        The logout comes back from the worker and is announced to the listeners.
+        """
+
+        client = self.names.get(name)
+        if client is not None:
+            self.remove_client(client)
+
+    def add_session_listener(self, callback):
+        """
+        The method that subscribes to the logins and logouts of the users of all workers,
+        as in MessageProcessor. The callback is called from the router thread.
+        """
+
+        self.session_listeners.append(callback)
+
+    def notify_sessions(self, name, address=None):
+        """The method that passes the login (with the address) or the logout of the user to the listeners."""
+
+        for callback in self.session_listeners:
+            callback(name, address)
+
+    def service_update_lists(self):
+        """
+        Method that makes all workers send service message 205 to their clients.
+        As in MessageProcessor, the requests made during UPDATE_LISTS_DELAY are merged into one.
+        """
+
+        with self.lock:
+            if self.lists_update_due is None:
+                self.lists_update_due = time.monotonic() + UPDATE_LISTS_DELAY
+
+    def flush_update_lists(self):
+        """The method of the router loop that passes the requested notification to the workers."""
+
+        with self.lock:
+            if self.lists_update_due is None or self.lists_update_due > time.monotonic():
+                return
+            self.lists_update_due = None
+        self.broadcast({ACTION: IPC_UPDATE_LISTS})
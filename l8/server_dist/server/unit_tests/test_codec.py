@@ -0,0 +1,58 @@
+import unittest
+import sys
+import os
+
+sys.path.insert(0, os.path.join(os.getcwd(), '..'))
+from common.codec import KEY_CODES, pack, unpack
+from common.variables import ACCOUNT_NAME, ACTION, LIST_INFO, PRESENCE, RESPONSE, TIME, USER
+from common.utils import ReceiveBuffer, encode_message
+
+
+class TestCodec(unittest.TestCase):
+    """
+    Тестирует двоичный формат сообщений.
+    """
+
+    test_dict = {
+            ACTION: PRESENCE,
+            TIME: 111.111,
+            USER: {
+                    ACCOUNT_NAME: 'тестовый_гость'
+            }
+    }
+
+    def test_round_trip(self):
+        self.assertEqual(unpack(pack(self.test_dict)), self.test_dict)
+
+    def test_values(self):
+        values = [None, True, False, 0, 127, 128, -1, -33, 2 ** 40, -2 ** 40, 0.5, '', 'x' * 70000,
+                  list(range(20)), {'custom_key': {}}]
+        for value in values:
+            self.assertEqual(unpack(pack(value)), value)
+
+    def test_known_key_is_one_byte(self):
+        self.assertEqual(pack({RESPONSE: 200}), bytes((0x81, KEY_CODES[RESPONSE], 0xcc, 200)))
+
+    def test_big_list(self):
+        message = {RESPONSE: 202, LIST_INFO: [f'user_{i}' for i in range(1000)]}
+        self.assertEqual(unpack(pack(message)), message)
+
+    def test_unsupported_type(self):
+        self.assertRaises(TypeError, pack, {ACTION: b'bytes'})
+        self.assertRaises(TypeError, pack, {1: 'not a string key'})
+
+    def test_damaged_data(self):
+        data = pack(self.test_dict)
+        self.assertRaises(ValueError, unpack, data[:-3])
+        self.assertRaises(ValueError, unpack, data + b'\x00')
+        self.assertRaises(ValueError, unpack, b'\xc1')
+        self.assertRaises(ValueError, unpack, bytes((0x81, 0x7f, 0x00)))
+
+    def test_binary_frames(self):
+        buffer = ReceiveBuffer(framed=True, binary=True)
+        buffer.feed(encode_message(self.test_dict, True, True) + encode_message({RESPONSE: 200}, True, True))
+        self.assertEqual(list(buffer.messages), [self.test_dict, {RESPONSE: 200}])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,88 @@
+import unittest
+import sys
+import os
+import socket
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.join(os.getcwd(), '..'))
+from server.connection import STATE_AUTHORIZED, Connection
+from server.core import MessageProcessor
+from server.dispatcher import ActionValidator
+from common.utils import ReceiveBuffer
+from common.variables import (ACCOUNT_NAME, ACTION, DESTINATION, MESSAGE_TEXT, PRESENCE, PUBLIC_KEY, RESPONSE, SENDER,
+                              TIME, USER)
+
+
+class TestActionValidator(unittest.TestCase):
+    """
+    Тестирует проверку запросов валидатором действия.
+    """
+
+    def setUp(self):
+        self.client = SimpleNamespace(name='test_user')
+        self.message_validator = ActionValidator(
+            {DESTINATION: str, TIME: (int, float), SENDER: str, MESSAGE_TEXT: str},
+            owner=SENDER
+        )
+        self.message = {DESTINATION: 'other', TIME: 1.1, SENDER: 'test_user', MESSAGE_TEXT: 'text'}
+
+    def test_valid_message(self):
+        self.assertTrue(self.message_validator(self.message, self.client))
+
+    def test_missing_key(self):
+        del self.message[MESSAGE_TEXT]
+        self.assertFalse(self.message_validator(self.message, self.client))
+
+    def test_wrong_type(self):
+        self.message[TIME] = 'now'
+        self.assertFalse(self.message_validator(self.message, self.client))
+
+    def test_foreign_sender(self):
+        self.assertFalse(self.message_validator(self.message, SimpleNamespace(name='other')))
+
+    def test_nested_keys(self):
+        validator = ActionValidator({TIME: (int, float), USER: {ACCOUNT_NAME: str}})
+        self.assertTrue(validator({TIME: 1, USER: {ACCOUNT_NAME: 'test_user'}}, self.client))
+        self.assertFalse(validator({TIME: 1, USER: {}}, self.client))
+        self.assertFalse(validator({TIME: 1, USER: 'test_user'}, self.client))
+
+    def test_presence_requires_public_key(self):
+        action, fields, owner = MessageProcessor.handle_presence.action_spec
+        validator = ActionValidator(fields, owner)
+        self.assertTrue(validator({TIME: 1, USER: {ACCOUNT_NAME: 'test_user', PUBLIC_KEY: 'key'}}, self.client))
+        self.assertFalse(validator({TIME: 1, USER: {ACCOUNT_NAME: 'test_user'}}, self.client))
+
+
+class TestRepeatedPresence(unittest.TestCase):
+    """
+    Тестирует отказ в повторной авторизации по уже авторизованному соединению.
+    """
+
+    def setUp(self):
+        self.server = MessageProcessor('127.0.0.1', 7777, None)
+        self.sock, self.peer = socket.socketpair()
+        self.peer.settimeout(1)
+        self.client = Connection(self.sock)
+        self.client.state = STATE_AUTHORIZED
+        self.client.name = 'alice'
+        self.server.names['alice'] = self.client
+
+    def tearDown(self):
+        self.sock.close()
+        self.peer.close()
+
+    def test_presence_rejected(self):
+        self.server.process_client_message(
+            {ACTION: PRESENCE, TIME: 1, USER: {ACCOUNT_NAME: 'bob', PUBLIC_KEY: 'key'}}, self.client)
+
+        buffer = ReceiveBuffer()
+        buffer.feed(self.peer.recv(1024))
+        self.assertEqual(buffer.messages.popleft()[RESPONSE], 400)
+        self.assertEqual(self.client.name, 'alice')
+        self.assertTrue(self.client.authorized)
+        self.assertEqual(self.server.names, {'alice': self.client})
+        self.assertEqual(self.server.handlers[PRESENCE].rejected, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,12 +1,43 @@
 import unittest
 import sys
 import os
+import binascii
+import datetime
+import hmac
+import shutil
+import socket
+import tempfile
+import threading
+import time
+from unittest import mock
 
 sys.path.insert(0, os.path.join(os.getcwd(), '..'))
-from common.variables import ACCOUNT_NAME, ACTION, ERROR, PRESENCE, RESPONSE, TIME, USER
-from server import process_client_message
+from common.utils import ReceiveBuffer, encode_message, get_message, send_message
+from common.variables import (ACCOUNT_NAME, ACTION, ADD_CONTACT, CONNECTION_TIMEOUT, DATA, DELAY, DESTINATION,
+                              ERROR, FRAMING, FRAMING_LENGTH, GET_CONTACTS, LIST_INFO, MESSAGE, MESSAGE_TEXT,
+                              PRESENCE, PUBLIC_KEY, PUBLIC_KEY_REQUEST, REQUEST_ID, RESPONSE, RESPONSE_205,
+                              RESPONSE_206, RESPONSE_511, SENDER, TIME, UPDATE_LISTS_DELAY, USER, USERS_ADDED,
+                              USERS_REMOVED, USERS_REQUEST, VERSION)
+from db.server_db_config import ServerDB
+from server.engines import ENGINES
 
+# Таблица активных пользователей окна сервера построена на моделях Qt
+try:
+    from server.active_users import ActiveUsersModel, SessionEvents
+except ImportError:
+    ActiveUsersModel = SessionEvents = None
 
+# Тесты первой версии сервера: функции process_client_message в пакете server больше нет
+try:
+    from server import process_client_message
+except ImportError:
+    process_client_message = None
+
+# Хэш пароля, с которым зарегистрированы пользователи тестов
+PASSWORD_HASH = b'test hash'
+
+
+@unittest.skipIf(process_client_message is None, 'the server has no process_client_message function')
 class TestServer(unittest.TestCase):
     server_msg_200 = {
             RESPONSE: 200
@@ -70,5 +101,628 @@ class TestServer(unittest.TestCase):
         self.assertNotIsInstance(test_data_str, dict)
 
 
+def free_port():
+    """Возвращает свободный порт локального адреса."""
+
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+class JimClient:
+    """
+    Клиент JIM для тестов движков: сокет с буфером приёма.
+    Подключение повторяется, пока поток сервера не открыл порт.
+    """
+
+    def __init__(self, port, receive_buffer=None):
+        deadline = time.monotonic() + 5
+        while True:
+            self.sock = socket.socket()
+            self.sock.settimeout(5)
+            # Маленький буфер приёма, заданный до подключения, ограничивает окно TCP
+            if receive_buffer is not None:
+                self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, receive_buffer)
+            try:
+                self.sock.connect(('127.0.0.1', port))
+                break
+            except ConnectionRefusedError:
+                self.sock.close()
+                if time.monotonic() > deadline:
+                    raise
+                time.sleep(0.05)
+        self.buffer = ReceiveBuffer()
+
+    def send(self, message):
+        send_message(self.sock, message, self.buffer.framed, self.buffer.binary, self.buffer.compression)
+
+    def get(self):
+        return get_message(self.sock, self.buffer)
+
+    def presence(self, name, key=None):
+        """Отправляет presence с кадрированием и возвращает ответ сервера."""
+
+        self.send({
+            ACTION: PRESENCE,
+            TIME: time.time(),
+            USER: {ACCOUNT_NAME: name, PUBLIC_KEY: key or f'key of {name}'},
+            FRAMING: FRAMING_LENGTH
+        })
+        return self.get()
+
+    def login(self, name, key=None):
+        """Проходит авторизацию и возвращает ответ сервера на дайджест."""
+
+        answer = self.presence(name, key)
+        if answer[RESPONSE] != 511:
+            return answer
+        self.buffer.framed = answer.get(FRAMING) == FRAMING_LENGTH
+        digest = hmac.new(PASSWORD_HASH, answer[DATA].encode('ascii'), 'MD5').digest()
+        self.send({**RESPONSE_511, DATA: binascii.b2a_base64(digest).decode('ascii')})
+        return self.get()
+
+    def disconnected(self):
+        """Проверяет, что сервер закрыл соединение."""
+
+        try:
+            while True:
+                if not self.sock.recv(65536):
+                    return True
+        except ConnectionResetError:
+            return True
+        except socket.timeout:
+            return False
+
+    def close(self):
+        self.sock.close()
+
+
+def wait_for(condition, timeout=5):
+    """Ждёт выполнения условия, которое проверяет поток сервера; возвращает итоговое значение условия."""
+
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+
+class EngineTestCase(unittest.TestCase):
+    """
+    Движок сервера на свободном порту локального адреса с новой базой во временном каталоге.
+    Пользователи alice, bob и carol зарегистрированы и уже входили с ключами 'key of <имя>'.
+    """
+
+    engine = None
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.database = ServerDB(os.path.join(self.directory, 'server_db.db3'))
+        for name in ('alice', 'bob', 'carol'):
+            self.database.add_user(name, PASSWORD_HASH)
+            # Ключ уже известен серверу: вход с ним не рассылает уведомление 206
+            self.database.user_login(name, '127.0.0.1', 7777, f'key of {name}')
+            self.database.user_logout(name)
+        self.server = ENGINES[self.engine]('127.0.0.1', free_port(), self.database)
+        self.server.daemon = True
+        self.server.start()
+        self.clients = []
+
+    def tearDown(self):
+        for client in self.clients:
+            client.close()
+        self.server.running = False
+        self.server.call_soon(lambda: None)
+        self.server.join(CONNECTION_TIMEOUT * 4)
+        self.database.close()
+        shutil.rmtree(self.directory)
+
+    def connect(self, name=None, receive_buffer=None):
+        """Подключает клиента и, если указано имя, авторизует его."""
+
+        client = JimClient(self.server.port, receive_buffer)
+        self.clients.append(client)
+        if name is not None:
+            self.assertEqual(client.login(name)[RESPONSE], 200)
+        return client
+
+    def message(self, sender, destination, text='hello'):
+        return {ACTION: MESSAGE, SENDER: sender, DESTINATION: destination, TIME: time.time(), MESSAGE_TEXT: text}
+
+
+class EngineScenarios:
+    """
+    Общие для всех движков проверки: авторизация, доставка сообщений и отключение из другого потока.
+    """
+
+    def test_login(self):
+        self.connect('alice')
+        self.assertTrue(wait_for(lambda: 'alice' in self.server.names))
+
+    def test_unknown_user(self):
+        client = self.connect()
+        self.assertEqual(client.presence('nobody')[RESPONSE], 400)
+        self.assertTrue(client.disconnected())
+
+    def test_wrong_password(self):
+        client = self.connect()
+        answer = client.presence('alice')
+        client.buffer.framed = True
+        client.send({**RESPONSE_511, DATA: binascii.b2a_base64(b'wrong digest').decode('ascii')})
+        self.assertEqual(answer[RESPONSE], 511)
+        self.assertEqual(client.get()[RESPONSE], 400)
+        self.assertTrue(client.disconnected())
+
+    def test_message_delivery(self):
+        alice = self.connect('alice')
+        bob = self.connect('bob')
+        for number in range(3):
+            alice.send(self.message('alice', 'bob', f'message {number}'))
+            self.assertEqual(alice.get()[RESPONSE], 200)
+        self.assertEqual([bob.get()[MESSAGE_TEXT] for _ in range(3)], ['message 0', 'message 1', 'message 2'])
+
+    def test_disconnect_user(self):
+        alice = self.connect('alice')
+        self.server.disconnect_user('alice')
+        self.assertTrue(alice.disconnected())
+        self.assertTrue(wait_for(lambda: 'alice' not in self.server.names))
+
+
+class TestSelectEngine(EngineScenarios, EngineTestCase):
+    """
+    Тестирует движок на select с опросом сокетов.
+    """
+
+    engine = 'select'
+
+
+class TestSelectorsEngine(EngineScenarios, EngineTestCase):
+    """
+    Тестирует движок на selectors.
+    """
+
+    engine = 'selectors'
+
+    def test_call_soon_wakes_loop(self):
+        self.connect('alice')
+        done = threading.Event()
+        start = time.monotonic()
+        self.server.call_soon(done.set)
+        self.assertTrue(done.wait(CONNECTION_TIMEOUT))
+        # Вызов выполнен без ожидания таймаута select
+        self.assertLess(time.monotonic() - start, CONNECTION_TIMEOUT / 2)
+
+    def test_update_lists_timeout(self):
+        # Незапущенный движок: срок рассылки не сбрасывается циклом
+        server = ENGINES[self.engine]('127.0.0.1', free_port(), self.database)
+        self.addCleanup(server.wakeup_writer.close)
+        self.addCleanup(server.wakeup_reader.close)
+        self.assertEqual(server.select_timeout(), CONNECTION_TIMEOUT)
+        server.lists_update_due = time.monotonic() + CONNECTION_TIMEOUT / 5
+        self.assertLessEqual(server.select_timeout(), CONNECTION_TIMEOUT / 5)
+        server.lists_update_due = time.monotonic() - 1
+        self.assertEqual(server.select_timeout(), 0)
+
+
+class TestAsyncioEngine(EngineScenarios, EngineTestCase):
+    """
+    Тестирует движок на asyncio.
+    """
+
+    engine = 'asyncio'
+
+    def test_call_soon_before_start(self):
+        server = ENGINES[self.engine]('127.0.0.1', free_port(), self.database)
+        server.daemon = True
+        calls = []
+        server.call_soon(calls.append, 'before start')
+        server.start()
+        self.assertTrue(wait_for(lambda: calls))
+        server.running = False
+        server.join(CONNECTION_TIMEOUT * 4)
+        # После остановки цикл закрыт, вызовы отбрасываются
+        server.call_soon(calls.append, 'after stop')
+        self.assertEqual(calls, ['before start'])
+
+    def test_shutdown_finishes_connections(self):
+        self.connect('alice')
+        self.connect('bob')
+        self.assertTrue(wait_for(lambda: len(self.server.tasks) == 2))
+        self.server.running = False
+        self.server.join(CONNECTION_TIMEOUT * 4)
+        self.assertFalse(self.server.is_alive())
+        self.assertEqual(self.server.tasks, set())
+        self.assertTrue(self.server.loop.is_closed())
+
+
+class TestBackpressure(EngineTestCase):
+    """
+    Тестирует очередь отправки движка: получатель, не успевающий читать, не отключается,
+    пока его очередь не превысит предел.
+    """
+
+    engine = 'selectors'
+    text = 'x' * 8000
+
+    def setUp(self):
+        super().setUp()
+        self.alice = self.connect('alice')
+        self.bob = self.connect('bob', receive_buffer=4096)
+        self.assertTrue(wait_for(lambda: 'bob' in self.server.names))
+        # Буфер ядра на стороне сервера тоже уменьшаем, чтобы данные оставались в очереди движка
+        self.bob_connection = self.server.names['bob']
+        self.bob_connection.sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 4096)
+
+    def send_messages(self, count):
+        for number in range(count):
+            self.alice.send(self.message('alice', 'bob', f'{number} {self.text}'))
+            self.assertEqual(self.alice.get()[RESPONSE], 200)
+
+    def test_slow_reader_queued(self):
+        self.send_messages(50)
+        self.assertGreater(self.bob_connection.send_buffer.size, 0)
+        self.assertIn(self.bob_connection, self.server.write_pending)
+
+        received = [self.bob.get()[MESSAGE_TEXT].split()[0] for _ in range(50)]
+        self.assertEqual(received, [str(number) for number in range(50)])
+        self.assertTrue(wait_for(lambda: self.bob_connection not in self.server.write_pending))
+        self.assertIs(self.server.names.get('bob'), self.bob_connection)
+
+    def test_overflow_disconnects(self):
+        self.bob_connection.send_buffer.limit = 64 * 1024
+        self.send_messages(50)
+        self.assertTrue(self.bob_connection.closed)
+        self.assertNotIn('bob', self.server.names)
+        self.assertTrue(self.bob.disconnected())
+        # Сообщения, отправленные после отключения, ждут следующего входа получателя
+        self.assertTrue(self.database.get_offline_messages('bob'))
+
+
+class TestConnectionRegistry(EngineTestCase):
+    """
+    Тестирует реестр соединений движка: дескриптор -> соединение и имя -> соединение.
+    """
+
+    engine = 'selectors'
+
+    def test_login_and_logout(self):
+        alice = self.connect('alice')
+        self.assertTrue(wait_for(lambda: 'alice' in self.server.names))
+        connection = self.server.names['alice']
+        self.assertIs(self.server.connections[connection.fd], connection)
+        self.assertEqual((connection.name, connection.authorized), ('alice', True))
+
+        alice.close()
+        self.assertTrue(wait_for(lambda: not self.server.connections))
+        self.assertEqual(self.server.names, {})
+        self.assertTrue(connection.closed)
+        # Повторное удаление закрытого соединения ничего не меняет
+        self.server.remove_client(connection)
+
+    def test_request_before_login(self):
+        client = self.connect()
+        client.send({ACTION: GET_CONTACTS, TIME: time.time(), USER: 'alice'})
+        self.assertTrue(client.disconnected())
+        self.assertTrue(wait_for(lambda: not self.server.connections))
+
+    def test_foreign_sender(self):
+        alice = self.connect('alice')
+        self.connect('bob')
+        alice.send(self.message('bob', 'alice'))
+        self.assertEqual(alice.get()[RESPONSE], 400)
+
+
+class HandshakeScenarios:
+    """
+    Проверки авторизации без блокировки цикла: срок ответа на запрос 511 сокращён до AUTH_TIMEOUT секунд.
+    """
+
+    AUTH_TIMEOUT = 0.3
+
+    def setUp(self):
+        for module in ('server.core', 'server.async_core'):
+            patcher = mock.patch(f'{module}.AUTH_TIMEOUT', self.AUTH_TIMEOUT)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        super().setUp()
+
+    def test_deadline_expired(self):
+        client = self.connect()
+        self.assertEqual(client.presence('alice')[RESPONSE], 511)
+        start = time.monotonic()
+        self.assertTrue(client.disconnected())
+        self.assertGreaterEqual(time.monotonic() - start, self.AUTH_TIMEOUT / 2)
+        self.assertTrue(wait_for(lambda: not self.server.connections))
+        self.assertNotIn('alice', self.server.names)
+
+    def test_pending_handshake_does_not_block(self):
+        waiting = self.connect()
+        self.assertEqual(waiting.presence('carol')[RESPONSE], 511)
+        # Пока carol не ответила на запрос, другие клиенты входят и обмениваются сообщениями
+        alice = self.connect('alice')
+        bob = self.connect('bob')
+        alice.send(self.message('alice', 'bob'))
+        self.assertEqual(alice.get()[RESPONSE], 200)
+        self.assertEqual(bob.get()[MESSAGE_TEXT], 'hello')
+        self.assertTrue(waiting.disconnected())
+
+
+class TestSelectorsHandshake(HandshakeScenarios, EngineTestCase):
+    """
+    Тестирует срок ответа на запрос 511 в движке на selectors.
+    """
+
+    engine = 'selectors'
+
+
+class TestAsyncioHandshake(HandshakeScenarios, EngineTestCase):
+    """
+    Тестирует срок ответа на запрос 511 в движке на asyncio.
+    """
+
+    engine = 'asyncio'
+
+
+class OfflineScenarios:
+    """
+    Проверки доставки сообщений, сохранённых до входа получателя.
+    """
+
+    def test_delivered_on_login(self):
+        alice = self.connect('alice')
+        for number in range(3):
+            alice.send(self.message('alice', 'bob', f'message {number}'))
+            self.assertEqual(alice.get()[RESPONSE], 200)
+
+        bob = self.connect('bob')
+        received = [bob.get() for _ in range(3)]
+        self.assertEqual([message[MESSAGE_TEXT] for message in received], ['message 0', 'message 1', 'message 2'])
+        self.assertEqual({message[SENDER] for message in received}, {'alice'})
+        # Доставленные сообщения удалены из базы
+        self.assertTrue(wait_for(lambda: self.database.get_offline_messages('bob') == []))
+
+    def test_unregistered_recipient(self):
+        alice = self.connect('alice')
+        alice.send(self.message('alice', 'nobody'))
+        self.assertEqual(alice.get()[RESPONSE], 400)
+        self.assertEqual(self.database.get_offline_messages('nobody'), [])
+
+
+class TestSelectorsOffline(OfflineScenarios, EngineTestCase):
+    """
+    Тестирует доставку сохранённых сообщений в движке на selectors.
+    """
+
+    engine = 'selectors'
+
+
+class TestAsyncioOffline(OfflineScenarios, EngineTestCase):
+    """
+    Тестирует доставку сохранённых сообщений в движке на asyncio.
+    """
+
+    engine = 'asyncio'
+
+
+class TestRequestIds(EngineTestCase):
+    """
+    Тестирует номера запросов: сервер возвращает номер в ответе, запросы можно отправлять подряд.
+    """
+
+    engine = 'selectors'
+
+    def setUp(self):
+        super().setUp()
+        self.alice = self.connect('alice')
+
+    def test_pipelined_requests(self):
+        requests = [
+            {ACTION: ADD_CONTACT, USER: 'alice', ACCOUNT_NAME: 'bob', TIME: time.time(), REQUEST_ID: 1},
+            {ACTION: ADD_CONTACT, USER: 'alice', ACCOUNT_NAME: 'carol', TIME: time.time(), REQUEST_ID: 2},
+            {ACTION: GET_CONTACTS, USER: 'alice', TIME: time.time(), REQUEST_ID: 3},
+            {ACTION: GET_CONTACTS, USER: 'bob', TIME: time.time(), REQUEST_ID: 4},
+        ]
+        # Все запросы уходят одной записью, не дожидаясь ответов
+        self.alice.sock.sendall(b''.join(encode_message(request, True) for request in requests))
+        answers = [self.alice.get() for _ in requests]
+
+        self.assertEqual([answer[REQUEST_ID] for answer in answers], [1, 2, 3, 4])
+        self.assertEqual([answer[RESPONSE] for answer in answers], [200, 200, 202, 400])
+        self.assertEqual(answers[2][LIST_INFO], ['bob', 'carol'])
+
+    def test_request_without_id(self):
+        self.alice.send({ACTION: GET_CONTACTS, USER: 'alice', TIME: time.time()})
+        self.assertNotIn(REQUEST_ID, self.alice.get())
+        # Номер не попадает в ответ на следующий запрос
+        self.alice.send({ACTION: GET_CONTACTS, USER: 'alice', TIME: time.time(), REQUEST_ID: 'a'})
+        self.alice.send({ACTION: GET_CONTACTS, USER: 'alice', TIME: time.time()})
+        self.assertEqual(self.alice.get()[REQUEST_ID], 'a')
+        self.assertNotIn(REQUEST_ID, self.alice.get())
+
+
+class TestPublicKeys(EngineTestCase):
+    """
+    Тестирует выдачу открытых ключей и уведомление 206 о смене ключа.
+    """
+
+    engine = 'selectors'
+
+    def test_keys_in_one_request(self):
+        alice = self.connect('alice')
+        alice.send({ACTION: PUBLIC_KEY_REQUEST, ACCOUNT_NAME: ['bob', 'carol', 'nobody'], TIME: time.time()})
+        answer = alice.get()
+        self.assertEqual(answer[RESPONSE], 511)
+        self.assertEqual(answer[DATA], {'bob': 'key of bob', 'carol': 'key of carol'})
+
+    def test_key_changed(self):
+        alice = self.connect('alice')
+        carol = self.connect('carol')
+        bob = self.connect()
+        self.assertEqual(bob.login('bob', key='new key of bob')[RESPONSE], 200)
+
+        for client in (alice, carol):
+            self.assertEqual(client.get(), {RESPONSE: 206, ACCOUNT_NAME: 'bob'})
+        self.assertEqual(self.database.get_public_key('bob'), 'new key of bob')
+        # Общий шаблон уведомления не изменился
+        self.assertIsNone(RESPONSE_206[ACCOUNT_NAME])
+
+    def test_same_key_not_announced(self):
+        alice = self.connect('alice')
+        self.connect('bob')
+        # Следующий ответ alice - ответ на её запрос, уведомления 206 перед ним нет
+        alice.send({ACTION: GET_CONTACTS, USER: 'alice', TIME: time.time()})
+        self.assertEqual(alice.get()[RESPONSE], 202)
+
+
+class TestUpdateLists(EngineTestCase):
+    """
+    Тестирует объединение уведомлений 205 и ответы на запросы списка пользователей по версии.
+    """
+
+    engine = 'selectors'
+
+    def setUp(self):
+        super().setUp()
+        self.alice = self.connect('alice')
+        self.bob = self.connect('bob')
+
+    def users_request(self, version=None):
+        request = {ACTION: USERS_REQUEST, ACCOUNT_NAME: 'alice', TIME: time.time()}
+        if version is not None:
+            request[VERSION] = version
+        self.alice.send(request)
+        return self.alice.get()
+
+    def test_coalesced(self):
+        self.database.add_user('dave', PASSWORD_HASH)
+        start = time.monotonic()
+        for _ in range(5):
+            self.server.service_update_lists()
+
+        for client in (self.alice, self.bob):
+            notice = client.get()
+            self.assertEqual(notice[RESPONSE], 205)
+            self.assertEqual(notice[VERSION], self.database.users_version())
+            self.assertGreaterEqual(notice[DELAY], 0)
+            self.assertLessEqual(notice[DELAY], self.server.update_lists_spread())
+        self.assertGreaterEqual(time.monotonic() - start, UPDATE_LISTS_DELAY / 2)
+
+        # Второго уведомления нет: следующий ответ - ответ на запрос
+        self.alice.send({ACTION: GET_CONTACTS, USER: 'alice', TIME: time.time()})
+        self.assertEqual(self.alice.get()[RESPONSE], 202)
+        self.assertEqual(RESPONSE_205, {RESPONSE: 205})
+
+    def test_changes_since_version(self):
+        version = self.database.users_version()
+        answer = self.users_request(version)
+        self.assertEqual((answer[VERSION], answer[USERS_ADDED], answer[USERS_REMOVED]), (version, [], []))
+
+        self.database.add_user('dave', PASSWORD_HASH)
+        self.database.remove_user('carol')
+        answer = self.users_request(version)
+        self.assertEqual((answer[VERSION], answer[USERS_ADDED], answer[USERS_REMOVED]),
+                         (version + 2, ['dave'], ['carol']))
+
+        answer = self.users_request()
+        self.assertEqual(sorted(answer[LIST_INFO]), ['alice', 'bob', 'dave'])
+        self.assertNotIn(USERS_ADDED, answer)
+
+    def test_answer_shared(self):
+        with mock.patch.object(self.database, 'users_snapshot', wraps=self.database.users_snapshot) as snapshot:
+            first = self.users_request()
+            second = self.users_request()
+        self.assertEqual(first, second)
+        # Одинаковые запросы одной версии списка обслуживает один запрос к базе
+        self.assertEqual(snapshot.call_count, 1)
+
+
+class TestSessionListeners(EngineTestCase):
+    """
+    Тестирует передачу входов и выходов пользователей подписчикам движка (окну сервера).
+    """
+
+    engine = 'selectors'
+
+    def setUp(self):
+        super().setUp()
+        self.events = []
+        self.server.add_session_listener(lambda name, address: self.events.append((name, address)))
+
+    def test_login_and_logout(self):
+        alice = self.connect('alice')
+        self.assertTrue(wait_for(lambda: self.events))
+        name, address = self.events[0]
+        self.assertEqual((name, address), ('alice', alice.sock.getsockname()))
+
+        alice.close()
+        self.assertTrue(wait_for(lambda: len(self.events) == 2))
+        self.assertEqual(self.events[1], ('alice', None))
+
+    def test_removed_from_gui(self):
+        self.connect('alice')
+        self.connect('bob')
+        self.server.disconnect_user('bob')
+        self.assertTrue(wait_for(lambda: ('bob', None) in self.events))
+        self.assertEqual([name for name, address in self.events if address is None], ['bob'])
+
+
+@unittest.skipIf(ActiveUsersModel is None, 'PyQt5 is not installed')
+class TestActiveUsersModel(unittest.TestCase):
+    """
+    Тестирует таблицу активных пользователей, которая меняется по событиям входа и выхода.
+    """
+
+    def setUp(self):
+        self.time = datetime.datetime(2020, 1, 1, 10, 0)
+        self.model = ActiveUsersModel()
+        self.model.reset([('alice', '127.0.0.1', 7001, self.time), ('bob', '127.0.0.1', 7002, self.time)])
+
+    def names(self):
+        return [self.model.index(row, 0).data() for row in range(self.model.rowCount())]
+
+    def test_login_appends(self):
+        self.model.apply([('carol', ('127.0.0.1', 7003), self.time), ('dave', ('127.0.0.1', 7004), self.time)])
+        self.assertEqual(self.names(), ['alice', 'bob', 'carol', 'dave'])
+        self.assertEqual(self.model.index(2, 2).data(), '7003')
+
+    def test_logout_moves_last_row(self):
+        self.model.apply([('carol', ('127.0.0.1', 7003), self.time)])
+        self.model.apply([('alice', None, self.time)])
+        self.assertEqual(self.names(), ['carol', 'bob'])
+        self.assertEqual(self.model.positions, {'carol': 0, 'bob': 1})
+
+    def test_relogin_updates_row(self):
+        self.model.apply([('bob', ('10.0.0.1', 8000), self.time)])
+        self.assertEqual(self.names(), ['alice', 'bob'])
+        self.assertEqual(self.model.index(1, 1).data(), '10.0.0.1')
+
+    def test_login_and_logout_in_one_batch(self):
+        self.model.apply([('carol', ('127.0.0.1', 7003), self.time), ('carol', None, self.time),
+                          ('nobody', None, self.time)])
+        self.assertEqual(self.names(), ['alice', 'bob'])
+
+
+@unittest.skipIf(SessionEvents is None, 'PyQt5 is not installed')
+class TestSessionEvents(unittest.TestCase):
+    """
+    Тестирует очередь событий между потоком движка и окном сервера.
+    """
+
+    def test_signal_for_batch(self):
+        events = SessionEvents()
+        signals = []
+        events.arrived.connect(lambda: signals.append(True))
+        events.push('alice', ('127.0.0.1', 7001))
+        events.push('alice')
+        self.assertEqual(len(signals), 1)
+
+        taken = events.take()
+        self.assertEqual([(name, address) for name, address, time in taken],
+                         [('alice', ('127.0.0.1', 7001)), ('alice', None)])
+        self.assertEqual(events.take(), [])
+        # После разбора очереди следующее событие снова подаёт сигнал
+        events.push('bob')
+        self.assertEqual(len(signals), 2)
+
+
 if __name__ == '__main__':
     unittest.main()
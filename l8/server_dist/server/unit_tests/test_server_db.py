@@ -0,0 +1,305 @@
+import unittest
+import sys
+import os
+import shutil
+import sqlite3
+import tempfile
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.getcwd(), '..'))
+from db.server_db_config import SCHEMA_VERSION, ServerDB
+
+# Схема базы до перехода на числовые внешние ключи: id пользователей хранятся строками
+OLD_SCHEMA = '''
+CREATE TABLE all_users (
+    id INTEGER NOT NULL, name VARCHAR, last_login DATETIME, pswd_hash VARCHAR, public_key TEXT,
+    PRIMARY KEY (id), UNIQUE (name)
+);
+CREATE TABLE active_users (
+    id INTEGER NOT NULL, user VARCHAR, ip VARCHAR, port INTEGER, login_time DATETIME,
+    PRIMARY KEY (id), UNIQUE (user), FOREIGN KEY(user) REFERENCES all_users (id)
+);
+CREATE TABLE login_history (
+    id INTEGER NOT NULL, user VARCHAR, login_time DATETIME, ip VARCHAR, port INTEGER,
+    PRIMARY KEY (id), FOREIGN KEY(user) REFERENCES all_users (id)
+);
+CREATE TABLE contacts (
+    id INTEGER NOT NULL, user VARCHAR, contact VARCHAR,
+    PRIMARY KEY (id), FOREIGN KEY(user) REFERENCES all_users (id), FOREIGN KEY(contact) REFERENCES all_users (id)
+);
+CREATE TABLE users_history (
+    id INTEGER NOT NULL, user VARCHAR, sent INTEGER, accepted INTEGER,
+    PRIMARY KEY (id), FOREIGN KEY(user) REFERENCES all_users (id)
+);
+INSERT INTO all_users (id, name, pswd_hash) VALUES (1, 'alice', 'h1'), (2, 'bob', 'h2'), (3, 'carol', 'h3');
+INSERT INTO login_history (id, user, login_time, ip, port) VALUES
+    (1, '1', '2020-01-01 10:00:00.000000', '127.0.0.1', 7001),
+    (2, '2', '2020-01-01 11:00:00.000000', '127.0.0.1', 7002),
+    (3, '9', '2020-01-01 12:00:00.000000', '127.0.0.1', 7009);
+INSERT INTO contacts (id, user, contact) VALUES (1, '1', '2'), (2, '1', '2'), (3, '1', '3'), (4, '2', '9'), (5, '3', '1');
+INSERT INTO users_history (id, user, sent, accepted) VALUES (1, '1', 5, 1), (2, '2', 0, 4), (3, '3', 2, 2), (4, '9', 7, 7);
+'''
+
+
+class TestMigration(unittest.TestCase):
+    """
+    Тестирует перестройку базы прежней версии под текущую схему.
+    """
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'server_db.db3')
+        connection = sqlite3.connect(self.path)
+        connection.executescript(OLD_SCHEMA)
+        connection.close()
+        self.database = ServerDB(self.path)
+
+    def tearDown(self):
+        self.database.close()
+        shutil.rmtree(self.directory)
+
+    def query(self, sql):
+        connection = sqlite3.connect(self.path)
+        try:
+            return connection.execute(sql).fetchall()
+        finally:
+            connection.close()
+
+    def test_rows_converted(self):
+        self.assertEqual(self.query('SELECT id, user, contact, typeof(user), typeof(contact) FROM contacts'),
+                         [(1, 1, 2, 'integer', 'integer'), (3, 1, 3, 'integer', 'integer'),
+                          (5, 3, 1, 'integer', 'integer')])
+        self.assertEqual(self.query('SELECT id, user, typeof(user), port FROM login_history'),
+                         [(1, 1, 'integer', 7001), (2, 2, 'integer', 7002)])
+        self.assertEqual(self.query('SELECT id, user, sent, accepted FROM users_history'),
+                         [(1, 1, 5, 1), (2, 2, 0, 4), (3, 3, 2, 2)])
+        self.assertEqual(self.query('PRAGMA user_version'), [(SCHEMA_VERSION,)])
+        self.assertEqual(self.query('PRAGMA foreign_key_check'), [])
+        self.assertEqual(self.database.get_contacts('alice'), ['bob', 'carol'])
+
+    def test_cascade_delete(self):
+        self.database.remove_user('alice')
+        self.assertEqual(self.query('SELECT user, contact FROM contacts'), [])
+        self.assertEqual(self.query('SELECT user FROM login_history'), [(2,)])
+        self.assertEqual(self.query('SELECT user FROM users_history ORDER BY user'), [(2,), (3,)])
+
+    def test_second_open(self):
+        self.database.close()
+        schema = self.query('SELECT sql FROM sqlite_master ORDER BY name')
+        with mock.patch.object(ServerDB, 'rebuild_table') as rebuild_table:
+            self.database = ServerDB(self.path)
+        rebuild_table.assert_not_called()
+        self.assertEqual(self.query('SELECT sql FROM sqlite_master ORDER BY name'), schema)
+        self.assertEqual(self.query('SELECT id, user, contact FROM contacts'), [(1, 1, 2), (3, 1, 3), (5, 3, 1)])
+
+
+class DatabaseTestCase(unittest.TestCase):
+    """
+    Новая база с пользователями alice, bob и carol во временном каталоге.
+    Поток записи записывает пачку только по требованию (большой интервал записи).
+    """
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'server_db.db3')
+        self.database = ServerDB(self.path, write_interval=60, stats_interval=60)
+        for name in ('alice', 'bob', 'carol'):
+            self.database.add_user(name, b'hash')
+
+    def tearDown(self):
+        self.database.close()
+        shutil.rmtree(self.directory)
+
+    def query(self, sql, *args):
+        connection = sqlite3.connect(self.path)
+        try:
+            return connection.execute(sql, args).fetchall()
+        finally:
+            connection.close()
+
+
+class TestWriter(DatabaseTestCase):
+    """
+    Тестирует запись изменений потоком записи.
+    """
+
+    def test_wait_writes_queued(self):
+        self.database.add_contact('alice', 'bob')
+        self.database.add_contact('alice', 'carol')
+        self.assertEqual(self.query('SELECT COUNT(*) FROM contacts'), [(0,)])
+        self.database.writer.wait('alice')
+        self.assertEqual(self.query('SELECT user, contact FROM contacts ORDER BY id'), [(1, 2), (1, 3)])
+        self.assertEqual(self.database.writer.pending, {})
+
+    def test_order_kept(self):
+        self.database.add_contact('alice', 'bob')
+        self.database.remove_contact('alice', 'bob')
+        self.database.add_contact('alice', 'bob')
+        self.database.remove_contact('alice', 'carol')
+        self.database.flush()
+        self.assertEqual(self.query('SELECT user, contact FROM contacts'), [(1, 2)])
+
+    def test_call_after_queued(self):
+        self.database.add_contact('alice', 'bob')
+        count = self.database.writer.call(lambda session: session.query(ServerDB.UsersContacts).count())
+        self.assertEqual(count, 1)
+
+    def test_call_error(self):
+        def fail(session):
+            session.add(ServerDB.AllUsers('alice', b'hash'))
+            session.flush()
+
+        self.assertRaises(Exception, self.database.writer.call, fail)
+        # Транзакция с ошибкой откатывается, поток продолжает работу
+        self.database.add_user('dave', b'hash')
+        self.assertEqual(self.query('SELECT name FROM all_users WHERE name = ?', 'dave'), [('dave',)])
+
+
+class TestMessageStats(DatabaseTestCase):
+    """
+    Тестирует счётчики сообщений в памяти и их перенос в users_history.
+    """
+
+    def history(self):
+        return {name: (sent, accepted) for name, last_login, sent, accepted in self.database.message_history()}
+
+    def stored(self):
+        return self.query('SELECT all_users.name, sent, accepted FROM users_history '
+                          'JOIN all_users ON all_users.id = users_history.user ORDER BY all_users.id')
+
+    def test_flush_totals(self):
+        for _ in range(3):
+            self.database.process_message('alice', 'bob')
+        self.database.process_message('bob', 'alice')
+        expected = {'alice': (3, 1), 'bob': (1, 3), 'carol': (0, 0)}
+        # Ещё не записанные счётчики уже видны в статистике
+        self.assertEqual(self.stored(), [('alice', 0, 0), ('bob', 0, 0), ('carol', 0, 0)])
+        self.assertEqual(self.history(), expected)
+
+        self.database.writer.call(self.database.flush_message_stats)
+        self.assertEqual(self.stored(), [('alice', 3, 1), ('bob', 1, 3), ('carol', 0, 0)])
+        self.assertEqual(self.database.message_counters, {})
+        self.assertEqual(self.history(), expected)
+
+        # Следующий перенос прибавляется к записанным значениям
+        self.database.process_message('carol', 'alice')
+        self.database.writer.call(self.database.flush_message_stats)
+        self.assertEqual(self.stored(), [('alice', 3, 2), ('bob', 1, 3), ('carol', 1, 0)])
+
+    def test_flush_on_close(self):
+        self.database.process_message('alice', 'carol')
+        self.database.close()
+        self.assertEqual(self.stored(), [('alice', 1, 0), ('bob', 0, 0), ('carol', 0, 1)])
+
+
+class TestOfflineMessages(DatabaseTestCase):
+    """
+    Тестирует хранение сообщений для пользователей не в сети.
+    """
+
+    def test_delivered_once(self):
+        first = {'text': 'first'}
+        second = {'text': 'second'}
+        self.database.store_offline_message('bob', first)
+        self.database.store_offline_message('bob', second)
+        self.database.store_offline_message('carol', first)
+
+        messages = self.database.get_offline_messages('bob')
+        self.assertEqual([message for message_id, message in messages], [first, second])
+        self.database.remove_offline_messages('bob', messages[-1][0])
+        self.assertEqual(self.database.get_offline_messages('bob'), [])
+        self.assertEqual(len(self.database.get_offline_messages('carol')), 1)
+
+        # Сообщение, пришедшее после выборки, не удаляется вместе с доставленными
+        self.database.store_offline_message('bob', first)
+        messages = self.database.get_offline_messages('bob')
+        self.database.store_offline_message('bob', second)
+        self.database.remove_offline_messages('bob', messages[-1][0])
+        self.assertEqual([message for message_id, message in self.database.get_offline_messages('bob')], [second])
+
+    def test_removed_with_user(self):
+        self.database.store_offline_message('bob', {'text': 'text'})
+        self.database.remove_user('bob')
+        self.assertEqual(self.query('SELECT COUNT(*) FROM offline_messages'), [(0,)])
+
+
+class TestUserCache(DatabaseTestCase):
+    """
+    Тестирует кеш пользователей ServerDB.
+    """
+
+    def test_removed_user(self):
+        self.database.add_contact('alice', 'bob')
+        self.database.add_contact('alice', 'carol')
+        self.assertEqual(self.database.get_contacts('alice'), ['bob', 'carol'])
+        self.assertTrue(self.database.check_user('bob'))
+
+        self.database.remove_user('bob')
+        self.assertNotIn('bob', self.database.cache.users)
+        self.assertFalse(self.database.check_user('bob'))
+        self.assertIsNone(self.database.get_hash('bob'))
+        self.assertEqual(self.database.get_contacts('alice'), ['carol'])
+
+        # Пользователь с тем же именем - новая запись, а не прежняя из кеша
+        self.database.add_user('bob', b'new hash')
+        self.assertEqual(self.database.get_hash('bob'), b'new hash')
+        self.assertEqual(self.database.get_user_id('bob'), 4)
+
+    def test_unknown_user_contacts(self):
+        self.assertEqual(self.database.get_contacts('nobody'), [])
+        self.database.add_contact('nobody', 'bob')
+        self.database.remove_contact('nobody', 'bob')
+        self.database.flush()
+        self.assertEqual(self.database.get_contacts('nobody'), [])
+
+    def test_incomplete_cache(self):
+        self.database.close()
+        self.database = ServerDB(self.path, cache_size=2)
+        self.assertFalse(self.database.cache.complete)
+        # Вытесненный пользователь читается из базы
+        self.assertTrue(self.database.check_user('carol'))
+        self.assertEqual(self.database.cache_metrics()['users'], 2)
+
+        self.database.remove_user('alice')
+        self.assertFalse(self.database.check_user('alice'))
+        self.assertIsNone(self.database.get_public_key('alice'))
+
+
+class TestUserListVersions(DatabaseTestCase):
+    """
+    Тестирует изменения списка пользователей по версиям.
+    Журнал изменений уменьшен до трёх записей.
+    """
+
+    def setUp(self):
+        patcher = mock.patch('db.server_db_config.DIRECTORY_LOG_LIMIT', 3)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        super().setUp()
+        self.database.add_user('dave', b'hash')
+        self.database.remove_user('alice')
+
+    def test_delta(self):
+        self.assertEqual(self.database.users_version(), 5)
+        self.assertEqual(self.database.users_changes(5), (5, [], []))
+        self.assertEqual(self.database.users_changes(4), (5, [], ['alice']))
+        # Самая старая версия, от которой в журнале есть все изменения
+        self.assertEqual(self.database.users_changes(2), (5, ['carol', 'dave'], ['alice']))
+
+    def test_snapshot(self):
+        self.assertIsNone(self.database.users_changes(1))
+        self.assertIsNone(self.database.users_changes(6))
+        version, names = self.database.users_snapshot()
+        self.assertEqual((version, sorted(names)), (5, ['bob', 'carol', 'dave']))
+
+    def test_reopen(self):
+        self.database.close()
+        self.assertEqual(self.query('SELECT id, name, added FROM directory_log ORDER BY id'),
+                         [(3, 'carol', 1), (4, 'dave', 1), (5, 'alice', 0)])
+        self.database = ServerDB(self.path)
+        self.assertEqual(self.database.users_changes(2), (5, ['carol', 'dave'], ['alice']))
+        self.assertIsNone(self.database.users_changes(1))
+
+
+if __name__ == '__main__':
+    unittest.main()